@@ -0,0 +1,54 @@
+"""
+Memory used per DynamicAttribute: the __slots__ class vs. an object
+with the same members in a per-instance __dict__ (as DynamicAttribute 
+was in previous releases), and with a RingBuffer history of N samples.
+
+Sizes are the sys.getsizeof of the instance, its __dict__ and history 
+buffers (values shared between attributes are not counted).
+
+  python ci/bench/bench_dynattr_memory.py [attributes] [history_size]
+"""
+
+import sys,time
+from fandango.tango.dynattr import DynamicAttribute
+
+class DictAttribute(object):
+    """ The members of DynamicAttribute, kept in __dict__ """
+    def __init__(self,name=''):
+        for k in DynamicAttribute.__slots__:
+            setattr(self,k,None)
+        self.name = name
+
+def sizeof(attr):
+    size = sys.getsizeof(attr)
+    if hasattr(attr,'__dict__'):
+        size += sys.getsizeof(attr.__dict__)
+    h = getattr(attr,'history',None)
+    if h is not None:
+        size += sum(map(sys.getsizeof,(h,h.times,h.values,h.qualities)))
+    return size
+
+def bench(klass,n,history=0):
+    attrs = [klass(name='A%d'%i) for i in range(n)]
+    for i,a in enumerate(attrs):
+        if history:
+            a.set_history(history)
+            for j in range(history):
+                a.update(float(i+j),time.time(),0)
+    return sum(map(sizeof,attrs))/float(n)
+
+def main(args=None):
+    args = args or sys.argv[1:]
+    n = int(args[0]) if args else 10000
+    history = int(args[1]) if len(args)>1 else 100
+    print('%-32s %16s'%('','bytes/attribute'))
+    for label,klass,h in (
+            ('__dict__ (previous)',DictAttribute,0),
+            ('__slots__',DynamicAttribute,0),
+            ('__slots__ + history(%d)'%history,DynamicAttribute,history),
+            ):
+        print('%-32s %16d'%(label,bench(klass,n,h)))
+    return True
+
+if __name__ == '__main__':
+    main()
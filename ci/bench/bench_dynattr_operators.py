@@ -0,0 +1,50 @@
+"""
+Benchmark of DynamicAttribute operators used in formulas; each 
+expression is evaluated with A, B (scalars) and L (list) bound to 
+DynamicAttribute objects and the time per evaluation is printed.
+
+  python ci/bench/bench_dynattr_operators.py [loops]
+"""
+
+import sys,time
+from fandango.tango.dynattr import DynamicAttribute,AttrQuality
+
+EXPRESSIONS = [
+    'A+B',
+    'A*2+1',
+    '2*A-B',
+    'A>B',
+    'A==1.5',
+    'float(A)',
+    'abs(-A)',
+    'L[0]+L[1]',
+    '1 if A and B>0 else 0',
+    '(A+B)*(A-B)/2.',
+    ]
+
+def get_namespace():
+    now = time.time()
+    return {
+        'A':DynamicAttribute(1.5,now,AttrQuality.ATTR_VALID,'A'),
+        'B':DynamicAttribute(2.5,now-1,AttrQuality.ATTR_WARNING,'B'),
+        'L':DynamicAttribute([1.,2.,3.],now,AttrQuality.ATTR_VALID,'L'),
+        }
+
+def bench(expression,namespace,loops):
+    code = compile(expression,expression,'eval')
+    t0 = time.time()
+    for i in xrange(loops):
+        eval(code,{},namespace)
+    return (time.time()-t0)/loops
+
+def main(args=None):
+    args = args or sys.argv[1:]
+    loops = int(args[0]) if args else 100000
+    namespace = get_namespace()
+    print('%-28s %12s'%('expression','us/eval'))
+    for e in EXPRESSIONS:
+        print('%-28s %12.2f'%(e,1e6*bench(e,namespace,loops)))
+    return True
+
+if __name__ == '__main__':
+    main()
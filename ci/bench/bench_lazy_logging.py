@@ -0,0 +1,59 @@
+"""
+Compares the logging cost of an evalAttr-like call at WARNING level,
+building messages eagerly ('...'%(shortstr(value),)) as DynamicDS did 
+before, or passing deferred arguments to Logger (formatted only if the 
+level is enabled).
+
+  python ci/bench/bench_lazy_logging.py [array_size] [loops]
+"""
+
+import sys,time
+from fandango.log import Logger,Lazy,shortstr
+from fandango.functional import time2str
+
+def eager(log,aname,value,t0):
+    log.debug("DynamicDS(%s)::evalAttr(%s,%s): ... last value was %s"
+        % ('test/dyn/1',aname,False,shortstr(value)))
+    log.debug('Returning cached (%s) value for %s: %s(%s)'
+        %(time2str(t0),aname,type(value),shortstr(value)))
+    log.debug('%s::evalAttr(READ): Attribute=%s; formula=%s;'
+        %('test/dyn/1',aname,'[0]*N'))
+    log.debug('eval result: '+str(value))
+    log.info('In check_changed_event(%s,%s,%s): %s!=%s'
+        % (aname,True,None,shortstr(value),shortstr(value)))
+    log.debug('evalAttr(%s): events = %s, check = %s, cached = %s, '
+        'eval_ms = %d' % (aname,True,True,True,0.1))
+    
+def lazy(log,aname,value,t0):
+    log.debug("DynamicDS(%s)::evalAttr(%s,%s): ... last value was %s",
+        'test/dyn/1',aname,False,Lazy(shortstr,value))
+    log.debug('Returning cached (%s) value for %s: %s(%s)',
+        Lazy(time2str,t0),aname,type(value),Lazy(shortstr,value))
+    log.debug('%s::evalAttr(READ): Attribute=%s; formula=%s;',
+        'test/dyn/1',aname,'[0]*N')
+    log.debug('eval result: %s',Lazy(shortstr,value))
+    log.info('In check_changed_event(%s,%s,%s): %s!=%s',
+        aname,True,None,Lazy(shortstr,value),Lazy(shortstr,value))
+    log.debug('evalAttr(%s): events = %s, check = %s, cached = %s, '
+        'eval_ms = %d', aname,True,True,True,0.1)
+    
+def bench(method,log,value,loops):
+    t0 = time.time()
+    for i in range(loops):
+        method(log,'A',value,t0)
+    return (time.time()-t0)/loops
+
+def main(args=None):
+    args = args or sys.argv[1:]
+    size = int(args[0]) if args else 10000
+    loops = int(args[1]) if len(args)>1 else 1000
+    log = Logger('bench',level='WARNING')
+    print('%10s %16s %16s'%('size','eager(us/call)','lazy(us/call)'))
+    for n in sorted(set((1,100,size))):
+        value = [float(i) for i in range(n)]
+        print('%10d %16.2f %16.2f'%(n,1e6*bench(eager,log,value,loops),
+                                    1e6*bench(lazy,log,value,loops)))
+    return True
+
+if __name__ == '__main__':
+    main()
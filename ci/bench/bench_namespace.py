@@ -0,0 +1,80 @@
+"""
+Benchmark of the DynamicDS evaluation namespace.
+
+It emulates a polling cycle (every attribute evaluated once) using the
+per-call rebuild of locals done by evalAttr in previous releases vs. the
+persistent LayeredDict namespace; cycle time is printed for each number
+of attributes.
+
+Formulas use builtins and device globals (as DynamicDS formulas do), so
+the names resolved by eval after the locals are included in the cost.
+
+  python ci/bench/bench_namespace.py [attribute counts]
+"""
+
+import sys,time
+from fandango.dicts import LayeredDict
+
+QUALITIES = dict(('ATTR_%d'%i,i) for i in range(5))
+TYPES = dict(('DevVar%d'%i,float) for i in range(20))
+GLOBALS = {'K':0}
+
+def get_attributes(n):
+    attrs = dict(('A%d'%i,'max(A%d,K)+abs(-1)'%(i-1) if i else '1') 
+                 for i in range(n))
+    return attrs,dict((a,compile(f,a,'eval')) for a,f in attrs.items())
+
+def cycle_rebuild(attrs,compiled,values,_locals):
+    for a in sorted(attrs):
+        # Former evalAttr: dependencies, defaults and constants per call
+        for k,v in values.items():
+            if k in attrs[a]:
+                _locals[k] = v
+        _locals.update({
+            't':time.time(),
+            'WRITE':False,'READ':True,'ATTRIBUTE':a,'VALUE':None,
+            'ATTRIBUTES':sorted(attrs.keys()),
+            'FORMULAS':dict((k,v) for k,v in attrs.items()),
+            })
+        [_locals.__setitem__(k,v) for k,v in QUALITIES.items()]
+        [_locals.__setitem__(k,v) for k,v in TYPES.items()]
+        values[a] = _locals[a] = eval(compiled[a],GLOBALS,_locals)
+
+def cycle_layered(attrs,compiled,values,_locals):
+    for a in sorted(attrs):
+        _locals.push({'t':time.time(),'WRITE':False,'READ':True,
+            'ATTRIBUTE':a,'VALUE':None})
+        try:
+            values[a] = _locals[a] = eval(compiled[a],GLOBALS,_locals)
+        finally:
+            _locals.pop()
+
+def bench(n,cycles=5):
+    attrs,compiled = get_attributes(n)
+    results = []
+    for method,ns in ((cycle_rebuild,{}),(cycle_layered,LayeredDict())):
+        if isinstance(ns,LayeredDict):
+            ns.globals = GLOBALS
+            ns.update(QUALITIES)
+            ns.update(TYPES)
+            ns.set_lazy('ATTRIBUTES',lambda:sorted(attrs.keys()))
+            ns.set_lazy('FORMULAS',lambda:dict(attrs))
+        values = dict.fromkeys(attrs,0)
+        ns.update(values)
+        t0 = time.time()
+        for i in range(cycles):
+            method(attrs,compiled,values,ns)
+        results.append(1e3*(time.time()-t0)/cycles)
+    return results
+
+def main(args=None):
+    args = args or sys.argv[1:]
+    counts = map(int,args) or [10,50,100,250,500,1000]
+    print('%8s %14s %14s %8s'%('attrs','rebuild(ms)','layered(ms)','ratio'))
+    for n in counts:
+        old,new = bench(n)
+        print('%8d %14.3f %14.3f %8.1f'%(n,old,new,old/(new or 1e-9)))
+    return True
+
+if __name__ == '__main__':
+    main()
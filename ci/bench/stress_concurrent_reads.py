@@ -0,0 +1,64 @@
+"""
+Stress test for concurrent attribute reading on a running DynamicDS device.
+
+N client threads read the given attributes in a loop (each thread using
+its own DeviceProxy) for a number of seconds; reads/second and latency
+are printed for each number of threads.
+
+Compare the results with ConcurrentReads=False/True in the device
+(the server must be launched with SerialModel NO_SYNC to allow parallel
+requests; a slow attribute, e.g. one reading an unresponsive device,
+will show the difference).
+
+  python ci/bench/stress_concurrent_reads.py test/dyn/1 A,B,C 1,2,4,8 [seconds]
+"""
+
+import sys,time,threading
+import PyTango
+
+def reader(device,attributes,stop,results):
+    dp = PyTango.DeviceProxy(device)
+    count,errors,latency = 0,0,0.
+    while not stop.is_set():
+        for a in attributes:
+            t0 = time.time()
+            try:
+                dp.read_attribute(a)
+                count += 1
+            except Exception,e:
+                errors += 1
+            latency = max((latency,time.time()-t0))
+    results.append((count,errors,latency))
+
+def stress(device,attributes,nthreads,seconds=10.):
+    stop,results = threading.Event(),[]
+    threads = [threading.Thread(target=reader,
+                    args=(device,attributes,stop,results))
+               for i in range(nthreads)]
+    t0 = time.time()
+    [t.start() for t in threads]
+    time.sleep(seconds)
+    stop.set()
+    [t.join() for t in threads]
+    elapsed = time.time()-t0
+    reads = sum(r[0] for r in results)
+    errors = sum(r[1] for r in results)
+    latency = max(r[2] for r in results) if results else 0
+    return reads/elapsed,errors,latency
+
+def main(args=None):
+    args = args or sys.argv[1:]
+    if len(args)<2:
+        print(__doc__)
+        return False
+    device,attributes = args[0],args[1].split(',')
+    nthreads = map(int,args[2].split(',')) if len(args)>2 else [1,2,4,8]
+    seconds = float(args[3]) if len(args)>3 else 10.
+    print('%8s %12s %8s %14s'%('threads','reads/s','errors','max_lat(ms)'))
+    for n in nthreads:
+        rate,errors,latency = stress(device,attributes,n,seconds)
+        print('%8d %12.1f %8d %14.1f'%(n,rate,errors,1e3*latency))
+    return True
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import fandango as fn
+from fandango.arrays import RingBuffer
+
+class _Tester(object):
+
+    def __init__(self,name):
+        self.name = name
+
+    def __enter__(self):
+        print('testing %s' % self.name)
+
+    def __exit__(self, et, ev, etb):
+        if et:
+            print('Failed!',etb)
+
+def test_RingBuffer():
+    rb = RingBuffer(4)
+    assert not len(rb) and rb.last() is None and rb.delta() is None
+    for i in range(6):
+        rb.append(100.+i,2.*i,i%2)
+    assert len(rb) == 4
+    assert [v for t,v,q in rb.items()] == [4.,6.,8.,10.]
+    assert rb.last() == (105.,10.,1)
+    assert rb.delta() == 6. and rb.mean() == 7. and rb.rate() == 2.
+    assert rb.items(window=2,now=105.) == [(103.,6.,1),(104.,8.,0),(105.,10.,1)]
+    assert rb.delta(window=1,now=105.) == 2.
+    try:
+        rb.append(106.,'x')
+        assert False, 'TypeError not raised'
+    except TypeError:
+        pass
+    rs = RingBuffer(2,numeric=False)
+    rs.append(1.,'a')
+    rs.append(2.,'b')
+    rs.append(3.,'c')
+    assert [v for t,v,q in rs.items()] == ['b','c']
+    rb.clear()
+    assert not rb.items()
+    return True
+
+def main():
+    for f in globals().values():
+        if str(getattr(f,'__name__','')).startswith('test_'):
+            with _Tester(f.__name__) as t:
+                print(f())
+    return True
+
+if __name__ == '__main__':
+    main()
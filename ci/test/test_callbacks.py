@@ -1,42 +1,184 @@
+import sys
 import fandango as fn, fandango.callbacks as fc
+from collections import defaultdict
 
-attrs = map(str.lower,fn.get_matching_attributes('bl00*eps*plc*01/*'))
+class _Tester(object):
 
-a = 'bl00/ct/eps-plc-01/State'
+    def __init__(self,name):
+        self.name = name
 
-t0 = fn.now()
-sources = dict((d,fc.EventSource(d,asynchronous=True)) for d in sorted(attrs))
+    def __enter__(self):
+        print('testing %s' % self.name)
 
-#sources.values()[10].read(synch=True)
+    def __exit__(self, et, ev, etb):
+        if et:
+            print('Failed!',etb)
 
-cache = fn.CaselessDict()
+class _Source(object):
+    """ Minimal EventSource replacement for EventThread tests """
+    KeepAlive = 15000.
+    polling_period = 3000.
+    def __init__(self,full_name):
+        self.full_name = full_name
+        self.device = full_name.rsplit('/',1)[0]
+        self.stats = defaultdict(int)
+        self.last_read_time = 0
+    def isPollingEnabled(self):
+        return False
 
-def hook(src,t,value):
-    cache[src.normal_name]=(value)
+def _thread():
+    t = fc.EventThread()
+    t.start = lambda: None #register() must not launch the thread
+    return t
 
-el = fc.EventListener('A Queue for All')
-el.set_value_hook(hook)
-print('Subscribing %d attributes'%len(attrs))
-[s.addListener(el) for k,s in sorted(sources.items())]
-print('Subscription took %f seconds'%(fn.now()-t0))
+def test_filter_events():
+    t,s = _thread(),_Source('a/b/c/d')
+    error = Exception('failed')
+    events = [(s,(t_,v),None) for t_,v in (('periodic',1),('change',2),
+        ('periodic',3),('change',error),('change',4),('periodic',5),
+        ('change',6))]
+    # superseded rules are opt-in
+    assert len(t.filter_events(list(events))) == len(events)
+    s.event_filters = {'superseded':{'periodic':('change','archive')}}
+    kept = [e[1][1] for e in t.filter_events(list(events))]
+    assert kept == [2,error,4,6], kept
+    assert t.stats['superseded'] == 3 and not t.stats['coalesced']
+    kept = [e[1][1] for e in t.filter_events(list(events),filtered=True)]
+    assert kept == [error,6], kept
+    assert t.stats['coalesced'] == 2 and s.stats['coalesced'] == 2
+    return True
 
-t0 = fn.now()
-print('Waiting ...')
-while len(cache) < len(attrs):
-    if fn.now() > t0+18.:
-        break
-    fn.wait(1.)
-print('Attributes upated in %f seconds'%(fn.now()-t0))
+class _Proxy(object):
+    def read_attributes(self,names):
+        raise Exception('API_AttrNotFound: %s'%names[-1])
 
-def print_all():
-    for i,t in enumerate(sorted(cache.items())):
-        k,v = t
-        print('%s/%s: %s = %s'%(i,len(attrs),k,str(v)[:40]))
-        
-print_all()
+def test_poll_sources():
+    t = _thread()
+    sources = [_Source('a/b/c/%s'%n) for n in 'ab']
+    polled = []
+    for s in sources:
+        s.proxy,s.simple_name,s.tango_asynch = _Proxy(),s.full_name[-1],False
+        s.checkState = lambda state: False
+        s.poll = lambda value=None,s=s: polled.append((s,value))
+    check,fc.check_device_cached = fc.check_device_cached,lambda d: True
+    try:
+        # a failed bulk read is retried one by one
+        assert t.poll_sources(sources) == 2
+        assert polled == [(s,None) for s in sources], polled
+    finally:
+        fc.check_device_cached = check
+    return True
 
-print('%d attributes were not read'%(len(attrs)-len(cache)))
-print(sorted(a for a in attrs if a not in cache.keys()))
-print('%d Nones'%len([v for v in cache.values() if v is None]))
+def test_EventThread_pollings():
+    t = _thread()
+    a,b,c = [_Source('a/b/c/%s'%n) for n in 'abc']
+    t.schedule(a,30.)
+    t.schedule(b,10.)
+    t.schedule(c,20.)
+    t.schedule(a,5.) #replaces the previous entry
+    assert t.pop_due(1.) == []
+    assert t.pop_due(25.) == [a,b,c]
+    assert t.pop_due(100.) == [] and not t.next_due
+    return True
 
+def test_EventThread_registry():
+    t = _thread()
+    a,b = _Source('A/b/c/d'),_Source('a/b/c/e')
+    t.register(a)
+    t.register(b)
+    assert a.full_name == 'a/b/c/d' and t.has_source('A/B/C/D')
+    assert t.get_sources('a/b/c/d') == [a]
+    assert sorted(t.get_source_names('a/b/c/.*')) == ['a/b/c/d','a/b/c/e']
+    assert len(t.get_device_sources('A/B/C')) == 2
+    assert t.unregister(a) and not t.unregister(a)
+    assert not t.has_source('a/b/c/d') and 'a/b/c/d' not in t.names
+    assert t.get_device_sources('a/b/c') == [b]
+    assert t.pop_due(fn.now()+1) == [b]
+    t.unregister(b)
+    assert not t.sources and not t.names and not t.devices
+    return True
 
+def test_EventThread_profile():
+    t,s = _thread(),_Source('a/b/c/d')
+    t.register(s)
+    t.profiler.enabled = True
+    for i in range(10):
+        t.profile_event(s.full_name,('change',None),fn.now()-0.01,fn.now())
+    p = t.get_profile(['A/B/C/D','x/y/z/w'])
+    assert sorted(p) == [t.profile_key,'a/b/c/d']
+    assert p['a/b/c/d']['events'] == 10
+    assert p['a/b/c/d']['queue']['count'] == 10
+    assert p['a/b/c/d']['queue']['min'] > 9.
+    assert 'network' not in p['a/b/c/d'] #value without time
+    return True
+
+def test_get_thread():
+    threads,shards = fc.EventSource.THREADS,fc.EventSource.SHARDS
+    try:
+        fc.EventSource.THREADS,fc.EventSource.SHARDS = 3,[]
+        assert len(fc.EventSource.get_threads()) == 3
+        t = fc.EventSource.get_thread(device='A/B/C')
+        assert t is fc.EventSource.get_thread(device='a/b/c')
+        assert fc.EventSource.get_thread() is fc.EventSource.QUEUE
+    finally:
+        fc.EventSource.THREADS,fc.EventSource.SHARDS = threads,shards
+    return True
+
+def live_EventSource(pattern='bl00*eps*plc*01/*'):
+    """ 
+    Requires a running control system with matching attributes:
+      python ci/test/test_callbacks.py [attribute pattern]
+    """
+    attrs = map(str.lower,fn.get_matching_attributes(pattern))
+
+    a = 'bl00/ct/eps-plc-01/State'
+
+    t0 = fn.now()
+    sources = dict((d,fc.EventSource(d,asynchronous=True)) for d in sorted(attrs))
+
+    #sources.values()[10].read(synch=True)
+
+    cache = fn.CaselessDict()
+
+    def hook(src,t,value):
+        cache[src.normal_name]=(value)
+
+    el = fc.EventListener('A Queue for All')
+    el.set_value_hook(hook)
+    print('Subscribing %d attributes'%len(attrs))
+    [s.addListener(el) for k,s in sorted(sources.items())]
+    print('Subscription took %f seconds'%(fn.now()-t0))
+
+    t0 = fn.now()
+    print('Waiting ...')
+    while len(cache) < len(attrs):
+        if fn.now() > t0+18.:
+            break
+        fn.wait(1.)
+    print('Attributes upated in %f seconds'%(fn.now()-t0))
+
+    def print_all():
+        for i,t in enumerate(sorted(cache.items())):
+            k,v = t
+            print('%s/%s: %s = %s'%(i,len(attrs),k,str(v)[:40]))
+
+    print_all()
+
+    print('%d attributes were not read'%(len(attrs)-len(cache)))
+    print(sorted(a for a in attrs if a not in cache.keys()))
+    print('%d Nones'%len([v for v in cache.values() if v is None]))
+    return True
+
+def main(args=None):
+    args = args if args is not None else sys.argv[1:]
+    for f in globals().values():
+        if str(getattr(f,'__name__','')).startswith('test_'):
+            with _Tester(f.__name__) as t:
+                print(f())
+    if args:
+        with _Tester('live_EventSource') as t:
+            print(live_EventSource(*args))
+    return True
+
+if __name__ == '__main__':
+    main()
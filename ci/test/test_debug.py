@@ -0,0 +1,51 @@
+import fandango as fn
+from fandango.debug import Histogram, Profiler
+
+class _Tester(object):
+
+    def __init__(self,name):
+        self.name = name
+
+    def __enter__(self):
+        print('testing %s' % self.name)
+
+    def __exit__(self, et, ev, etb):
+        if et:
+            print('Failed!',etb)
+
+def test_Histogram():
+    h = Histogram()
+    values = [1e-3*i for i in range(1,1001)]
+    [h.add(v) for v in values]
+    assert h.count == 1000 and h.max == 1.
+    for q in (50,95,99):
+        assert abs(h.percentile(q)-q*1e-2)/(q*1e-2) < 0.05
+    assert h.percentile(100) == 1.
+    h.reset()
+    assert not h.count and h.percentile(99) == 0.
+    return True
+
+def test_Profiler():
+    p = Profiler()
+    p.add('A','eval',0.01)
+    p.count('A','cache_hit',3)
+    p.count('A','cache_miss')
+    r = p.report()
+    assert r['A']['eval']['count'] == 1
+    assert r['A']['cache_hit_rate'] == 0.75
+    assert '"A"' in p.to_json()
+    p.reset()
+    p.enabled = False
+    p.add('A','eval',0.01)
+    assert not p.report()
+    return True
+
+def main():
+    for f in globals().values():
+        if str(getattr(f,'__name__','')).startswith('test_'):
+            with _Tester(f.__name__) as t:
+                print(f())
+    return True
+
+if __name__ == '__main__':
+    main()
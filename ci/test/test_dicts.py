@@ -0,0 +1,79 @@
+import fandango as fn
+from fandango.dicts import DependencyGraph, DependencyCycle, LayeredDict
+
+class _Tester(object):
+
+    def __init__(self,name):
+        self.name = name
+
+    def __enter__(self):
+        print('testing %s' % self.name)
+
+    def __exit__(self, et, ev, etb):
+        if et:
+            print('Failed!',etb)
+
+def test_DependencyGraph():
+    g = DependencyGraph()
+    g.add('C',['A','B'])
+    g.add('D',['C'])
+    g.add('E',['A'])
+    order = g.order()
+    assert order.index('A') < order.index('C') < order.index('D')
+    assert g.plan('D') == ['A','B','C']
+    assert g.plan('A') == []
+    assert map(sorted,g.levels(['D','C','A','B','E'])) == [['A','B'],['C','E'],['D']]
+    assert sorted(g.mark_dirty('A')) == ['C','D','E']
+    assert g.is_dirty('D')
+    g.set_clean('D')
+    assert not g.is_dirty('D')
+    g.add('C',['B'])
+    assert g.plan('D') == ['B','C']
+    g.add('B',['D'])
+    assert not g.cycles
+    g.build()
+    assert g.cycles
+    try:
+        g.build(strict=True)
+        assert False, 'DependencyCycle not raised'
+    except DependencyCycle:
+        pass
+    return True
+
+def test_LayeredDict():
+    calls = []
+    ns = LayeredDict(A=1)
+    ns.set_lazy('ATTRIBUTES',lambda: calls.append(1) or ['A'])
+    ns.defaults['VALUE'] = None
+    assert eval('ATTRIBUTES',{},ns) == ['A']
+    assert eval('ATTRIBUTES+[VALUE]',{},ns) == ['A',None]
+    assert len(calls) == 1
+    ns.invalidate()
+    assert ns.get('ATTRIBUTES') == ['A'] and len(calls) == 2
+    ns.push({'VALUE':2})
+    ns.push(ATTRIBUTE='B')
+    assert eval('A+VALUE',{},ns) == 3
+    assert ns.in_frames('ATTRIBUTE') == ['B']
+    ns.pop()
+    ns.pop()
+    assert ns['VALUE'] is None and 'ATTRIBUTE' not in ns
+    # globals and builtins are returned, but not contained
+    ns.globals = {'G':3}
+    assert ns['G'] == 3 and ns['abs'] is abs and 'abs' not in ns
+    assert eval('abs(-G)',ns.globals,ns) == 3 and ns.get('G') is None
+    try:
+        eval('UNDEFINED',{},ns)
+        assert False, 'NameError not raised'
+    except NameError:
+        pass
+    return True
+
+def main():
+    for f in globals().values():
+        if str(getattr(f,'__name__','')).startswith('test_'):
+            with _Tester(f.__name__) as t:
+                print(f())
+    return True
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+import fandango as fn
+from fandango.dynamic import FormulaCompiler, DynamicDSAttrs, PropertySnapshot
+from fandango.dicts import DependencyGraph
+
+class _Tester(object):
+
+    def __init__(self,name):
+        self.name = name
+
+    def __enter__(self):
+        print('testing %s' % self.name)
+
+    def __exit__(self, et, ev, etb):
+        if et:
+            print('Failed!',etb)
+
+class _Slot(object):
+    def __init__(self,value):
+        self.value = value
+
+def test_FormulaCompiler():
+    ns = {'A':1,'B':None,'D':{},'XATTR':lambda m: 'namespace'}
+    slot = _Slot(5)
+    fc = FormulaCompiler(ns,{},slots={'B':slot},
+                         xattr=lambda m: (lambda: 42))
+    # folding
+    f = fc.compile('2*3+A')
+    assert f() == 7 and 6 in f.func_code.co_consts
+    ns['A'] = 2
+    assert f() == 8
+    # slots
+    f = fc.compile('B+1')
+    assert f() == 6
+    slot.value = 7
+    assert f() == 8
+    # XATTR handles
+    assert fc.compile("XATTR('a/b/c/d')+1")() == 43
+    assert fc.compile("XATTR(A)")() == 'namespace'
+    # not supported, eval() will be used
+    assert fc.compile('[x for x in range(A)]') is None
+    assert fc.compile('lambda: A') is None
+    # errors as in eval()
+    try:
+        fc.compile('C+1')()
+        assert False, 'NameError not raised'
+    except NameError:
+        pass
+    try:
+        fc.compile("D['x']")()
+        assert False, 'KeyError not raised'
+    except KeyError:
+        pass
+    return True
+
+def test_get_reload_affected():
+    formulas = {'X':'1','Y':'X*2','Z':'Y+1','W':'5','V':"ATTR('N')"}
+    graph = DependencyGraph({'Y':['X'],'Z':['Y']})
+    # X formula edited, its dependents must be reloaded too
+    affected = DynamicDSAttrs.get_reload_affected(graph,formulas,['X'])
+    assert sorted(affected) == ['X','Y','Z'], affected
+    # added names are searched in the formulas
+    affected = DynamicDSAttrs.get_reload_affected(graph,formulas,['N'],
+                                                  added=['N'])
+    assert sorted(affected) == ['N','V'], affected
+    return True
+
+class _FakeDb(object):
+    props = {'a/b/c':{'P':['1']},"a/b/it's":{'P':['2']}}
+    def __init__(self):
+        self.queries = []
+    def command_inout(self,cmd,q):
+        self.queries.append(q)
+        return [0,3],[]
+    def get_device_property_list(self,name,mask):
+        return list(self.props[name])
+    def get_device_property(self,name,props):
+        return self.props[name]
+
+def test_PropertySnapshot():
+    db = _FakeDb()
+    snap = PropertySnapshot(db)
+    # quoted names are not interpolated in the query, but read one by one
+    snap.load(devices=['a/b/c',"a/b/it's"])
+    assert len(db.queries) == 1 and "it" not in db.queries[0], db.queries
+    assert snap.get_device_property("a/b/it's",['P']) == {'P':['2']}
+    try:
+        snap.query('device',["x' or '1'='1"])
+        assert False, 'ValueError not raised'
+    except ValueError:
+        pass
+    return True
+
+def main():
+    for f in globals().values():
+        if str(getattr(f,'__name__','')).startswith('test_'):
+            with _Tester(f.__name__) as t:
+                print(f())
+    return True
+
+if __name__ == '__main__':
+    main()
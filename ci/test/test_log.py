@@ -0,0 +1,37 @@
+import fandango as fn
+from fandango.log import Logger, Lazy
+
+class _Tester(object):
+
+    def __init__(self,name):
+        self.name = name
+
+    def __enter__(self):
+        print('testing %s' % self.name)
+
+    def __exit__(self, et, ev, etb):
+        if et:
+            print('Failed!',etb)
+
+def test_Lazy():
+    calls = []
+    f = lambda: calls.append('f') or 'f'
+    log = Logger('test_Lazy',level='INFO')
+    log.info('function %s',f)
+    assert not calls, 'plain functions must not be called'
+    log.debug('lazy %s',Lazy(f))
+    assert not calls, 'Lazy called with level disabled'
+    log.info('lazy %s',Lazy(f))
+    assert calls == ['f']
+    assert Lazy(max,1,2)() == 2 and str(Lazy(max,1,2)) == '2'
+    return True
+
+def main():
+    for f in globals().values():
+        if str(getattr(f,'__name__','')).startswith('test_'):
+            with _Tester(f.__name__) as t:
+                print(f())
+    return True
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+import fandango as fn
+from fandango.threads import CoalescingQueue, ThreadPool
+import time
+
+class _Tester(object):
+
+    def __init__(self,name):
+        self.name = name
+
+    def __enter__(self):
+        print('testing %s' % self.name)
+
+    def __exit__(self, et, ev, etb):
+        if et:
+            print('Failed!',etb)
+
+def test_CoalescingQueue():
+    q = CoalescingQueue(maxsize=3,priorities=['state','status'])
+    q.put('A',1)
+    q.put('B',1)
+    q.put('A',2)
+    q.put('State',3)
+    assert q.qsize() == 3 and q.stats['coalesced'] == 1
+    q.put('C',4)
+    assert q.stats['dropped'] == 1
+    assert [q.get(),q.get(),q.get()] == [('State',3),('B',1),('C',4)]
+    try:
+        q.get()
+        assert False, 'Empty not raised'
+    except CoalescingQueue.Empty:
+        pass
+    # lower priority keys do not evict higher ones
+    q = CoalescingQueue(maxsize=1,priorities=['State'])
+    assert q.put('State',1) and not q.put('A',2)
+    assert q.put('Status',3) is False and q.get() == ('State',1)
+    q = CoalescingQueue(maxsize=1,policy='newest')
+    assert q.put('A',1) and not q.put('B',2)
+    assert q.get() == ('A',1) and q.empty()
+    return True
+
+def test_ThreadPool():
+    tp = ThreadPool(3)
+    t0 = time.time()
+    results = [tp.submit(time.sleep,.2) for i in range(3)]
+    [r.get(1.) for r in results]
+    assert time.time()-t0 < .5, 'tasks not executed in parallel'
+    try:
+        tp.submit(time.sleep,.5).get(.1)
+        assert False, 'TimeOut not raised'
+    except Exception,e:
+        assert 'TimeOut' in str(e)
+    try:
+        tp.submit(int,'x').get(1.)
+        assert False, 'ValueError not raised'
+    except ValueError:
+        pass
+    tp.stop()
+    return True
+
+def main():
+    for f in globals().values():
+        if str(getattr(f,'__name__','')).startswith('test_'):
+            with _Tester(f.__name__) as t:
+                print(f())
+    return True
+
+if __name__ == '__main__':
+    main()
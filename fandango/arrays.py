@@ -35,14 +35,14 @@
 ## along with this program; if not, see <http://www.gnu.org/licenses/>.
 ###########################################################################
 
-import csv,sys,re,operator,traceback
+import csv,sys,re,operator,traceback,array
 import functional as fun
 from fandango.log import printf
 from fandango.dicts import SortedDict
 try: import numpy as np
 except: np = None
 
-__all__ = ['Grid','CSVArray','tree2table']
+__all__ = ['Grid','CSVArray','tree2table','RingBuffer']
 
 #from excepts import *
 #from ExceptionWrapper import *
@@ -983,6 +983,88 @@ class DictFile(object):
 
 import time
 
+class RingBuffer(object):
+    """
+    A fixed size history of (time,value,quality) samples, once full each 
+    append overwrites the oldest one.
+    
+    If numeric is True, times, values and qualities are kept in 
+    array.array objects (8+8+1 bytes per sample); otherwise values are 
+    kept in a list. Qualities are stored as integers.
+    
+    rb = RingBuffer(3600)
+    rb.append(time.time(),value,quality)
+    rb.delta(60), rb.mean(60), rb.rate(60) #over the last 60 seconds
+    """
+    __slots__ = ('size','numeric','times','values','qualities',
+                 '_next','_count')
+    
+    def __init__(self,size,numeric=True):
+        self.size = int(size)
+        self.numeric = numeric
+        self.times = array.array('d',[0.])*self.size
+        self.values = (array.array('d',[0.])*self.size if numeric 
+                       else [None]*self.size)
+        self.qualities = array.array('b',[0])*self.size
+        self._next,self._count = 0,0
+        
+    def __len__(self):
+        return self._count
+    
+    def __repr__(self):
+        return 'RingBuffer(%d/%d)'%(self._count,self.size)
+        
+    def clear(self):
+        self._next,self._count = 0,0
+    
+    def append(self,t,value,quality=0):
+        i = self._next
+        self.values[i] = value
+        self.times[i] = t
+        self.qualities[i] = int(quality)
+        self._next = (i+1)%self.size
+        if self._count<self.size:
+            self._count += 1
+            
+    def indexes(self):
+        """ Buffer positions from oldest to newest """
+        start = (self._next-self._count)%self.size
+        return [(start+j)%self.size for j in range(self._count)]
+    
+    def items(self,window=None,now=None):
+        """ 
+        Returns (time,value,quality) tuples from oldest to newest;
+        if window is passed only samples of the last window seconds.
+        """
+        idx = self.indexes()
+        if window:
+            t0 = (now or time.time())-window
+            idx = [i for i in idx if self.times[i]>=t0]
+        return [(self.times[i],self.values[i],self.qualities[i]) 
+                for i in idx]
+    
+    def last(self):
+        if not self._count:
+            return None
+        i = (self._next-1)%self.size
+        return (self.times[i],self.values[i],self.qualities[i])
+    
+    def delta(self,window=None,now=None):
+        """ Difference between the newest and oldest value in window """
+        items = self.items(window,now)
+        return items[-1][1]-items[0][1] if items else None
+    
+    def mean(self,window=None,now=None):
+        items = self.items(window,now)
+        return sum(v for t,v,q in items)/float(len(items)) if items else None
+    
+    def rate(self,window=None,now=None):
+        """ Value change per second in window """
+        items = self.items(window,now)
+        if len(items)<2 or items[-1][0]==items[0][0]:
+            return None
+        return (items[-1][1]-items[0][1])/(items[-1][0]-items[0][0])
+
 class TimedQueue(list):
     """ 
     A FIFO that keeps all the values introduced at least for a given time.
@@ -41,7 +41,7 @@
 ## along with this program; if not, see <http://www.gnu.org/licenses/>.
 ###########################################################################
 """
-import sys,os,time,re
+import sys,os,time,re,heapq,itertools,zlib
 import threading,weakref,types
 from copy import *
 
@@ -52,7 +52,8 @@ from dicts import *
 from tango import PyTango,EventType,fakeAttributeValue,ProxiesDict
 from tango import get_full_name,get_attribute_events, check_device_cached
 from threads import ThreadedObject,timed_range,wait,threading
-from log import Logger,printf,tracer
+from log import Logger,Lazy,printf,tracer
+from debug import Profiler
 
 """
 @package callbacks
@@ -292,12 +293,36 @@ class EventThread(Logger,ThreadedObject):
     on each loop iteration for each source. 
     It can be set to False, True or a factor of latency.
     
+    Events queued for each source are passed through filter_events before
+    firing; rules are EVENT_FILTERS, updated by source.event_filters:
+    
+    - coalesce: keep only the latest event of each type (None = filtered)
+    - superseded: {type:types}, drop events of type followed by a later 
+      event of types; disabled by default, as listeners may not receive
+      all types (e.g. {'periodic':('change','archive')} drops PERIODIC 
+      events if a CHANGE or ARCHIVE event arrives later in the same cycle)
+      
+    Error events are never dropped; dropped events are counted in stats.
+    
+    If PROFILE is True (or setup(profile=True)), latency histograms are 
+    kept for the thread and each of its sources (see get_profile):
+    
+    - network: value timestamp to reception in push_event
+    - queue: reception to dispatch by this thread
+    - listeners: execution time of the listeners
+    
+    If profile_dump is a filename, get_profile() is written there as JSON 
+    every PROFILE_PERIOD seconds.
+    
     The latency (ms) specifies a time condition to abort event checking
     and proceed to callback execution.
     
     The real latency of the system is provided by inherited get_delay 
     and get_avg_delay methods
     
+    Polling and keep-alive reads are scheduled in a heap of 
+    (due_time,count,source) tuples; each cycle only the sources due are
+    checked, polled and inserted again (see schedule and pop_due).
     """
     
     MinWait = 0.01
@@ -309,30 +334,56 @@ class EventThread(Logger,ThreadedObject):
     #How many events to process before checking polled attributes
     SHOW_ALIVE = 10000
     #Will printout some logs every SHOW_ALIVE*period cycles
+    BULK_READS = True
+    #Attributes of the same device are polled with a single read_attributes
+    BULK_TIMEOUT = 3000
+    #Max time (ms) to wait for read_attributes_asynch replies
+    EVENT_FILTERS = {'coalesce':None,'superseded':{}}
+    #Default rules for filter_events, updated by source.event_filters
+    PROFILE = False
+    #Keep latency histograms, see get_profile
+    PROFILE_PERIOD = 60.
+    #Seconds between dumps of get_profile to profile_dump file
     
     def __init__(self,period_ms=None,filtered=False,latency=10.,
-                 delayed=False,loglevel='WARNING'):
+                 delayed=False,loglevel='WARNING',shard=0):
         """ 
         latency units are milliseconds 
+        shard is the index of this thread in EventSource.get_threads()
         """
         self.tinit = now()
         self.count = 0
+        self.shard = shard
+        self.stats = defaultdict(int)
         self.queue = Queue.Queue()
-        self.sources = set()
+        self.sources = {} #{source:full_name}, full names are lowercase
+        self.names = defaultdict(set) #{full_name:sources}
+        self.devices = defaultdict(set) #{device:sources}
+        self.pollings = [] #Heap of (due_time,count,source)
+        self.next_due = {} #{source:due_time}, older heap entries are ignored
+        self.pollings_lock = threading.Lock()
+        self.pollings_count = itertools.count()
         self.event = threading.Event()
         period = max((1e-3*(period_ms or self.DEFAULT_PERIOD_ms),self.MinWait))
         ThreadedObject.__init__(self,target=self.process,period=period)
-        Logger.__init__(self,type(self).__name__)
+        Logger.__init__(self,type(self).__name__+(
+                        '[%d]'%shard if shard else ''))
         self.filtered,self.latency = filtered,latency
         self.delayed = delayed #Do not poll in first cycle
         self.setLogLevel(loglevel)
+        self.profiler = Profiler(enabled=self.PROFILE)
+        self.profile_key = self.log_name
+        self.profile_dump,self.profile_dumped = None,now()
         
-    def setup(self,period_ms=None,filtered=None,latency=None,loglevel=None):
+    def setup(self,period_ms=None,filtered=None,latency=None,loglevel=None,
+              profile=None,profile_dump=None):
         """ 
         This method allows to reconfigure an already running EventThread 
         """
         self.filtered = notNone(filtered,self.filtered)
         self.latency = notNone(latency,self.latency)
+        self.profiler.enabled = notNone(profile,self.profiler.enabled)
+        self.profile_dump = notNone(profile_dump,self.profile_dump)
         if period_ms is not None:
           period = 1e-3*(period_ms or 0) or self.MinWait
           self.set_period(period)
@@ -360,11 +411,145 @@ class EventThread(Logger,ThreadedObject):
         if source in self.sources:
             self.debug('\t%s already registered'%source)
         else:
-            source.full_name = str(source.full_name).lower()
-            self.sources.add(source)
+            source.full_name = name = str(source.full_name).lower()
+            self.sources[source] = name
+            self.names[name].add(source)
+            self.devices[str(source.device).lower()].add(source)
             # sources to not be refreshed in the first keepalive cycle
             if self.delayed:
                 source.last_read_time = time.time()
+        # checked in the next cycle, new polling periods apply from there
+        self.schedule(source,now())
+        
+    def unregister(self,source):
+        """ Removes source from the registry and pollings schedule """
+        name = self.sources.pop(source,None)
+        if name is None:
+            return False
+        for index,key in ((self.names,name),
+                          (self.devices,str(source.device).lower())):
+            index[key].discard(source)
+            if not index[key]:
+                index.pop(key)
+        with self.pollings_lock:
+            self.next_due.pop(source,None) #heap entry will be discarded
+        return True
+        
+    def schedule(self,source,due=None):
+        """ 
+        Inserts the source in the pollings heap, due at the given time or 
+        at its next polling/keep-alive time (see get_next_due)
+        """
+        if due is None:
+            due = self.get_next_due(source)
+        with self.pollings_lock:
+            self.next_due[source] = due
+            heapq.heappush(self.pollings,
+                           (due,next(self.pollings_count),source))
+        return due
+    
+    def pop_due(self,t=None):
+        """ 
+        Removes from the heap and returns the sources due at t; 
+        entries replaced by a later call to schedule() are discarded
+        """
+        t,due = t or now(),[]
+        with self.pollings_lock:
+            while self.pollings and self.pollings[0][0] <= t:
+                nxt,i,source = heapq.heappop(self.pollings)
+                if self.next_due.get(source) == nxt:
+                    self.next_due.pop(source)
+                    due.append(source)
+        return due
+    
+    def get_next_due(self,source,alive=None):
+        """
+        Time of next polling of source; or next keep-alive read if 
+        polling is not enabled or the device is not alive
+        """
+        if alive is None:
+            alive = check_device_cached(source.device)
+        polled = alive and source.isPollingEnabled()
+        return source.last_read_time+1e-3*(
+            source.polling_period if polled else source.KeepAlive)
+            
+    def poll_sources(self,sources):
+        """
+        Polls the given sources; if BULK_READS is True, the attributes of a
+        device are read with a single read_attributes call (or 
+        read_attributes_asynch if all of them use tango_asynch, replies are 
+        collected after sending all requests).
+        
+        Each value (or error) is passed to the poll() method of its source;
+        if a bulk read fails (e.g. a single attribute not found fails the 
+        whole call) each source of the device reads its own value.
+        Returns the number of sources polled.
+        """
+        groups,single,requests = defaultdict(list),[],[]
+        for s in sources:
+            if (self.BULK_READS and getattr(s,'proxy',None) 
+                    and not s.checkState('SUBSCRIBING')):
+                groups[s.device.lower()].append(s)
+            else:
+                single.append(s)
+                
+        for device,group in sorted(groups.items()):
+            names,proxy = [s.simple_name for s in group],group[0].proxy
+            if len(group)==1:
+                single.extend(group)
+            elif not check_device_cached(group[0].device):
+                self.poll_values(group,Exception('EvS_CantConnectToDevice'))
+            elif all(s.tango_asynch for s in group):
+                try:
+                    requests.append(
+                        (group,proxy.read_attributes_asynch(names)))
+                except Exception,e:
+                    self.warning('%s.read_attributes_asynch failed, '
+                        'reading one by one: %s'%(device,e))
+                    self.poll_values(group)
+            else:
+                try:
+                    values = proxy.read_attributes(names)
+                except Exception,e:
+                    self.warning('%s.read_attributes failed, '
+                        'reading one by one: %s'%(device,e))
+                    values = None
+                self.poll_values(group,values)
+                
+        for group,request in requests:
+            try:
+                values = group[0].proxy.read_attributes_reply(
+                    request,int(self.BULK_TIMEOUT))
+            except Exception,e:
+                values = e
+                # a timeout is not retried, the device is not replying
+                if 'timeout' not in str(e).lower():
+                    self.warning('%s.read_attributes_reply failed, '
+                        'reading one by one: %s'%(group[0].device,e))
+                    values = None
+            self.poll_values(group,values)
+            
+        for s in single:
+            self.poll_values([s])
+        return len(sources)
+    
+    def poll_values(self,sources,values=None):
+        """ 
+        Calls poll() for each source passing its value, or the exception
+        if values is an exception; sources read their own value if None
+        """
+        for i,source in enumerate(sources):
+            try:
+                if values is None:
+                    source.poll()
+                else:
+                    source.poll(values if isinstance(values,Exception) 
+                                else values[i])
+            except:
+                traceback.print_exc()
+            finally:
+                source.last_read_time = now()
+        self.wait(self.MinWait/10.) #breathing
             
     def get_source_name(self,source): 
         if isString(source):
@@ -376,11 +561,20 @@ class EventThread(Logger,ThreadedObject):
       
     def has_source(self,source):
         if source in self.sources: return True
-        source = self.get_source_name(source)
-        return [s.full_name == source for s in self.sources]
+        return self.get_source_name(source) in self.names
       
     def get_sources(self,source='.*'):
+        """ 
+        Returns the sources registered with the given full name;
+        if there's none, source is matched as a regular expression
+        """
+        name = self.get_source_name(source)
+        if name in self.names:
+            return list(self.names[name])
         return [s for s in self.sources if clmatch(source,s.full_name)]
+    
+    def get_device_sources(self,device):
+        return list(self.devices.get(str(device).lower(),()))
       
     def get_source_names(self,source='.*'):
         return sorted(set(s.full_name for s in self.get_sources(source)))
@@ -390,6 +584,128 @@ class EventThread(Logger,ThreadedObject):
       
     def get_pending(self):
         return self.queue.qsize()
+    
+    def get_load(self):
+        """ Returns a dictionary with the load statistics of this thread """
+        elapsed = (now()-self.tinit) or 1.
+        return {
+            'shard':self.shard,
+            'sources':len(self.sources),
+            'pending':self.get_pending(),
+            'scheduled':len(self.next_due),
+            'events':self.stats['events'],
+            'polls':self.stats['polls'],
+            'coalesced':self.stats['coalesced'],
+            'superseded':self.stats['superseded'],
+            'events_per_second':self.stats['events']/elapsed,
+            'cycles':self.count,
+            'usage':self.get_usage(),
+            'avg_delay':self.get_avg_delay(),
+            }
+
+    def get_filters(self,source):
+        """ Returns EVENT_FILTERS updated with source.event_filters """
+        rules = getattr(source,'event_filters',None)
+        if not rules:
+            return self.EVENT_FILTERS
+        filters = dict(self.EVENT_FILTERS)
+        filters.update(rules)
+        return filters
+    
+    @staticmethod
+    def is_error(value):
+        """ True for exceptions, DevError and failed attribute values """
+        return (isinstance(value,Exception) or hasattr(value,'reason')
+                or getattr(value,'has_failed',False) is True)
+    
+    def filter_events(self,events,filtered=False):
+        """
+        Applies the rules of get_filters to a list of (source,args) events
+        queued for the same source, returning the events to be fired 
+        (in arrival order). args are (event_type,value).
+        
+        Events of each type are checked from latest to oldest, so an event
+        is dropped only if a later one makes it redundant.
+        """
+        if len(events)<2:
+            return events
+        rules = self.get_filters(events[-1][0])
+        coalesce = notNone(rules.get('coalesce'),filtered)
+        superseded = rules.get('superseded') or {}
+        kept,seen,dropped = [],set(),defaultdict(int)
+        for e in reversed(events):
+            args = e[1]
+            if len(args)<2 or self.is_error(args[1]):
+                kept.append(e)
+                continue
+            type_ = str(args[0]).lower().replace('_event','')
+            if coalesce and type_ in seen:
+                dropped['coalesced'] += 1
+            elif any(t in seen for t in superseded.get(type_,())):
+                dropped['superseded'] += 1
+            else:
+                seen.add(type_)
+                kept.append(e)
+        for k,v in dropped.items():
+            self.stats[k] += v
+            source = events[-1][0]
+            if hasattr(source,'stats'):
+                source.stats[k] += v
+            self.profiler.count(self.get_source_name(source),k,v)
+        kept.reverse()
+        return kept
+
+    def profile_event(self,name,args,received,dispatched):
+        """ 
+        Adds the latencies of an event fired at dispatched time to the 
+        histograms of the thread and the source name
+        """
+        t,p = now(),self.profiler
+        vtime = ctime2time(getattr(args[1],'time',None)) if (
+                           len(args)>1) else -1
+        for key in (self.profile_key,name):
+            p.count(key,'events')
+            if received:
+                if vtime > 0:
+                    p.add(key,'network',received-vtime)
+                p.add(key,'queue',dispatched-received)
+            p.add(key,'listeners',t-dispatched)
+    
+    def get_profile(self,sources=None):
+        """
+        Returns {name:{metric:stats,counter:value}} for this thread and 
+        its sources (or the given source names); stats are in ms (see 
+        fandango.debug.Histogram), events_per_second is added to each name.
+        """
+        p = self.profiler
+        if sources is None:
+            keys = p.keys()
+        else:
+            keys = [self.profile_key]+[n for n in map(self.get_source_name,
+                                       toList(sources)) if n in self.names]
+        report = p.report(keys)
+        elapsed = (now()-p.started) or 1.
+        report.setdefault(self.profile_key,{}).update(
+            (k,self.stats[k]) for k in ('polls','coalesced','superseded'))
+        report[self.profile_key]['received'] = self.stats['events']
+        for k,d in report.items():
+            d['events_per_second'] = d.get('events',0)/elapsed
+        return report
+    
+    def dump_profile(self,filename=None):
+        """ Writes get_profile() as JSON into filename or profile_dump """
+        import json
+        filename = filename or self.profile_dump
+        self.profile_dumped = now()
+        data = json.dumps({'thread':self.profile_key,
+            'time':self.profile_dumped,'profile':self.get_profile()},
+            sort_keys=True)
+        try:
+            with open(filename,'w') as f:
+                f.write(data)
+        except Exception,e:
+            self.warning('dump_profile(%s) failed: %s'%(filename,e))
+        return data
 
     def process(self):
         """ 
@@ -397,8 +713,9 @@ class EventThread(Logger,ThreadedObject):
         each time as max.
         """
         WAS_EMPTY = False
-        queue = CaselessSortedDict()
-        t0,evs,polls = now(),0,0
+        queue = {}
+        t00 = t0 = now()
+        evs,polls = 0,0
         filtered = self.filtered >= True
         lg = (partial(tracer,obj=self) if not self.count%self.SHOW_ALIVE 
                       else self.debug)
@@ -414,10 +731,14 @@ class EventThread(Logger,ThreadedObject):
                     source,args = data[0],data[1:]
                 else: 
                     source,args = data,[]
-                name = self.get_source_name(source)
-                if not self.has_source(name): self.register(source)
-                if name not in queue: queue[name] = []
-                queue[name].append((source,args))
+                # (source,type,value,reception time) from push_event
+                received,args = (args[2],args[:2]) if len(args)>2 else (
+                                 None,args)
+                name = self.sources.get(source)
+                if name is None:
+                    if hasattr(source,'full_name'): self.register(source)
+                    name = self.get_source_name(source)
+                queue.setdefault(name,[]).append((source,args,received))
 
             except Queue.Empty,e:
                 WAS_EMPTY = True
@@ -441,68 +762,71 @@ class EventThread(Logger,ThreadedObject):
         #Sequential execution of events received is relatively guaranteed
         if queue:
             self.debug('Process %d events received ...'%(len(queue)))        
+        if not WAS_EMPTY and self.get_pending():
+            self.warning('%d events still in queue'%self.get_pending())
         for s,events in sorted(queue.items()):
-            #@TODO: Event Filters should be implemented here 
-            #including removal of PERIODIC events if a change event is queued
-            if filtered:
-                events = events[-1:]
+            if filtered: #propagate kept events to all sources queued
+                targets = list(set(e[0] for e in events))
+            events = self.filter_events(events,filtered)
             while events:
                 try:
                     e = events.pop(0)
-                    source,args = e
-                    if filtered: #propagate last event to all sources
-                      sources = self.get_sources(self.get_source_name(s))
+                    source,args,received = e
+                    if filtered:
+                      sources = targets
                     else:
                       sources = [source] #each source should push its own events
                     for source in sources:
-                      if True:
-                        # Update timestamp also for errors 
-                        # not filtered in push_event
-                        source.last_read_time = now()
-                          
+                      # Update timestamp also for errors 
+                      # not filtered in push_event
+                      source.last_read_time = t1 = now()
                       self.fireEvent(source,*args)
+                      if self.profiler.enabled:
+                        self.profile_event(s,args,received,t1)
                       self.wait(self.MinWait/10.) #breathing
                 except:
                     self.error('%s:%s\n%s'%(s,e,traceback.format_exc()))
 
         self.wait(0) #breathing
        
-        #Process pollings and keep alive
-        t0 = now()
-        pollings = []
-        for s in self.sources.copy():
-            s.checkEvents(tdiff=2e-3*s.polling_period)
-            if s.getMode():
-                alive = check_device_cached(s.device)
-                polled = s.isPollingEnabled()
-                if not alive and s.last_read_time < t0-s.KeepAlive:
-                    self.debug('%s is not alive, last read was at %s'
-                               %(s.device,time2str(s.last_read_time)))
-                polled = alive and polled
-                nxt = s.last_read_time+1e-3*(
-                    s.polling_period if polled else s.KeepAlive)
-                pollings.append((nxt,s))
-            
-        for nxt,source in reversed(sorted(pollings)):
-            if t0 > nxt and (s.isPollingActive() or WAS_EMPTY):
-                self.debug('Executing pollings (%d/%d/%d)'
-                           %(polls,len(pollings),len(self.sources)))
-                try:
-                  if WAS_EMPTY: 
-                    lg('KeepAlive(%s) after %s ms'%(
+        #Process pollings and keep alive, only for the sources due
+        t0,polled = now(),[]
+        for source in self.pop_due(t0):
+            due = t0+1e-3*source.KeepAlive
+            try:
+                source.checkEvents(tdiff=2e-3*source.polling_period)
+                if source.getMode():
+                    alive = check_device_cached(source.device)
+                    if not alive and (source.last_read_time < 
+                                      t0-1e-3*source.KeepAlive):
+                        self.debug('%s is not alive, last read was at %s'
+                            %(source.device,time2str(source.last_read_time)))
+                    due = self.get_next_due(source,alive)
+                    if t0 > due and (source.isPollingActive() or WAS_EMPTY):
+                        if WAS_EMPTY: 
+                            lg('KeepAlive(%s) after %s ms'%(
                                 source.full_name,source.KeepAlive))
-                  #poll->read->fireEvent
-                  source.poll() 
-                  polls+=1
-                except:
-                  traceback.print_exc()
-                  if WAS_EMPTY: break
-                finally:
-                  source.last_read_time = now()
-            self.wait(self.MinWait/10.) #breathing
+                        polled.append((source,alive))
+                        continue #scheduled after polling
+                    elif t0 > due:
+                        # keep-alive delayed while events are queued
+                        due = t0+self.get_period()
+            except:
+                traceback.print_exc()
+            self.schedule(source,due)
+            
+        if polled:
+            self.debug('Executing pollings (%d/%d/%d)'
+                %(len(polled),len(self.pollings),len(self.sources)))
+            #poll->read->fireEvent
+            try:
+                polls += self.poll_sources([p[0] for p in polled])
+            finally:
+                for source,alive in polled:
+                    self.schedule(source,self.get_next_due(source,alive))
                 
-        asynch_hw = [s[1] for s in pollings 
-                     if getattr(s,'pending_request',None) is not None]
+        asynch_hw = [p[0] for p in polled 
+                     if getattr(p[0],'pending_request',None) is not None]
         if asynch_hw: self.warning('Check pending HW asynch requests')
         for source in randomize(asynch_hw):
             try: 
@@ -515,11 +839,19 @@ class EventThread(Logger,ThreadedObject):
           
         self.wait(0)
         if evs or polls: lg('Processed %d events, %d pollings'%(evs,polls))
-        notupdated = [s for s in self.sources if not s.stats['fired']]
-        if notupdated:
-            self.info('%d/%d sources not updated yet'%(
-                len(notupdated),
-                len(self.sources)))
+        self.stats['events'] += evs
+        self.stats['polls'] += polls
+        if self.profiler.enabled:
+            self.profiler.add(self.profile_key,'cycle',now()-t00)
+            if (self.profile_dump and 
+                    now() > self.profile_dumped+self.PROFILE_PERIOD):
+                self.dump_profile()
+        if not self.count%self.SHOW_ALIVE:
+            notupdated = [s for s in self.sources if not s.stats['fired']]
+            if notupdated:
+                self.info('%d/%d sources not updated yet'%(
+                    len(notupdated),
+                    len(self.sources)))
 
         self.count += 1
         return
@@ -572,11 +904,16 @@ class EventSource(Logger,SingletonMap):
     - tango_asynch = True/False ; to use asynchronous Tango reading
     - listeners = a list of listeners to be added at startup
     - persistent = if True, a dummy listener is added to enforce subscription  
+    - event_filters = a dict updating EventThread.EVENT_FILTERS rules for
+      this source, e.g. {'coalesce':True,
+                         'superseded':{'periodic':('change','archive')}}
     
     Class Parameters are:
     - EventSource.EVENT_TIMEOUT=900
     - EventSource.DefaultPolling = 3000.
     - EventSource.KeepAlive = 15000.    
+    - EventSource.THREADS = 1, number of EventThread shards; sources are
+      assigned to shards by device name (see get_threads_load())
     
     Documentation at doc/recipes/EventsAndCallbacks.rst
     
@@ -611,6 +948,8 @@ class EventSource(Logger,SingletonMap):
     VALUE_EVENTS = ['periodic','change','archive','quality','user_event']
     TAURUS_EVENTS = ['change','attr_conf']
     QUEUE = None
+    THREADS = 1 #Number of EventThread shards, see get_threads()
+    SHARDS = []
     DefaultPolling = 3000.
     KeepAlive = 15000.
     INSTANCES = []
@@ -669,10 +1008,12 @@ class EventSource(Logger,SingletonMap):
             '%s: A valid and existing device is needed'%(name)
         
         self.listeners = defaultdict(set) #[]    
+        self.dispatch = {} #{EventType:[(weakref,callback)]}, see fireEvent
         self._hard_refs = [] #Needed to keep instance method refs @TODO
         self.event_ids = dict() # An {EventType:ID} dict      
         self.state = self.STATES.UNSUBSCRIBED
         self.tango_asynch = kw.get('tango_asynch',False)
+        self.event_filters = kw.get('event_filters',None)
         self.write_with_read = kw.get('write_with_read',False)        
         
         ## Set polling configuration
@@ -737,6 +1078,8 @@ class EventSource(Logger,SingletonMap):
           self.deactivatePolling()
         if self.checkState('SUBSCRIBED','PENDING'):
           self.unsubscribeEvents()
+        if EventSource.SHARDS:
+          self.get_thread(device=self.device).unregister(self)
           
     def resetStats(self):
         t0 = now()
@@ -745,20 +1088,61 @@ class EventSource(Logger,SingletonMap):
         return t0
         
     @staticmethod
-    def get_thread(period_ms=None):
+    def get_threads():
+        """
+        Returns the EventThread shards, created at first call; its number
+        is set by EventSource.THREADS (to be modified before creating any 
+        EventSource). The first one is also EventSource.QUEUE.
+        """
+        if not EventSource.SHARDS:
+            if EventSource.QUEUE is None:
+                EventSource.QUEUE = EventThread()
+            EventSource.SHARDS = [EventSource.QUEUE]+[EventThread(shard=i)
+                for i in range(1,max((1,int(EventSource.THREADS))))]
+        return EventSource.SHARDS
+    
+    @staticmethod
+    def get_thread(period_ms=None,device=None):
+        """
+        It returns the EventThread INSTANCE processing the device sources,
+        assigned by a hash of the device name; the first one if device is 
+        None. All events of a source are processed in the same thread.
+        
+        Use EventSource.get_thread().setup(...) to configure it,
+        or [t.setup(...) for t in EventSource.get_threads()] if sharded
         """
-        It returns the current EventThread INSTANCE
-        Use EventSource.get_thread().setup(...) to configure it
+        threads = EventSource.get_threads()
+        if device is None or len(threads)==1:
+            return threads[0]
+        shard = (zlib.crc32(str(device).lower()) & 0xffffffff)%len(threads)
+        return threads[shard]
+    
+    @staticmethod
+    def get_threads_load():
+        """ Returns the EventThread.get_load() dictionary of each shard """
+        return [t.get_load() for t in EventSource.get_threads()]
+    
+    @staticmethod
+    def get_threads_profile(sources=None):
+        """ 
+        Returns the EventThread.get_profile() of all shards merged
+        (profiling is enabled with t.setup(profile=True) on each thread)
         """
-        if EventSource.QUEUE is None:
-            EventSource.QUEUE = EventThread()
-        return EventSource.QUEUE
+        profile = {}
+        for t in EventSource.get_threads():
+            profile.update(t.get_profile(sources))
+        return profile
+    
+    def get_profile(self):
+        """ Returns the latency stats and counters of this source """
+        return self.get_thread(device=self.device).get_profile(
+            [self.full_name]).get(self.full_name.lower(),{})
     
     @staticmethod
     def start_thread():
-        th = EventSource.get_thread()
-        if not th.get_started():
-            th.start()
+        for th in EventSource.get_threads():
+            if not th.get_started():
+                th.start()
             
     def setState(self,state):
         try:
@@ -825,7 +1209,7 @@ class EventSource(Logger,SingletonMap):
                       %(self.forced,self.polling_period))
 
             self.resetStats()
-            self.get_thread().register(self)
+            self.get_thread(device=self.device).register(self)
         except:
             self.warning('activatePolling() failed!: %s'%
               traceback.format_exc())
@@ -860,8 +1244,49 @@ class EventSource(Logger,SingletonMap):
         try:
             self.debug('_listenerDied(%s)!' % str(weak_listener))
             self.listeners.pop(weak_listener)
+            self.update_dispatch()
         except Exception, e:
             pass
+            
+    @staticmethod
+    def get_listener_callback(listener):
+        """
+        Returns a callback(listener,source,event_type,event_value) for the 
+        method implemented by the listener (eventReceived, event_received, 
+        push_event) or the listener itself if callable; None otherwise.
+        
+        The bound method is got from the listener at each call (instead of
+        keeping it in the table) to not keep a hard reference to it.
+        """
+        for m in ('eventReceived','event_received'):
+            if hasattr(listener,m):
+                return lambda l,s,t,v,m=m: getattr(l,m)(s,t,v)
+        if hasattr(listener,'push_event'):
+            return lambda l,s,t,v: l.push_event(taurusevent2tango(s,t,v))
+        if isCallable(listener):
+            return lambda l,s,t,v: l(s,t,v)
+        return None
+    
+    def update_dispatch(self):
+        """
+        Rebuilds the {EventType:[(weakref,callback)]} table used by 
+        fireEvent from self.listeners; called when adding/removing listeners.
+        Periodic events (e.g. poll() values) are sent to all listeners.
+        """
+        dispatch,periodic = defaultdict(list),EVENT_TYPES['periodic']
+        for weak,evs in self.listeners.items():
+            listener = weak()
+            callback = self.get_listener_callback(listener)
+            if callback is None:
+                if listener is not None:
+                    self.warning('unknown type listener: %s' % listener)
+                continue
+            evtypes = set(EVENT_TYPES[e] for e in evs if e in EVENT_TYPES)
+            evtypes.add(periodic)
+            for e in evtypes:
+                dispatch[e].append((weak,callback))
+        self.dispatch = dict(dispatch)
+        return self.dispatch
 
     def addListener(self, listener,use_events=True,use_polling=False):
         """
@@ -885,7 +1310,7 @@ class EventSource(Logger,SingletonMap):
         if isNumber(use_polling): 
             self.changePollingPeriod(use_polling)
         
-        self.get_thread().register(self)
+        self.get_thread(device=self.device).register(self)
         if use_events:
             #If state is UNSUBSCRIBED, event subscription will be delayed
             self.subscribeEvents(types=use_events,
@@ -906,6 +1331,7 @@ class EventSource(Logger,SingletonMap):
             self.listeners[weak] = set()
         for e in use_events:
             self.listeners[weak].add(e)
+        self.update_dispatch()
 
         self.debug('addListener(%s): %d listeners registered'  
                    % (listener,len(self.listeners)))
@@ -942,6 +1368,8 @@ class EventSource(Logger,SingletonMap):
             self.listeners.pop(listener)
         except Exception, e:
             return False
+        finally:
+            self.update_dispatch()
             
         if not self.listeners:
             self.unsubscribeEvents()
@@ -958,51 +1386,29 @@ class EventSource(Logger,SingletonMap):
     def fireEvent(self, event_type, event_value, listeners=None):
         """
         sends an event to all listeners or a specific one
-        event type filtering is done here
-        poll() events will be allowed to pass through
+        event type filtering is done in update_dispatch, 
+        poll() events (periodic) will be allowed to pass through
         """
-        self.debug('fireEvent()')
-        pending = self.get_thread().get_pending()
-        if pending:
-          self.warning('fireEvent(%s), %d events still in queue'%
-                       (event_type,pending))
         self.stats['fired']+=1
-
-        listeners = listeners or self.listeners.keys()
-        self.debug('fireEvent(): %d/%d listeners' 
-                   % (len(listeners),len(self.listeners)))
-        for l in listeners:
+        targets = self.dispatch.get(EVENT_TYPES.get(event_type),())
+        if listeners:
+            listeners = [l if isinstance(l,weakref.ref) else weakref.ref(l)
+                         for l in toList(listeners)]
+            targets = [t for t in targets if t[0] in listeners]
+
+        for weak,callback in targets:
+            l = weak()
+            if l is None: 
+                continue #removed by _listenerDied
             try:
-                #event filter will allow poll() events to pass through
-                evtype = EVENT_TYPES[event_type]
-                evlist = [EVENT_TYPES[e] for e in self.listeners.get(l,[])]
-                if (evtype not in ('periodic',EventType.PERIODIC_EVENT) 
-                  and evtype not in evlist):
-                    self.debug('%s event discarded (not in %s - %s)'
-                      %(event_type,self.listeners[l],self.use_events))
-                    continue
-                if isinstance(l, weakref.ref):
-                    l = l()
-                self.debug('fireEvent(%s) => %s?' % (event_type,l))
-                if hasattr(l,'eventReceived'):
-                    l.eventReceived(self, event_type, event_value)
-                elif hasattr(l,'event_received'):
-                    l.event_received(self, event_type, event_value)
-                elif hasattr(l,'push_event'):
-                    ev = taurusevent2tango(self, event_type, event_value)
-                    l.push_event(ev)
-                elif isCallable(l):
-                    l(self, event_type, event_value)
-                else:
-                    self.warning('unknown type listener: %s' % (l))
+                callback(l, self, event_type, event_value)
             except:
                 traceback.print_exc()
-        try:
-            vtime = ctime2time(getattr(event_value,'time',None))
+                
+        vtime = ctime2time(getattr(event_value,'time',None))
+        if vtime > 0:
             self.stats['acc_latency']+=now()-vtime
             self.stats['latency']=self.stats['acc_latency']/self.stats['fired']
-        except: 
-            pass
                 
     # TANGO RELATED METHODS               
     
@@ -1055,7 +1461,7 @@ class EventSource(Logger,SingletonMap):
                 pass 
           
           #self.start_thread() #DONT DO THIS WITHIN THE LOOP HOOK!
-          self.get_thread().register(self)
+          self.get_thread(device=self.device).register(self)
 
         except:
           self.error('subscribeEvents(): \n'+traceback.format_exc())
@@ -1165,23 +1571,28 @@ class EventSource(Logger,SingletonMap):
         if with_read:
             return self.read(cache=False)
 
-    def read(self, cache=None,asynch=None,_raise=True):
+    def read(self, cache=None,asynch=None,_raise=True,value=None):
         """ 
         Read last value acquired, 
         if cache = False or not polled it will trigger
         a proxy.read_attribute() call.
 
         If asynch=True/False, self.tango_asynch will be overriden for this call.
+        
+        If value is passed (a DeviceAttribute or Exception already read by
+        EventThread) it is processed as a hardware reading.
         """
         #self.debug('read(cache=%s,asynch=%s)'%(cache,asynch))
         asynch = notNone(asynch,self.tango_asynch)
         t0 = now()
+        if value is not None:
+            cache = False
 
         # If it was just updated, return cache
         if cache is None:
             vtime = ctime2time(getattr(self.attr_value,'time',None))
             if vtime>t0: vtime = t0 #correct "future" data
-            self.debug(str([t0,vtime,self.keep_time*1e-3]))
+            self.debug('%s',[t0,vtime,self.keep_time*1e-3])
             if self.fake or (t0 < (vtime + self.keep_time*1e-3)):
                 cache = True
             # If not polled, force HW reading
@@ -1189,8 +1600,9 @@ class EventSource(Logger,SingletonMap):
                 cache = False
             else:
                 cache = True
-        self.debug('read(cache=%s,asynch=%s,threaded=%s)'
-           %(cache,asynch,self.get_thread().is_alive()))
+        self.debug('read(cache=%s,asynch=%s,threaded=%s)',
+           cache,asynch,
+           Lazy(lambda:self.get_thread(device=self.device).is_alive()))
         self.asynch_hook() # Check for pending asynchronous results
         if not cache or self.attr_value is None:
             if self.checkState('SUBSCRIBED') and not self.last_event:
@@ -1198,7 +1610,7 @@ class EventSource(Logger,SingletonMap):
                 self.info('Attribute subscribed but no events received yet!!')
             self.stats['read']+=1
             self.last_read_time = t0
-            self.read_hw(asynch=asynch)
+            self.read_hw(asynch=asynch,value=value)
             
             if self.attr_value is not None: 
                 #if None, asynch has not been read yet
@@ -1208,16 +1620,23 @@ class EventSource(Logger,SingletonMap):
         else:
             return self.attr_value
         
-    def read_hw(self,asynch=False):
-        self.debug('read_hw(asynch=%s,\n\tpending=%s)'
-                          %(asynch,self.pending_request))
+    def read_hw(self,asynch=False,value=None):
+        self.debug('read_hw(asynch=%s,\n\tpending=%s)',
+                          asynch,self.pending_request)
         try:
             ## Do not merge these IF's, order matters
             #self.debug('read(): cache : %s'%shortstr(self.attr_value))
-            if not check_device_cached(self.device):
+            if value is not None:
+                # already read by EventThread.poll_sources
+                if getattr(value,'has_failed',False):
+                    value = PyTango.DevFailed(*value.get_err_stack())
+                if isinstance(value,Exception):
+                    raise value
+                self.attr_value = value
+            elif not check_device_cached(self.device):
                 self.warning('read_hw(): %s not running!'%self.device)
                 raise Exception('EvS_CantConnectToDevice')
-            if asynch:
+            elif asynch:
                 if self.pending_request is not None:
                     #self.debug('read(): pending_request ...')
                     self.attr_value = notNone(self.asynch_hook(),
@@ -1232,9 +1651,9 @@ class EventSource(Logger,SingletonMap):
             else:
                 #self.debug('read(): not asynch')
                 self.attr_value = self.proxy.read_attribute(self.simple_name)
-                self.debug('read_hw(asynch=False):\n\tvalue:%s\n\tdata:%s'
-                    %(getattr(self.attr_value,'value','null'),
-                        shortstr(self.attr_value,256)))
+                self.debug('read_hw(asynch=False):\n\tvalue:%s\n\tdata:%s',
+                    Lazy(getattr,self.attr_value,'value','null'),
+                    Lazy(shortstr,self.attr_value,256))
                     
             #Correct wrong timestamps
             try:
@@ -1288,20 +1707,24 @@ class EventSource(Logger,SingletonMap):
         try: return v.value
         except: return v
 
-    def poll(self):
+    def poll(self,value=None):
+        """ 
+        Reads the attribute (triggering fireEvent) and checks events; 
+        value is passed to read() if already read by EventThread
+        """
         t0 = now()
         #self.logPrint('DEBUG','\n\n',False)
-        self.debug('poll(+%s): %s'%(t0-self.last_read_time,self.stats['poll']))
+        self.debug('poll(+%s): %s',t0-self.last_read_time,self.stats['poll'])
         self.stats['poll']+=1
         if self.checkState('SUBSCRIBING'):
             ## While subscribing, polling is ignored and resumed on SUBSCRIBED/PENDING state
-            self.get_thread().lasts[self.full_name] = self.last_read_time = t0
+            self.last_read_time = t0
             return
         
         try:
             prev = getattr(self.attr_value,'value',None) #None in case of error
             ## The read() call will trigger a fireEvent()
-            self.attr_value = self.read(cache=False) 
+            self.attr_value = self.read(cache=False,value=value) 
             #(self.attr_value is not None))
             av = getattr(self.attr_value,'value',self.attr_value)
             diff = prev != av
@@ -1337,7 +1760,7 @@ class EventSource(Logger,SingletonMap):
                 value = event.errors[0]
                 reason = event.errors[0].reason
                 (self.info if (self.last_event_time < time.time()-5*self.KeepAlive) else self.debug)(
-                  'push_event(%s,err=%s,has_events=%s,polled=%s)'%(type_,reason,has_evs,is_polled))
+                  'push_event(%s,err=%s,has_events=%s,polled=%s)',type_,reason,has_evs,is_polled)
                 
                 if reason == 'API_EventPropertiesNotSet' and self.isUsingEvents():
                     #Nothing to do, other event types are already subscribed
@@ -1373,7 +1796,7 @@ class EventSource(Logger,SingletonMap):
             
             elif isinstance(event,PyTango.AttrConfEventData):
                 # MANAGING CONF EVENTS
-                self.debug('push_event(%s)'%str(type_))
+                self.debug('push_event(%s)',type_)
                 value = event.attr_conf
                 self.decodeAttrInfoEx(value)
                 #(Taurus sends here a read cache=False instead of AttrConf)
@@ -1381,7 +1804,7 @@ class EventSource(Logger,SingletonMap):
             else:
                 # MANAGING VALUE EVENTS
                 (self.debug if self.last_event.get(type_,None) else self.info)(
-                  'push_event(%s,err=%s,has_events=%s)'%(type_,event.err,self.isUsingEvents()))
+                  'push_event(%s,err=%s,has_events=%s)',type_,event.err,self.isUsingEvents())
                 
                 self.setState('SUBSCRIBED')
                 try:
@@ -1407,7 +1830,7 @@ class EventSource(Logger,SingletonMap):
             self.last_event[type_] = event
 
             #Instead of firingEvent, I return and pass the value to the queue
-            self.get_thread().put((self,type_,value))
+            self.get_thread(device=self.device).put((self,type_,value,t0))
         except:
             self.error(type(event),dir(event))
             traceback.print_exc()
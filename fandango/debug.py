@@ -75,6 +75,139 @@ def test_xtreme(device,attribute,value):
         PyTango.DeviceProxy(dp.adm_name()).command_inout('kill')
     return
        
+class Histogram(object):
+    """
+    Log-linear histogram (HDR-like) for latency values, in seconds.
+    
+    Values are counted in buckets whose width grows with the value,
+    keeping a relative error below 1/2**(precision-1) for any magnitude;
+    memory is bounded by the range of values, not by the number of samples.
+    
+    h = Histogram()
+    [h.add(t) for t in times]
+    h.percentile(99), h.stats()
+    """
+    
+    def __init__(self,precision=5,unit=1e-6):
+        self.precision = precision
+        self.unit = unit
+        self.reset()
+        
+    def reset(self):
+        self.counts = {}
+        self.count = 0
+        self.total = 0.
+        self.min = None
+        self.max = 0.
+        
+    def index(self,v):
+        """ bucket index for an integer value """
+        p = self.precision
+        if v < (1<<p):
+            return v
+        e = v.bit_length()-p
+        return (e<<(p-1)) + (v>>e)
+    
+    def upper(self,i):
+        """ highest integer value counted in bucket i """
+        p = self.precision
+        if i < (1<<p):
+            return i
+        e = (i>>(p-1))-1
+        m = i-(e<<(p-1))
+        return ((m+1)<<e)-1
+    
+    def add(self,value,count=1):
+        i = self.index(max(0,int(value/self.unit)))
+        self.counts[i] = self.counts.get(i,0)+count
+        self.count += count
+        self.total += value*count
+        if self.min is None or value<self.min: self.min = value
+        if value>self.max: self.max = value
+        
+    def percentile(self,q):
+        """ returns the value (seconds) below which q% of samples are """
+        if not self.count:
+            return 0.
+        target,acc = self.count*q/100.,0
+        for i in sorted(self.counts):
+            acc += self.counts[i]
+            if acc>=target:
+                return min(self.max,(self.upper(i)+1)*self.unit)
+        return self.max
+    
+    def mean(self):
+        return self.total/self.count if self.count else 0.
+    
+    def stats(self,scale=1e3):
+        """ returns count, mean, min, max and percentiles, in ms """
+        return {'count':self.count,
+            'mean':scale*self.mean(),
+            'min':scale*(self.min or 0.),
+            'max':scale*self.max,
+            'p50':scale*self.percentile(50),
+            'p95':scale*self.percentile(95),
+            'p99':scale*self.percentile(99),
+            }
+    
+class Profiler(object):
+    """
+    Keeps a Histogram per key and metric (e.g. attribute,'eval') 
+    and counters per key (e.g. attribute,'cache_hit').
+    
+    If not enabled, add() and count() return immediately.
+    """
+    
+    def __init__(self,enabled=True,precision=5):
+        self.enabled = enabled
+        self.precision = precision
+        self.reset()
+        
+    def reset(self):
+        self.histograms = {}
+        self.counters = {}
+        self.started = time.time()
+        
+    def add(self,key,metric,value):
+        if not self.enabled: 
+            return
+        try:
+            h = self.histograms[key][metric]
+        except KeyError:
+            h = self.histograms.setdefault(key,{}).setdefault(metric,
+                    Histogram(self.precision))
+        h.add(value)
+        
+    def count(self,key,name,n=1):
+        if not self.enabled: 
+            return
+        c = self.counters.setdefault(key,{})
+        c[name] = c.get(name,0)+n
+        
+    def keys(self):
+        return sorted(set(self.histograms).union(self.counters))
+        
+    def get(self,key,metric,stat='p50'):
+        h = self.histograms.get(key,{}).get(metric)
+        return h.stats().get(stat,0) if h is not None else 0
+        
+    def report(self,keys=None):
+        """ returns a dictionary {key:{metric:stats,counter:value}} """
+        r = {}
+        for k in (keys if keys is not None else self.keys()):
+            d = r[k] = dict((m,h.stats()) 
+                for m,h in self.histograms.get(k,{}).items())
+            d.update(self.counters.get(k,{}))
+            hits,misses = d.get('cache_hit',0),d.get('cache_miss',0)
+            if hits or misses:
+                d['cache_hit_rate'] = float(hits)/(hits+misses)
+        return r
+    
+    def to_json(self,keys=None):
+        import json
+        return json.dumps({'started':self.started,'elapsed':
+            time.time()-self.started,'keys':self.report(keys)},sort_keys=True)
+       
 from . import doc
 __doc__ = doc.get_fn_autodoc(__name__,vars())
  
@@ -51,7 +51,10 @@ srubio@cells.es,
 
 import time,traceback,os
 import threading # needed for ThreadDict
+try: from thread import get_ident
+except: from threading import get_ident
 import collections
+import __builtin__
 from collections import defaultdict, deque
 try: from collections import OrderedDict
 except: pass
@@ -924,9 +927,314 @@ class ReversibleDict(object):#dict):
         
     def setdefault(self, key, def_val=None): raise Exception,'NotImplemented!'
     def fromkeys(self, iterable, value=None): raise Exception,'NotImplemented!'
-    def pop(self, key, def_val=None): raise Exception,'NotImplemented!'        
-    
-    
+    def pop(self, key, def_val=None): raise Exception,'NotImplemented!'
+
+
+##################################################################################################
+
+class DependencyCycle(Exception):
+    pass
+
+class DependencyGraph(object):
+    """
+    A directed graph of dependencies between named nodes,
+    used by DynamicDS to decide which attributes must be evaluated.
+
+    g = DependencyGraph()
+    g.add('C',['A','B'])  # C depends on A and B
+    g.add('D',['C'])
+    g.order()     # ['A','B','C','D'], inputs always first
+    g.plan('D')   # ['A','B','C'], all inputs of D in evaluation order
+    g.mark_dirty('A') # ['C','D'], the nodes to be re-evaluated
+
+    Nodes in a cycle are appended at the end of the order and kept in
+    the cycles list; build(strict=True) will raise DependencyCycle instead.
+
+    Topological order and plans are cached until the graph is modified.
+    """
+
+    def __init__(self,other=None):
+        self.inputs = {}
+        self.outputs = defaultdict(set)
+        self.dirty = set()
+        self.cycles = []
+        self._order = None
+        self._index = {}
+        self._plans = {}
+        if other:
+            for k,v in (other.items() if isMapping(other) else other):
+                self.add(k,v)
+
+    def __len__(self):
+        return len(self.inputs)
+
+    def __contains__(self,node):
+        return node in self.inputs
+
+    def __iter__(self):
+        return iter(self.order())
+
+    def add(self,node,inputs=None):
+        """ Adds or replaces the list of inputs of a node """
+        inputs = set(i for i in (inputs or []) if i!=node)
+        if node in self.inputs:
+            if self.inputs[node] == inputs:
+                return
+            self.remove(node,keep=True)
+        self.inputs[node] = inputs
+        for i in inputs:
+            self.outputs[i].add(node)
+            if i not in self.inputs:
+                self.inputs[i] = set()
+        self.reset(node)
+
+    def remove(self,node,keep=False):
+        """ Removes the node inputs; keep=True will keep it as input of others """
+        for i in self.inputs.get(node,[]):
+            self.outputs[i].discard(node)
+        self.reset(node)
+        if keep or self.outputs.get(node):
+            self.inputs[node] = set()
+        else:
+            self.inputs.pop(node,None)
+            self.outputs.pop(node,None)
+            self.dirty.discard(node)
+
+    def reset(self,node=None):
+        """ Clears the cached order and the plans affected by node """
+        self._order = None
+        if node is None or not self._plans:
+            self._plans.clear()
+        else:
+            for n in [node]+self.descendants(node):
+                self._plans.pop(n,None)
+
+    def build(self,strict=False):
+        """ Topological sort (Kahn's algorithm), returns the nodes order """
+        pending = dict((n,len(i)) for n,i in self.inputs.items())
+        ready = sorted(n for n,c in pending.items() if not c)
+        order = []
+        while ready:
+            n = ready.pop(0)
+            order.append(n)
+            for o in sorted(self.outputs.get(n,[])):
+                pending[o] -= 1
+                if not pending[o]:
+                    ready.append(o)
+        cycled = sorted(n for n,c in pending.items() if c)
+        self.cycles = cycled
+        if cycled and strict:
+            raise DependencyCycle(','.join(map(str,cycled)))
+        self._order = order+cycled
+        self._index = dict((n,i) for i,n in enumerate(self._order))
+        return self._order
+
+    def order(self):
+        if self._order is None:
+            self.build()
+        return self._order
+
+    def index(self,node):
+        self.order()
+        return self._index.get(node,-1)
+
+    def ancestors(self,node):
+        """ All the nodes that node depends on, unsorted """
+        seen,stack = set(),list(self.inputs.get(node,[]))
+        while stack:
+            n = stack.pop()
+            if n not in seen and n!=node:
+                seen.add(n)
+                stack.extend(self.inputs.get(n,[]))
+        return list(seen)
+
+    def descendants(self,node):
+        """ All the nodes depending on node, unsorted """
+        seen,stack = set(),list(self.outputs.get(node,[]))
+        while stack:
+            n = stack.pop()
+            if n not in seen and n!=node:
+                seen.add(n)
+                stack.extend(self.outputs.get(n,[]))
+        return list(seen)
+
+    def plan(self,*nodes):
+        """
+        Returns the inputs to be updated before evaluating nodes,
+        in topological order (the nodes themselves are not included)
+        """
+        if len(nodes)==1:
+            node = nodes[0]
+            if node not in self._plans:
+                index = self.index
+                self._plans[node] = sorted(self.ancestors(node),key=index)
+            return self._plans[node]
+        targets = set(nodes)
+        deps = set(d for n in nodes for d in self.plan(n))
+        return [n for n in self.order() if n in deps and n not in targets]
+
+    def sort(self,nodes):
+        """ Returns the given nodes in evaluation order """
+        return sorted(nodes,key=self.index)
+
+    def levels(self,nodes):
+        """
+        Groups the given nodes in levels, each node depending only on nodes
+        of previous levels (inputs not in nodes are ignored); the nodes of 
+        a level can be evaluated in parallel.
+        """
+        level,levels = {},[]
+        for n in self.sort(nodes):
+            l = 1+max([level[i] for i in self.inputs.get(n,()) 
+                       if i in level] or [-1])
+            level[n] = l
+            if l==len(levels):
+                levels.append([])
+            levels[l].append(n)
+        return levels
+
+    def mark_dirty(self,node):
+        """ Marks all dependents of node as dirty, returns them """
+        nodes = self.descendants(node)
+        self.dirty.update(nodes)
+        return nodes
+
+    def is_dirty(self,node):
+        return node in self.dirty
+
+    def set_clean(self,node):
+        self.dirty.discard(node)
+
+##################################################################################################
+
+_undefined = object()
+_builtins = __builtin__.__dict__
+
+class LayeredDict(dict):
+    """
+    A dictionary used as persistent evaluation namespace (eval locals).
+
+    Its own items are the persistent layer, accessed at dict speed.
+    Keys not found there are looked up (through __missing__) in:
+
+     - the current frame of the calling thread, pushed/popped per call
+     - lazy keys, calculated by a method only when accessed and cached
+       until invalidate() is called (or not cached if cached=False)
+     - the defaults dictionary
+     - the globals dictionary and builtins, as eval would do next; so
+       global names are returned without raising a KeyError each time
+       (but they are not "in" the namespace)
+
+    ns = LayeredDict(ATTR=getAttr)
+    ns.set_lazy('ATTRIBUTES',lambda:sorted(attributes))
+    ns.push(VALUE=1.,ATTRIBUTE='A')
+    try: eval('VALUE*2',{},ns)
+    finally: ns.pop()
+
+    Frame keys must not be stored in the persistent layer, as it 
+    would hide them (eval would never reach __missing__).
+    """
+
+    def __init__(self,*args,**kwargs):
+        dict.__init__(self,*args,**kwargs)
+        self.defaults = {}
+        self._lazy = {}
+        self._lazy_values = {}
+        self._frames = {} #{thread:[frames]}
+        self.globals = {}
+
+    def _lookup(self,key):
+        """ returns the value of key in frames/lazy/defaults or _undefined """
+        frames = self._frames.get(get_ident())
+        if frames:
+            for layer in frames[-1]:
+                if key in layer:
+                    return layer[key]
+        if key in self._lazy:
+            try:
+                return self._lazy_values[key]
+            except KeyError:
+                method,cached = self._lazy[key]
+                value = method()
+                if cached:
+                    self._lazy_values[key] = value
+                return value
+        return self.defaults.get(key,_undefined)
+
+    def __missing__(self,key):
+        value = self._lookup(key)
+        if value is not _undefined:
+            return value
+        if key in self.globals:
+            return self.globals[key]
+        if key in _builtins:
+            return _builtins[key]
+        raise KeyError(key)
+
+    def __contains__(self,key):
+        return (dict.__contains__(self,key) 
+                or self._lookup(key) is not _undefined)
+
+    has_key = __contains__
+
+    def get(self,key,default=None):
+        if dict.__contains__(self,key):
+            return dict.__getitem__(self,key)
+        value = self._lookup(key)
+        return default if value is _undefined else value
+
+    def set_lazy(self,key,method,cached=True):
+        """ method() will be called to calculate key when needed """
+        self._lazy[key] = (method,cached)
+        self._lazy_values.pop(key,None)
+
+    def invalidate(self,key=None):
+        """ Clears cached lazy values, to be recalculated on next access """
+        if key is None:
+            self._lazy_values.clear()
+        else:
+            self._lazy_values.pop(key,None)
+
+    def push(self,*layers,**kwargs):
+        """
+        Pushes a new frame for the calling thread, 
+        layers are mappings looked up in order, kwargs go first;
+        keys not found will be searched in the previous frame.
+        """
+        frames = self._frames.setdefault(get_ident(),[])
+        frame = ((kwargs,)+layers) if kwargs else layers
+        if frames:
+            frame += frames[-1]
+        frames.append(frame)
+        return frame
+
+    def pop(self):
+        """ Removes the last frame of the calling thread """
+        ident = get_ident()
+        frames = self._frames[ident]
+        frame = frames.pop()
+        if not frames:
+            self._frames.pop(ident,None)
+        return frame
+
+    def frame(self):
+        """ Returns the current frame as a single dictionary """
+        frames = self._frames.get(get_ident())
+        r = {}
+        for layer in reversed(frames[-1] if frames else ()):
+            r.update(layer)
+        return r
+
+    def in_frames(self,key):
+        """ Returns the values of key in the current frame of each thread """
+        r = []
+        for frames in self._frames.values():
+            for layer in (frames[-1] if frames else ()):
+                if key in layer:
+                    r.append(layer[key])
+                    break
+        return r
+
 ##################################################################################################
     
 """
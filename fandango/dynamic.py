@@ -90,7 +90,7 @@ This Module includes several classes:
         </pre>
 """
 
-import PyTango,sys,threading,time,traceback,re,inspect
+import PyTango,sys,threading,time,traceback,re,inspect,ast,functools
 from PyTango import AttrQuality,DevState
 
 import fandango as fn
@@ -101,7 +101,10 @@ from fandango.excepts import *
 from fandango.objects import self_locked, Cached
 from fandango.linos import listdir
 from fandango.dicts import SortedDict,CaselessDefaultDict,defaultdict,CaselessDict
-from fandango.log import Logger,shortstr
+from fandango.dicts import DependencyGraph, LayeredDict
+from fandango.log import Logger,Lazy,shortstr
+from fandango.debug import Profiler
+from fandango.threads import CoalescingQueue, ThreadPool
 import fandango.functional as fun
 from fandango.functional import clmatch, clsearch, clsub, kmap, isSequence, \
     isCallable, isMapping, isString, list2lines, time2str, str2time, notNone
@@ -114,6 +117,11 @@ if getattr(PyTango,'__version_number__',0)<722:
 else: 
     USE_STATIC_METHODS = False
 
+try:
+    import numpy as np
+except:
+    np = None
+
 import os
 MEM_CHECK = str(os.environ.get('PYMEMCHECK')).lower() in ('yes','true','1')
 if MEM_CHECK and 'HEAPY' not in locals():
@@ -136,6 +144,327 @@ if 'DeviceClass' not in dir(PyTango): PyTango.DeviceClass = PyTango.PyDeviceClas
 MAX_ARRAY_SIZE = 8192
 EVENT_TYPES = '(true|yes|push|archive|[0-9]+)$'
 
+###############################################################################
+
+class PropertySnapshot(object):
+    """
+    Database wrapper that keeps device/class properties in memory.
+    
+    load() reads all the properties of a list of devices and classes 
+    using a single DbMySqlSelect query for each table (or a call per 
+    device if the query is not allowed by the database); 
+    get_device_property/get_class_property return the cached values and 
+    load (and keep) the ones not yet read.
+    
+    Any other method is forwarded to the database object, so the snapshot
+    can be passed as db argument (e.g. to resolve @COPY extensions).
+    """
+    
+    TABLES = {'device':'property_device','class':'property_class'}
+    
+    def __init__(self,db):
+        self.db = db
+        self.devices = CaselessDict()
+        self.classes = CaselessDict()
+        self.queries = 0
+        
+    def __getattr__(self,name):
+        return getattr(self.db,name)
+    
+    @staticmethod
+    def is_safe(name):
+        return not any(c in name for c in '\'"\\;')
+    
+    def query(self,column,names):
+        """ returns {owner:{property:[values]}} for all names """
+        # names are interpolated in the query, quotes are not allowed
+        bad = [n for n in names if not self.is_safe(n)]
+        if bad:
+            raise ValueError('Unsafe names for %s query: %s' % (column,bad))
+        q = ("select %s,name,value from %s where %s in (%s) "
+             "order by %s,name,count" % (column,self.TABLES[column],column,
+                ','.join("'%s'"%n for n in names),column))
+        lv,sv = self.db.command_inout('DbMySqlSelect',q)
+        self.queries += 1
+        nrows,ncols = lv[-2],lv[-1]
+        result = CaselessDict()
+        for i in range(nrows):
+            owner,prop,value = sv[i*ncols:(i*ncols)+3]
+            result.setdefault(owner,CaselessDict()).setdefault(
+                prop,[]).append(value)
+        return result
+    
+    def read(self,column,name):
+        """ fallback for a single device/class, using the Database API """
+        if column == 'device':
+            props = list(self.db.get_device_property_list(name,'*'))
+            values = self.db.get_device_property(name,props) if props else {}
+        else:
+            props = list(self.db.get_class_property_list(name))
+            values = self.db.get_class_property(name,props) if props else {}
+        self.queries += 1+bool(props)
+        return CaselessDict((k,list(v)) for k,v in values.items())
+        
+    def load(self,devices=None,classes=None,update=False):
+        for column,names,cache in (('device',devices,self.devices),
+                                   ('class',classes,self.classes)):
+            names = [n for n in (names or []) if update or n not in cache]
+            if not names:
+                continue
+            safe = [n for n in names if self.is_safe(n)]
+            try:
+                result = self.query(column,safe) if safe else CaselessDict()
+            except Exception,e:
+                print('PropertySnapshot.load(%s): %s query failed, '
+                      'reading one by one: %s' % (column,len(safe),e))
+                result = CaselessDict((n,self.read(column,n)) for n in safe)
+            for n in names:
+                if n not in safe:
+                    result[n] = self.read(column,n)
+            for n in names:
+                cache[n] = result.get(n,CaselessDict())
+        return self
+    
+    def get_property(self,column,name,props):
+        cache = self.devices if column == 'device' else self.classes
+        if name not in cache and column == 'device':
+            self.load(devices=[name])
+        elif name not in cache:
+            self.load(classes=[name])
+        if isString(props):
+            props = [props]
+        return dict((p,list(cache[name].get(p,[]))) for p in props)
+        
+    def get_device_property(self,device,props):
+        return self.get_property('device',device,props)
+    
+    def get_class_property(self,klass,props):
+        return self.get_property('class',klass,props)
+    
+class FormulaCompiler(object):
+    """
+    Converts a formula into a python function, parsing its AST just once:
+    
+     - constant expressions are folded (e.g. 2*3.14 => 6.28)
+     - names of kept attributes are read directly from its slot (.value)
+     - literal external models (XATTR('a/b/c/d')) are replaced by 
+       pre-bound handles, returned by the xattr(model) method
+     - all other names are read from the namespace, 
+       or from globals/builtins if not declared there
+    
+    compile() returns None for formulas that cannot be converted 
+    (lambdas, generators, comprehensions); those will use eval()
+    
+    As with eval(), names not found in the namespace raise NameError
+    
+    It is enabled by the CompileFormulas property of DynamicDS
+    """
+    
+    UNSUPPORTED = tuple(getattr(ast,n) for n in ('Lambda','GeneratorExp',
+        'ListComp','DictComp','SetComp','Yield') if hasattr(ast,n))
+    XATTR_CALLS = ('ATTR','Attr','XATTR','XAttr')
+    CONSTANTS = ('True','False','None')
+    BUILTINS = (__builtins__ if isinstance(__builtins__,dict) 
+                else vars(__builtins__))
+    
+    PURE_CALLS = ('abs','min','max','sum','len','round','int','float','bool',
+        'str','list','tuple','any','all','pow','divmod','sorted','reversed')
+    
+    @classmethod
+    def is_pure(cls,formula,names,namespace=None):
+        """
+        Returns True if the formula uses only literals, operators, the 
+        given attribute names (lowercase) and PURE_CALLS builtins 
+        (if not overriden in namespace).
+        """
+        try:
+            tree = ast.parse(formula.strip(),mode='eval')
+        except:
+            return False
+        for node in ast.walk(tree):
+            if isinstance(node,cls.UNSUPPORTED+(ast.Attribute,)):
+                return False
+            elif isinstance(node,ast.Call) and not (
+                    isinstance(node.func,ast.Name) 
+                    and node.func.id in cls.PURE_CALLS):
+                return False
+            elif isinstance(node,ast.Name):
+                if node.id in cls.CONSTANTS or node.id.lower() in names:
+                    continue
+                elif node.id in cls.PURE_CALLS and (
+                        namespace is None or node.id not in namespace):
+                    continue
+                return False
+        return True
+        
+    def __init__(self,namespace,_globals=None,slots=None,xattr=None):
+        self.namespace = namespace
+        self.globals = _globals if _globals is not None else {}
+        self.slots = slots or {}
+        self.xattr = xattr
+        
+    # Used if names are read from namespace, to raise NameError like eval
+    TEMPLATE = ("def __formula_factory__(%s):\n"
+                "    def formula():\n"
+                "        try:\n"
+                "            return None\n"
+                "        except KeyError,_e:\n"
+                "            _undefined(_ns,_e,%r)\n"
+                "            raise\n"
+                "    return formula\n")
+    
+    @staticmethod
+    def undefined(namespace,e,names):
+        """ Converts the KeyError of a missing name into a NameError """
+        key = e.args[0] if e.args else None
+        if key in names and key not in namespace:
+            raise NameError("name '%s' is not defined" % key)
+        
+    def compile(self,formula,name='<formula>'):
+        try:
+            expr = ast.parse(formula.strip(),mode='eval').body
+            self._args,self._names,self._lookups = [],{},set()
+            expr = self.visit(expr)
+            argnames = ['_ns','_undefined']+[a for a,v in self._args]
+            args = [self.namespace,self.undefined]+[v for a,v in self._args]
+            if not self._lookups:
+                tpl = ast.parse('lambda %s: lambda: None'%','.join(argnames),
+                                mode='eval')
+                tpl.body.body.body = expr
+                ast.fix_missing_locations(tpl)
+                factory = eval(compile(tpl,name,'eval'),self.globals)
+                return factory(*args)
+            tpl = ast.parse(self.TEMPLATE % (','.join(argnames),
+                            tuple(sorted(self._lookups))),mode='exec')
+            tpl.body[0].body[0].body[0].body[0].value = expr
+            ast.fix_missing_locations(tpl)
+            try:
+                exec compile(tpl,name,'exec') in self.globals
+                return self.globals.pop('__formula_factory__')(*args)
+            finally:
+                self.globals.pop('__formula_factory__',None)
+        except Exception,e:
+            return None
+        finally:
+            self._args,self._names,self._lookups = [],{},set()
+        
+    def bind(self,key,obj,prefix):
+        """ Objects are passed to the formula as closure variables """
+        if key not in self._names:
+            self._names[key] = '%s%d'%(prefix,len(self._args))
+            self._args.append((self._names[key],obj))
+        return ast.Name(id=self._names[key],ctx=ast.Load())
+    
+    def visit(self,node):
+        if isinstance(node,self.UNSUPPORTED):
+            raise Exception('FormulaCompiler: %s not supported'
+                            % type(node).__name__)
+        method = getattr(self,'visit_'+type(node).__name__,None)
+        if method is not None:
+            return method(node)
+        return self.visit_fields(node)
+    
+    def visit_fields(self,node):
+        for field,old in ast.iter_fields(node):
+            if isinstance(old,list):
+                setattr(node,field,[self.visit(n) if isinstance(n,ast.AST)
+                                    else n for n in old])
+            elif isinstance(old,ast.AST):
+                setattr(node,field,self.visit(old))
+        return node
+    
+    def fold(self,node):
+        """ Replaces a numeric expression by its result """
+        value = eval(compile(ast.fix_missing_locations(ast.Expression(node)),
+                    '<fold>','eval'),{'__builtins__':{}})
+        if type(value) in (int,long,float,complex):
+            return ast.copy_location(ast.Num(n=value),node)
+        return node
+
+    def visit_BinOp(self,node):
+        node.left,node.right = self.visit(node.left),self.visit(node.right)
+        if isinstance(node.left,ast.Num) and isinstance(node.right,ast.Num):
+            if isinstance(node.op,(ast.Pow,ast.LShift)) and abs(
+                    node.right.n)>64:
+                return node
+            try: 
+                return self.fold(node)
+            except: #Errors (e.g. ZeroDivision) are raised at evaluation
+                pass
+        return node
+    
+    def visit_UnaryOp(self,node):
+        node.operand = self.visit(node.operand)
+        if isinstance(node.operand,ast.Num):
+            try:
+                return self.fold(node)
+            except:
+                pass
+        return node
+    
+    def visit_Name(self,node):
+        if not isinstance(node.ctx,ast.Load):
+            raise Exception('FormulaCompiler: %s assignment not supported'
+                            % node.id)
+        if node.id in self.CONSTANTS:
+            return node
+        if node.id in self.slots:
+            return ast.copy_location(ast.Attribute(
+                value=self.bind(node.id,self.slots[node.id],'_s'),
+                attr='value',ctx=ast.Load()),node)
+        if node.id not in self.namespace and (
+                node.id in self.globals or node.id in self.BUILTINS):
+            return node
+        self._lookups.add(node.id)
+        return ast.copy_location(ast.Subscript(
+            value=ast.Name(id='_ns',ctx=ast.Load()),
+            slice=ast.Index(value=ast.Str(s=node.id)),ctx=ast.Load()),node)
+    
+    def visit_Call(self,node):
+        f,args = node.func,node.args
+        if (self.xattr and isinstance(f,ast.Name) 
+                and f.id in self.XATTR_CALLS
+                and len(args)==1 and isinstance(args[0],ast.Str) 
+                and '/' in args[0].s
+                and not getattr(node,'starargs',None) 
+                and not getattr(node,'kwargs',None)
+                and (f.id.startswith('X') or not node.keywords)):
+            handle = self.xattr(args[0].s)
+            if handle is not None:
+                node.func = self.bind(args[0].s,handle,'_x')
+                node.args = []
+                node.keywords = [self.visit(k) for k in node.keywords]
+                return node
+        return self.visit_fields(node)
+
+###############################################################################
+
+def dyn_attr_locked(method):
+    """
+    Decorator for read_dyn_attr/write_dyn_attr, serializing the access.
+    
+    By default it uses a device-wide lock (self_locked); if ConcurrentReads 
+    is enabled each attribute is evaluated holding its own lock and 
+    cached values are returned without waiting for any lock.
+    """
+    device_locked = self_locked(method)
+    
+    @functools.wraps(method)
+    def locked(self,attr,*args,**kwargs):
+        if not getattr(self,'ConcurrentReads',False):
+            return device_locked(self,attr,*args,**kwargs)
+        attr = tango.fakeAttributeValue(attr) if isString(attr) else attr
+        aname = self.get_attr_name(attr.get_name())
+        if method.__name__.startswith('read') and self.read_dyn_cache(
+                attr,aname):
+            if self.profiler is not None:
+                self.profiler.count(aname,'cache_hit')
+            return
+        with self.get_attr_lock(aname):
+            return method(self,attr,*args,**kwargs)
+        
+    return locked
+
 class DynamicDSImpl(PyTango.Device_4Impl,Logger):
     
     EXTENSIONS = dict(list(tango.EXTENSIONS.items()))    
@@ -164,6 +493,32 @@ class DynamicDSImpl(PyTango.Device_4Impl,Logger):
         self.dyn_values = {} #<- That's the main cache used for attribute management
             #Should it be caseless?
         self.dyn_qualities = {} #<- It keeps the dynamic qualities variables
+        self.dyn_quality_codes = {} #<- Compiled quality formulas
+        self._state_inputs = None #<- Built at dyn_attr(), see build_state_inputs
+        self._state_last = (0,None) #<- Time and inputs of last check_state
+        self._state_counters = {'evaluated':0,'skipped':0}
+        self._pure = {} #<- Memoized attributes and its inputs
+        self._pure_tags = set() #<- Attributes declared with @pure
+        self._dyn_lines = SortedDict() #<- Lines loaded by dyn_attr
+        self._reload_report = ''
+        self._memo = {}
+        self._memo_counters = {'hits':0,'misses':0}
+        self.profiler = None #Created at dyn_attr if EnableProfiler
+        self._quality_deps = {}
+        self._quality_cache = {}
+        self.dyn_graph = DependencyGraph() #<- Built at dyn_attr()
+        self.dyn_functions = {} #<- Compiled formulas, if CompileFormulas
+        self._deps_pass = threading.local()
+        self._batch = threading.local() #<- Filled by read_attr_hardware
+        self._xattr_models = {}
+        self._xattr_snapshot = {} #<- {model:(time,value)}, see prefetch_xattrs
+        self._attr_xmodels = {}
+        self._io_bound = {} #<- See is_io_bound
+        self._eval_pool = None #<- Created by get_eval_pool if EvalThreads
+        self._xdevice_proxies = {}
+        self._xdevice_stats = {}
+        self._attr_locks = {}
+        self._attr_locks_lock = threading.Lock()
         self.variables = {}
         self.state_lock = threading.Lock()
         self.DEFAULT_POLLING_PERIOD = 3000.
@@ -183,8 +538,9 @@ class DynamicDSImpl(PyTango.Device_4Impl,Logger):
         self._external_commands = CaselessDict()
 
         self._events_paused = False
-        self._events_queue = objects.Queue.Queue()
+        self._events_queue = CoalescingQueue(priorities=['state','status'])
         self._events_lock = threading.Lock()        
+        self._events_queue_lock = threading.Lock() #<- put vs queue swap
 
         self.time0 = time.time() #<< Used by child devices to check startup time
         self.simulationMode = False #If it is enabled the ForceAttr command overwrites the values of dyn_values
@@ -222,7 +578,9 @@ class DynamicDSImpl(PyTango.Device_4Impl,Logger):
         
         self._globals={} #globals().copy()
         if _globals: self._globals.update(_globals)
-        self._locals = {}
+        self._locals = LayeredDict()
+        self._locals.globals = self._globals
+        self._formula_keeps = {}
                 
         # Methods to access other device servers
         self._locals['Attr'] = lambda _name: self.getAttr(_name)
@@ -261,6 +619,10 @@ class DynamicDSImpl(PyTango.Device_4Impl,Logger):
         self._locals['FILE'] = lambda filename: DynamicDS.open_file(filename,device=self) #This command will allow to setup attributes from config files
         self._locals['FORMULA'] = self.get_attr_formula
         self._locals['MODELS'] = self.get_attr_models
+        self._locals['HISTORY'] = self.get_attr_history
+        self._locals['DELTA'] = lambda a,window=None: self.get_attr_history(a,window,'delta')
+        self._locals['MEAN'] = lambda a,window=None: self.get_attr_history(a,window,'mean')
+        self._locals['RATE'] = lambda a,window=None: self.get_attr_history(a,window,'rate')
         self._locals['time2str'] = fn.time2str
         self._locals['ctime2time'] = fn.ctime2time
         self._locals['now'] = fn.now
@@ -295,6 +657,22 @@ class DynamicDSImpl(PyTango.Device_4Impl,Logger):
         self.TangoStates = dict((str(v),v) for k,v in PyTango.DevState.values.items())
         self._locals.update(self.TangoStates)
         
+        # Per device values, recalculated only after dyn_attr()
+        self._locals['LOCALS'] = self._locals
+        self._locals.set_lazy('NAME',self.get_name)
+        self._locals.set_lazy('ATTRIBUTES',
+            lambda: sorted(self.dyn_values.keys()))
+        self._locals.set_lazy('FORMULAS',
+            lambda: dict((k,v.formula) for k,v in self.dyn_values.items()))
+        self._locals.set_lazy('XATTRS',
+            lambda: self._external_attributes,cached=False)
+        self._locals.set_lazy('STATE',self.get_state,cached=False)
+        
+        # Per call values, pushed by evalAttr, these are used outside calls
+        self._locals.set_lazy('t',lambda: time.time()-self.time0,cached=False)
+        self._locals.defaults.update(
+            {'WRITE':False,'READ':True,'ATTRIBUTE':'','VALUE':None})
+        
         if _locals: 
             self._locals.update(_locals) #New submitted methods have priority over the old ones
             
@@ -381,6 +759,18 @@ class DynamicDSImpl(PyTango.Device_4Impl,Logger):
         #It will reload all subclass specific properties (with its own default values)
         self.get_device_properties(self.get_device_class()) 
         self._db = db or self.get_db()
+        # Properties of all devices are loaded in bulk at server startup,
+        # afterwards (Init/updateDynamicAttributes) only this device is read
+        try:
+            snap = ext_db = DynamicDSClass.get_properties_snapshot()
+            if not PyTango.Util.instance().is_svr_starting():
+                snap.load([self.get_name()],
+                          [self.get_device_class().get_name()],update=True)
+                # @COPY targets may be other devices, not refreshed above
+                ext_db = self._db
+        except Exception,e:
+            self.warning('Unable to load properties snapshot: %s' % e)
+            snap = ext_db = self._db
         
         if self.LogLevel: 
             try: self.setLogLevel(self.LogLevel)
@@ -388,10 +778,10 @@ class DynamicDSImpl(PyTango.Device_4Impl,Logger):
             
         #Loading DynamicDS specific properties (from Class and Device)
         for method,target,config in (
-                (self._db.get_class_property,
+                (snap.get_class_property,
                     self.get_device_class().get_name(),
                     DynamicDSClass.class_property_list),
-                (self._db.get_device_property,self.get_name(),
+                (snap.get_device_property,self.get_name(),
                     dict(list(DynamicDSClass.device_property_list.items())
                      +[('polled_attr',[PyTango.DevVarStringArray,[]])])),
             ):
@@ -429,7 +819,7 @@ class DynamicDSImpl(PyTango.Device_4Impl,Logger):
                   
                 else:
                     #APPLYING @COPY/@FILE property extensions
-                    value = self.check_property_extensions(prop,value)
+                    value = self.check_property_extensions(prop,value,db=ext_db)
                     if prop.lower() == 'checkdependencies':
                         if isSequence(value) and len(value)==1:
                             value = value[0]
@@ -487,7 +877,7 @@ class DynamicDSImpl(PyTango.Device_4Impl,Logger):
     def check_property_extensions(prop,value,db=None,extensions=EXTENSIONS):
         #THIS METHOD PROVIDES EXTENSIONS AND MULTILINE PARSING!
         return tango.check_property_extensions(prop,value,
-            extensions=DynamicDS.EXTENSIONS,db=DynamicDS.get_db(),
+            extensions=DynamicDS.EXTENSIONS,db=db or DynamicDS.get_db(),
             filters=DynamicDSClass.device_property_list)
 
     def check_polled_attributes(self,db=None,new_attr={},use_admin=False):
@@ -549,33 +939,86 @@ class DynamicDSImpl(PyTango.Device_4Impl,Logger):
            self._db.put_device_property(my_name,{'polled_attr':npattrs})
         self.info('Out of check_polled_attributes ...')
         
+    # Properties that affect all attributes; if any of them changes 
+    # updateDynamicAttributes will reload all of them
+    RELOAD_PROPERTIES = ('DynamicStates','DynamicQualities','KeepAttributes',
+        'UseEvents','CheckDependencies','CompileFormulas','MemoizeFormulas',
+        'Lambdas','DynamicSpectrumSize','UseNumpy','HistorySize')
+        
+    def get_dyn_lines(self):
+        """ Returns {attribute:line} for all DynamicAttributes lines """
+        lines = SortedDict()
+        for line in self.DynamicAttributes:
+            fields = line.split('#')[0].split('=',1)
+            if line.strip().startswith('#') or len(fields)<2:
+                continue
+            lines[fields[0].strip()] = line.strip()
+        return lines
+    
+    @staticmethod
+    def get_dyn_type(formula):
+        """ Returns the (DynamicDSType,writable) tuple used for a formula """
+        writable = 'WRITE' in fun.re.split('[\[\(\]\)\ =,\+]',formula)
+        for typename,dyntype in DynamicDSTypes.items():
+            if dyntype.match(formula):
+                return dyntype,writable
+        if any(map(formula.startswith,['list(','['])):
+            return DynamicDSTypes['DevVarDoubleArray'],writable
+        return DynamicDSTypes['DevDouble'],writable
+    
+    def get_reload_config(self):
+        return [str(getattr(self,p,None)) for p in self.RELOAD_PROPERTIES]
+    
     def updateDynamicAttributes(self):
         """Forces dynamic attributes update from properties.
         @warning : It will DELETE all attributes that does not appear in DynamicAttributes property or StaticAttributes list!
+        
+        Only added, removed or changed lines are reloaded, unless any of 
+        RELOAD_PROPERTIES changed; returns a summary of the changes.
         """
         self.warning('In updateDynamicAttributes(): reloading DynamicDS properties from Database')
+        t0 = time.time()
+        config = self.get_reload_config()
         self.get_DynDS_properties()
         
+        old,new = self._dyn_lines,self.get_dyn_lines()
+        added = [a for a in new if a not in old]
+        changed = [a for a in new if a in old and new[a]!=old[a]]
+        full = not old or config != self.get_reload_config()
+        
         ##All attributes managed with dyn_attr() that does not appear 
         # in DynamicAttributes or StaticAttributes list will be removed!
         attrs_list = [name.split('=',1)[0].strip() for name in 
             (self.DynamicAttributes + (getattr(self,'StaticAttributes',None) 
                                        or []))]
-        for a in self.dyn_attrs:
-            if a not in attrs_list:
-                self.warning('DynamicDS.updateDynamicAttributes(): '
-                    'Removing Attribute!: %sn not in [%s]' % (a,attrs_list))
-                try:
-                    self.remove_attribute(a)
-                except Exception,e:
-                    self.error('Unable to remove attribute %s: %s'%(a,str(e)))
-        DynamicDS.dyn_attr(self)
+        removed = [a for a in self.dyn_attrs if a not in attrs_list]
+        for a in removed:
+            self.warning('DynamicDS.updateDynamicAttributes(): '
+                'Removing Attribute!: %s not in [%s]' % (a,attrs_list))
+            try:
+                self.remove_attribute(a)
+            except Exception,e:
+                self.error('Unable to remove attribute %s: %s'%(a,str(e)))
+            for d in (self.dyn_attrs,self.dyn_types,self.dyn_values):
+                d.pop(a,None)
+            dict.pop(self._locals,a,None) #LayeredDict.pop() pops frames
+                
+        if full:
+            DynamicDS.dyn_attr(self)
+        elif added or changed or removed:
+            DynamicDS.dyn_attr(self,[new[a] for a in added+changed],removed)
         
         #Updating DynamicCommands (just update of formulas)
         try: 
             CreateDynamicCommands(type(self),type(self.get_device_class()))
         except: 
             print('CreateDynamicCommands failed: %s'%traceback.format_exc())        
+            
+        self._reload_report = ('%s reload in %f seconds; added: %s; '
+            'removed: %s; changed: %s' % ('full' if full else 'diff',
+            time.time()-t0,added,removed,changed))
+        self.warning('updateDynamicAttributes(): %s' % self._reload_report)
+        return self._reload_report
 
 ###############################################################################
     
@@ -586,12 +1029,15 @@ class DynamicDSAttrs(DynamicDSImpl):
 
 
     ## Dynamic Attributes Creator
-    def dyn_attr(self):
+    def dyn_attr(self,lines=None,removed=None):
         """
         Dynamic Attributes Creator: It initializes the device from DynamicAttributes and DynamicStates properties.
         It is called by all DeviceNameClass classes that inherit from DynamicDSClass.
         It MUST be an static method, to bound dynamic attributes and avoid being read by other devices from the same server.
         This is why Read/Write attributes are staticmethods also. (in other devices lambda is used)
+        
+        If lines are passed (see updateDynamicAttributes), only those 
+        attributes (and the ones using them or the removed ones) are updated.
         """
         self.info('\n'+'='*80+'\n'+'DynamicDS.dyn_attr( ... ), entering ...'+'\n'+'='*80)
         self.KeepAttributes = [s.lower() for s in self.KeepAttributes]
@@ -602,7 +1048,11 @@ class DynamicDSAttrs(DynamicDSImpl):
 
         if not hasattr(self,'DynamicStates'): self.error('DynamicDS property NOT INITIALIZED!')
             
-        if self.DynamicStates:
+        partial = lines is not None
+        lines = self.DynamicAttributes if lines is None else lines
+        removed = list(removed or [])
+        
+        if self.DynamicStates and not partial:
             self.dyn_states = SortedDict()
             def _add_state_formula(st,formula):
                 self.dyn_states[st]={'formula':formula,'compiled':compile(formula,'<string>','eval')}
@@ -625,9 +1075,30 @@ class DynamicDSAttrs(DynamicDSImpl):
                     self.debug( self.get_name()+".dyn.attr(): Unknown State: %s"%(line,))
         
         #Attributes may be added to polling if having Events
-        new_polled_attrs = CaselessDict(self.get_polled_attrs().items())
-        self.info('In %s.dyn_attr(): inspecting %d attributes ...' %(self.get_name(),len(self.DynamicAttributes)))
-        for line in self.DynamicAttributes:
+        polled_attrs = CaselessDict(self.get_polled_attrs().items())
+        new_polled_attrs = CaselessDict(polled_attrs.items())
+        touched = []
+        if not partial:
+            self._pure_tags,self._dyn_lines = set(),SortedDict()
+        else:
+            #Attributes changing its type or access must be created again
+            for line in lines:
+                aname,formula = [f.strip() for f in 
+                                 line.split('#')[0].split('=',1)]
+                previous = self._dyn_lines.get(aname,'=').split('#')[0]
+                if (aname in self.dyn_values and self.get_dyn_type(formula)
+                        != self.get_dyn_type(previous.split('=',1)[1].strip())):
+                    self.info('dyn_attr(): %s type changed' % aname)
+                    try:
+                        self.remove_attribute(aname)
+                    except Exception,e:
+                        self.error('Unable to remove %s: %s' % (aname,e))
+                    for d in (self.dyn_attrs,self.dyn_types,self.dyn_values):
+                        d.pop(aname,None)
+            added = [l.split('=',1)[0].strip() for l in lines 
+                     if l.split('=',1)[0].strip() not in self.dyn_values]
+        self.info('In %s.dyn_attr(): inspecting %d attributes ...' %(self.get_name(),len(lines)))
+        for line in lines:
             
             if not line.strip() or line.strip().startswith('#'): continue
             fields=[]
@@ -642,6 +1113,12 @@ class DynamicDSAttrs(DynamicDSImpl):
             ###################################################################
             aname,formula=fields[0].strip(),fields[1].strip()
             self.info(self.get_name()+".dyn_attr(): new Attribute '"+aname+"' = '"+formula+"'")
+            touched.append(aname)
+            self._dyn_lines[aname] = line.strip()
+            # A @pure tag in the comment declares a deterministic formula
+            self._pure_tags.discard(aname)
+            if '#' in line and '@pure' in line.split('#',1)[1]:
+                self._pure_tags.add(aname)
             
             ## How to compare existing formulas?
             # Strip the typename from the beginning (so all typenames must be identified!)
@@ -744,6 +1221,15 @@ class DynamicDSAttrs(DynamicDSImpl):
             self.dyn_values[aname].keep = events or (self.KeepAttributes and 
                 (not 'no' in self.KeepAttributes) and any(q.lower() 
                 in self.KeepAttributes for q in [aname,'*','yes','true']))            
+            
+            #History of numeric scalars, see get_attr_history
+            hsize,v = int(getattr(self,'HistorySize',0) or 0),self.dyn_values[aname]
+            if hsize and v.type.dimx==1 and v.type.pytype in (int,long,float):
+                if v.history is None or v.history.size!=hsize:
+                    v.set_history(hsize)
+                v.keep = True
+            elif v.history is not None:
+                v.set_history(0)
             if events:
                 self._locals[aname] = None
                 if create and events:
@@ -792,12 +1278,34 @@ class DynamicDSAttrs(DynamicDSImpl):
                           '%s(%s)) failed' % (type(exp),exp,type(aname),aname))
                         print(traceback.format_exc())
                         
-        if self.CheckDependencies:
-            [self.check_dependencies(aname) for aname in self.dyn_values]
+        affected = None
+        if partial:
+            affected = self.get_reload_affected(self.dyn_graph,
+                dict((a,v.formula) for a,v in self.dyn_values.items()),
+                touched,added,removed)
+            for a in removed:
+                self._pure_tags.discard(a)
+                self._dyn_lines.pop(a,None)
+            self.info('dyn_attr(): %d attributes affected: %s' 
+                      % (len(affected),sorted(affected)))
+        self.build_dependencies(affected,removed)
+        self.build_pure_formulas(affected)
+        self._locals.invalidate()
+        self._formula_keeps.clear()
+        self._attr_xmodels.clear()
+        self._io_bound.clear()
+        self.compile_qualities()
+        self.compile_formulas(affected)
+        self.build_state_inputs()
+        self.setup_events_queue()
+        if not getattr(self,'EnableProfiler',False):
+            self.profiler = None
+        elif self.profiler is None:
+            self.profiler = Profiler()
                         
         ##Setting up state events:
         #THESE SETTINGS ARE STILL NEEDED IN TANGO >= 7
-        for x in ('state','memusage',):
+        for x in (('state','memusage',) if not partial else ()):
             # Both State and MemUsage shall be polled to have events!
             events = self.check_attribute_events(x)
             if events and x not in new_polled_attrs:
@@ -810,7 +1318,9 @@ class DynamicDSAttrs(DynamicDSImpl):
                 if 'archive' in events:
                     self.set_archive_event(x,True,False)
         try:
-            self.check_polled_attributes(new_attr=new_polled_attrs)
+            if not partial or new_polled_attrs != polled_attrs or any(
+                    a in polled_attrs for a in removed):
+                self.check_polled_attributes(new_attr=new_polled_attrs)
         except:
             print('DynamicDS.dyn_attr( ... ), unable to set polling for (%s):'
                   ' \n%s'%(new_polled_attrs,traceback.format_exc()))
@@ -880,6 +1390,49 @@ class DynamicDSAttrs(DynamicDSImpl):
         except:pass
         return cabs,crel
     
+    def cast_dyn_value(self,aname,value):
+        """ 
+        Converts value to the attribute type, 
+        numeric arrays are kept as numpy.ndarray if UseNumpy is True
+        """
+        return self.dyn_types[aname].cast(value,
+            use_numpy=getattr(self,'UseNumpy',False))
+    
+    @staticmethod
+    def check_value_changed(old,new):
+        """ Compares two values, numpy arrays included """
+        if np is not None and (isinstance(old,np.ndarray) 
+                               or isinstance(new,np.ndarray)):
+            try:
+                return not np.array_equal(old,new)
+            except:
+                return True
+        try:
+            return bool(old!=new)
+        except:
+            return True
+    
+    @staticmethod
+    def check_array_changed(old,new,cabs=0,crel=0):
+        """
+        Vectorized change check for numpy arrays, abs/rel thresholds 
+        are evaluated element-wise; any change is reported if no thresholds.
+        """
+        old,new = np.asarray(old),np.asarray(new)
+        if old.shape!=new.shape:
+            return True
+        if old.dtype.kind not in 'iufb' or new.dtype.kind not in 'iufb':
+            return not np.array_equal(old,new)
+        if not cabs>0 and not crel>0:
+            return not np.array_equal(old,new)
+        old = old.astype('float64')
+        diff = np.abs(new-old)
+        if cabs>0 and (diff>=cabs).any():
+            return True
+        if crel>0 and ((diff>0)&(diff>=np.abs(old)*(crel/100.))).any():
+            return True
+        return False
+    
     def check_changed_event(self,aname,new_value,events=None,config=None):
         """
         Events will be always pushed if array,state,bool,string values change
@@ -900,22 +1453,34 @@ class DynamicDSAttrs(DynamicDSImpl):
             v = self.dyn_values[aname].value
             new_value = getattr(new_value,'value',new_value)
             
-            self.info('In check_changed_event(%s,%s,%s): %s!=%s'
-                % (aname,events,config,shortstr(v),shortstr(new_value) ))
+            self.info('In check_changed_event(%s,%s,%s): %s!=%s',
+                aname,events,config,Lazy(shortstr,v),
+                Lazy(shortstr,new_value))
             if v is None:
-                self.info('In check_changed_event(%s,%s): first value read!'
-                          %(aname,shortstr(new_value)))
+                self.info('In check_changed_event(%s,%s): first value read!',
+                          aname,Lazy(shortstr,new_value))
                 return True
             
             elif events and clsearch('always',events):
                 return True
             
+            elif np is not None and (isinstance(new_value,np.ndarray) 
+                                     or isinstance(v,np.ndarray)):
+                if clsearch('push',events):
+                    cabs,crel = 0,0
+                else:
+                    cabs,crel = config or self.check_events_config(aname)
+                changed = self.check_array_changed(v,new_value,cabs,crel)
+                self.info('In check_changed_event(%s,%s): changed = %s',
+                    aname,Lazy(shortstr,new_value),changed)
+                return changed
+            
             elif fun.isSequence(new_value) or fun.isSequence(v):
                 v,new_value = fun.notNone(v,[]),fun.notNone(new_value,[])
                 changed = len(v)!=len(new_value) \
                     or any(v!=vv for v,vv in zip(v,new_value))
-                self.info('In check_changed_event(%s,%s): changed = %s'
-                    %(aname,shortstr(new_value),changed))
+                self.info('In check_changed_event(%s,%s): changed = %s',
+                    aname,Lazy(shortstr,new_value),changed)
                 return changed
             
             else:
@@ -923,10 +1488,11 @@ class DynamicDSAttrs(DynamicDSImpl):
                     v,new_value = (float(v) if v is not None else None),\
                                     float(new_value)
                 except Exception,e: 
-                    self.debug(str(e))
+                    self.debug('%s',e)
                     self.info('In check_changed_event(%s): '
-                              'non-numeric, checking raw diff (%s,%s)'
-                              %(aname,shortstr(v),shortstr(new_value)))
+                              'non-numeric, checking raw diff (%s,%s)',
+                              aname,Lazy(shortstr,v),
+                              Lazy(shortstr,new_value))
                     try:
                         return v!=new_value #and (cabs>0 or crel>0)
                     except:
@@ -938,23 +1504,23 @@ class DynamicDSAttrs(DynamicDSImpl):
                     cabs,crel = config or self.check_events_config(aname)
                 
                 if cabs>0 and not v-cabs<new_value<v+cabs: 
-                    self.info('In check_changed_event(%s,%s): absolute change!'
-                              %(aname,shortstr(new_value)))
+                    self.info('In check_changed_event(%s,%s): absolute change!',
+                              aname,new_value)
                     return True
                 
                 elif crel>0 and not v*(1-crel/100.)<new_value<v*(1+crel/100.): 
-                    self.info('In check_changed_event(%s,%s): relative change!'
-                              %(aname,shortstr(new_value)))
+                    self.info('In check_changed_event(%s,%s): relative change!',
+                              aname,new_value)
                     return True
                 
                 elif v != new_value:
                     self.info('In check_changed_event(%s,%s): '
-                        'push on any change'%(aname,shortstr(new_value)))
+                        'push on any change',aname,new_value)
                     return True
                 
                 else: 
-                    self.debug('In check_changed_event(%s,%s): nothing changed'
-                               %(aname,shortstr(new_value)))
+                    self.debug('In check_changed_event(%s,%s): nothing changed',
+                               aname,new_value)
                     return False
                 
         except: #Needed to prevent fails if attribute_config_3 is not available
@@ -962,7 +1528,272 @@ class DynamicDSAttrs(DynamicDSImpl):
             
         return False
     
-    @Cached
+    def parse_dependencies(self, aname, names=None):
+        """
+        Returns the dynamic attributes appearing in the formula (and quality)
+        of aname; names is a {lower_name:name} dict of candidates.
+        """
+        if names is None:
+            names = dict((k.lower().strip(),k) for k in self.dyn_values)
+        a = aname.lower().strip()
+        formula = self.dyn_values[aname].formula or ''
+        fs = (formula+'\n'+self.dyn_qualities.get(a,'')).lower()
+        # Names within quotes are not tokenized as dependencies
+        tokens = set(fun.re.split("[^'\"_0-9a-zA-Z]",fs))
+        deps = set(names[t] for t in tokens if t in names and t!=a)
+
+        if isMapping(self.CheckDependencies):
+            for k,v in self.CheckDependencies.items():
+                if clmatch(k,aname) or clmatch(k,formula):
+                    deps.add(v)
+        return deps
+
+    @staticmethod
+    def get_reload_affected(graph,formulas,touched,added=(),removed=()):
+        """
+        Returns the attributes to be updated on a partial reload: the 
+        touched ones, those depending on them in graph (their inputs 
+        must be kept and their compiled formulas rebuilt) and those whose 
+        formula uses any added/removed name.
+        """
+        mentions = set(a.lower() for a in list(added)+list(removed))
+        affected = set(touched)
+        for a in touched:
+            affected.update(graph.descendants(a))
+        affected.update(a for a,f in formulas.items() 
+            if mentions.intersection(fun.re.split("[^_0-9a-zA-Z]",
+                                                  (f or '').lower())))
+        return affected
+        
+    def build_dependencies(self,anames=None,removed=None):
+        """
+        Builds the dependency graph between dynamic attributes, 
+        it is called once from dyn_attr() and updateDynamicAttributes()
+        
+        If anames is passed, only the inputs of those attributes (and the
+        removed ones) are updated in the current graph.
+        """
+        t0 = time.time()
+        if anames is None:
+            graph = DependencyGraph()
+            cycles,anames = [],self.dyn_values.keys()
+        else:
+            graph = self.dyn_graph
+            cycles = list(graph.cycles)
+            for a in (removed or []):
+                graph.remove(a)
+        if self.CheckDependencies:
+            names = dict((k.lower().strip(),k) for k in self.dyn_values)
+            for aname in anames:
+                v = self.dyn_values.get(aname)
+                if v is None:
+                    continue
+                v.dependencies = self.parse_dependencies(aname,names)
+                graph.add(aname,v.dependencies)
+                for k in v.dependencies:
+                    if k in self.dyn_values:
+                        self.dyn_values[k].keep = True
+            graph.build()
+            if graph.cycles:
+                self.warning('build_dependencies(): cyclic dependencies '
+                    'between %s' % graph.cycles)
+        if graph.cycles != (cycles if graph is self.dyn_graph 
+                            else self.dyn_graph.cycles):
+            self._attr_locks = {} #cyclic attributes share the same lock
+        self.dyn_graph = graph
+        self.info('build_dependencies(): %d attributes (%d updated) sorted '
+            'in %f seconds' % (len(graph),len(anames),time.time()-t0))
+        return graph
+
+    def build_pure_formulas(self,anames=None):
+        """
+        Formulas declared with a @pure tag (e.g. A = B*2 #@pure) or, if 
+        MemoizeFormulas is True, those detected as pure functions of other 
+        attributes (FormulaCompiler.is_pure) are memoized: the previous 
+        result is returned while the value and quality of all its inputs 
+        are unchanged (see check_memo). It requires CheckDependencies.
+        
+        If anames is passed, the results kept for other attributes are not 
+        discarded.
+        """
+        memo = {} if anames is None else dict((k,v) for k,v in 
+                        self._memo.items() if k not in anames)
+        self._pure,self._memo = {},memo
+        if not self.CheckDependencies:
+            return self._pure
+        auto = getattr(self,'MemoizeFormulas',False)
+        names = set(k.lower().strip() for k in self.dyn_values)
+        for aname,v in self.dyn_values.items():
+            if (not v.formula or v.formula in self.Lambdas 
+                    or v.dependencies is None):
+                continue
+            if aname in self._pure_tags or (auto and FormulaCompiler.is_pure(
+                    v.formula,names-set([aname.lower().strip()]),self._locals)):
+                self._pure[aname] = sorted(v.dependencies)
+        for k in list(self._memo):
+            if k not in self._pure:
+                self._memo.pop(k)
+        self.info('build_pure_formulas(): %d attributes memoized: %s' 
+                  % (len(self._pure),sorted(self._pure)))
+        return self._pure
+    
+    def check_memo(self,aname):
+        """
+        Returns (inputs,hit,result) for a memoized attribute; hit is True
+        if none of the inputs changed since the result was stored.
+        """
+        inputs = [(self.dyn_values[d].value,self.dyn_values[d].quality)
+                  for d in self._pure[aname]]
+        memo = self._memo.get(aname)
+        hit = memo is not None and not any(
+            self.check_value_changed(i[0],m[0]) or i[1]!=m[1]
+            for i,m in zip(inputs,memo[0]))
+        self._memo_counters['hits' if hit else 'misses'] += 1
+        if self.profiler is not None:
+            self.profiler.count(aname,'memo_hit' if hit else 'memo_miss')
+        return inputs,hit,(memo[1] if hit else None)
+
+    def get_pure_names(self,*extra):
+        """
+        Lowercase names accepted by FormulaCompiler.is_pure in quality and 
+        state formulas: dynamic attributes, AttrQuality and DevState 
+        constants and the extra names given.
+        """
+        names = set(k.lower().strip() for k in self.dyn_values)
+        names.update(str(q).lower() for q in AttrQuality.values.values())
+        names.update(k.lower() for k in getattr(self,'TangoStates',()))
+        names.update(n.lower() for n in extra)
+        return names
+
+    def compile_qualities(self):
+        """
+        Compiles DynamicQualities formulas once, and gets the inputs of 
+        each one (VALUE, DEFAULT and dynamic attributes); qualities will 
+        be re-evaluated only when their inputs change.
+        
+        Formulas calling any method or using any name not accepted by 
+        FormulaCompiler.is_pure (e.g. ATTR, VAR or callables added to 
+        _locals) are evaluated at every read.
+        """
+        self.dyn_quality_codes,self._quality_deps = {},{}
+        self._quality_cache = {}
+        names = dict((k.lower().strip(),k) for k in self.dyn_values)
+        pure = self.get_pure_names('VALUE','DEFAULT','ATTRIBUTE')
+        for a,formula in self.dyn_qualities.items():
+            try:
+                self.dyn_quality_codes[a] = compile(formula.strip(),
+                                                    '<quality:%s>'%a,'eval')
+            except:
+                self.error('compile_qualities(%s): %s' 
+                           % (a,traceback.format_exc()))
+                continue
+            tokens = set(fun.re.split("[^'\"_0-9a-zA-Z]",formula))
+            if (not FormulaCompiler.is_pure(formula,pure,self._locals)
+                    or re.findall(tango.retango,formula)):
+                self._quality_deps[a] = None
+            else:
+                self._quality_deps[a] = sorted(names[t.lower()] 
+                    for t in tokens if t.lower() in names)
+        return self.dyn_quality_codes
+
+    def build_state_inputs(self):
+        """
+        Gets the inputs of DynamicStates formulas; check_state() will
+        re-evaluate the state only if any of them changed. 
+        
+        External models are cached for KeepTime, so they make the state 
+        to be evaluated at most once per KeepTime; formulas with any other
+        call or name not accepted by FormulaCompiler.is_pure (e.g. VAR, 
+        non-literal ATTR, callables added to _locals) are evaluated always.
+        """
+        self._state_last = (0,None)
+        local,external,volatile = set(),False,False
+        names = dict((k.lower().strip(),k) for k in self.dyn_values)
+        pure = self.get_pure_names('STATE','_INPUT')
+        literal = "(?:X?ATTR|X?Attr)\\(\\s*['\"]([^'\"]+)['\"]\\s*[,)]"
+        call = ("(?:X?ATTR|X?Attr)\\(\\s*['\"][^'\"]+['\"]\\s*"
+                "(?:,[^()]*)?\\)")
+        for state,value in self.dyn_states.items():
+            formula = value['formula']
+            for m in re.findall(literal,formula):
+                if '/' in m:
+                    external = True
+                elif m.lower() in names:
+                    local.add(names[m.lower()])
+                else:
+                    volatile = True
+            # literal ATTR calls are already inputs, checked as _INPUT
+            formula = re.sub(call,'_INPUT',formula)
+            tokens = set(fun.re.split("[^'\"_0-9a-zA-Z]",formula))
+            volatile = volatile or not FormulaCompiler.is_pure(
+                formula,pure,self._locals)
+            external = external or bool(re.findall(tango.retango,formula))
+            local.update(names[t.lower()] for t in tokens 
+                         if t.lower() in names)
+            
+        self._state_inputs = {'attributes':sorted(local),
+            'external':external,'volatile':volatile}
+        self.info('build_state_inputs(): %s' % self._state_inputs)
+        return self._state_inputs
+    
+    def check_state_inputs(self):
+        """ Returns True if DynamicStates must be evaluated again """
+        now,(last,inputs) = time.time(),self._state_last
+        if now < last+getattr(self,'StateMinInterval',0)/1e3:
+            return False
+        if not self._state_inputs or self._state_inputs['volatile']:
+            return True
+        if (self._state_inputs['external'] 
+                and now >= last+max((100,self.KeepTime))/1e3):
+            return True
+        new = self.get_state_inputs()
+        return inputs is None or any(self.check_value_changed(a,b)
+                                     for a,b in zip(new,inputs))
+        
+    def get_state_inputs(self):
+        values = [self.get_state()]
+        for a in (self._state_inputs or {}).get('attributes',[]):
+            v = self.dyn_values[a]
+            values.extend((v.value,v.quality))
+        return values
+
+    def compile_formulas(self,anames=None):
+        """
+        If CompileFormulas is True, every attribute formula is converted 
+        into a python function (see FormulaCompiler); 
+        formulas that cannot be converted will still use eval()
+        
+        If anames is passed, only those formulas are compiled again.
+        """
+        if anames is None or not getattr(self,'CompileFormulas',False):
+            self.dyn_functions = {}
+        else:
+            self.dyn_functions = dict((k,f) for k,f in 
+                self.dyn_functions.items() if k not in anames 
+                and k in self.dyn_values)
+        if not getattr(self,'CompileFormulas',False):
+            return self.dyn_functions
+        t0 = time.time()
+        slots = dict((k,v) for k,v in self.dyn_values.items() if v.keep)
+        compiler = FormulaCompiler(self._locals,self._globals,slots,
+                                   xattr=self.get_xattr_handle)
+        for aname in (self.dyn_values.keys() if anames is None else anames):
+            v = self.dyn_values.get(aname)
+            if v is None or not v.formula or v.formula in self.Lambdas:
+                continue
+            f = compiler.compile(v.formula,'<%s>'%aname)
+            if f is not None:
+                self.dyn_functions[aname] = f
+            else:
+                self.info('compile_formulas(): %s will use eval()' % aname)
+        for a,formula in self.dyn_qualities.items():
+            f = compiler.compile(formula,'<quality:%s>'%a)
+            if f is not None:
+                self.dyn_quality_codes[a] = f
+        self.info('compile_formulas(): %d/%d formulas compiled in %f seconds'
+            % (len(self.dyn_functions),len(self.dyn_values),time.time()-t0))
+        return self.dyn_functions
+
     def check_dependencies(self, aname):
         #Checking attribute dependencies
         if aname not in self.dyn_values:
@@ -972,26 +1803,12 @@ class DynamicDSAttrs(DynamicDSImpl):
             
             if self.dyn_values[aname].dependencies is None:
                 self.debug("In evalAttr ... setting dependencies")
-                self.dyn_values[aname].dependencies = set()
-                a = aname.lower().strip()
-                formula = self.dyn_values[aname].formula
-                fs = (formula+'\n'+self.dyn_qualities.get(a,'')).lower()
-
-                # Get dependencies from existing attributes
-                for k,v in self.dyn_values.items():
-                    ks = k.lower().strip()
-                    if a==ks: 
-                        continue
-                    if ks in fun.re.split("[^'\"_0-9a-zA-Z]",fs): 
-                        #fun.searchCl("(^|[^'\"_0-9a-z])%s($|[^'\"_0-9a-z])"%k,formula):
-                        self.dyn_values[aname].dependencies.add(k) 
-                        #Dependencies are case sensitive
+                deps = self.parse_dependencies(aname)
+                self.dyn_values[aname].dependencies = deps
+                self.dyn_graph.add(aname,deps)
+                for k in deps:
+                    if k in self.dyn_values:
                         self.dyn_values[k].keep = True
-                        
-                if isMapping(self.CheckDependencies):
-                    for k,v in self.CheckDependencies.items():
-                        if clmatch(k,aname) or clmatch(k,formula):
-                            self.dyn_values[aname].dependencies.add(v)
             
             r = self.dyn_values[aname].dependencies
         else:
@@ -999,27 +1816,46 @@ class DynamicDSAttrs(DynamicDSImpl):
         self.debug('check_dependencies(%s): %s' % (aname,r))
         return r      
         
+    def check_dependency_expired(self, aname, now=None):
+        """
+        An input must be re-evaluated if it has been marked dirty by a
+        change in its own inputs, or if its kept value expired.
+        """
+        if self.dyn_graph.is_dirty(aname):
+            return True
+        updated = self.dyn_values[aname].updated
+        now = now or time.time()
+        return bool(self.KeepTime and (
+            not updated or now>(updated+(self.KeepTime/1e3))))
+        
     def update_dependencies(self, aname = None):
         ##Checking attribute dependencies
-        # dependencies assigned at dyn_attr by self.check_dependencies()
-        #Updating Last Attribute Values
+        # dependencies assigned at dyn_attr by self.build_dependencies()
+        # all inputs are updated in topological order, just once per pass
         now = time.time()
         changed = False
-        for k in (self.dyn_values[aname].dependencies or []):
-            self.debug("In update_dependencies(%s): "
-                " (%s,last read at %s, KeepTime is %s)"
-                %(aname,k,self._last_read.get(k,0),self.KeepTime))
+        done = getattr(self._deps_pass,'nodes',None)
+        nested = done is not None
+        if not nested:
+            done = self._deps_pass.nodes = set()
+            
+        try:
+            for k in self.dyn_graph.plan(aname):
+                if k in done or k not in self.dyn_values:
+                    continue
+                done.add(k)
+                if self.check_dependency_expired(k,now):
+                    self.debug("In update_dependencies(%s): read %s"%(aname,k))
+                    if USE_STATIC_METHODS: 
+                        self.read_dyn_attr(self,tango.fakeAttributeValue(k))
+                    else: 
+                        self.read_dyn_attr(tango.fakeAttributeValue(k))
+        finally:
+            if not nested:
+                self._deps_pass.nodes = None
             
+        for k in (self.dyn_values[aname].dependencies or []):
             old = self._locals.get(k)
-            updated = self.dyn_values[k].updated
-            if self.KeepTime and (
-                    not updated or now>(updated+(self.KeepTime/1e3))):
-                self.debug("In update_dependencies(%s): read value"%(k,))
-                if USE_STATIC_METHODS: 
-                    self.read_dyn_attr(self,tango.fakeAttributeValue(k))
-                else: 
-                    self.read_dyn_attr(tango.fakeAttributeValue(k))
-                
             v = self.dyn_values[k]
             
             if (k.lower().strip()!=aname.lower().strip() 
@@ -1032,16 +1868,40 @@ class DynamicDSAttrs(DynamicDSImpl):
             else: 
                 self._locals[k]=v.value #.value
                 
-            try:
-                if self._locals[k] != old:
-                    changed = True
-            except:
+            if self.check_value_changed(old,self._locals[k]):
                 changed = True
                 
         return changed      
 
     #@Catched #Catched decorator is not compatible with PyTango_Throw_Exception
-    @self_locked
+    def get_attr_lock(self,aname):
+        """ 
+        Returns the lock used to evaluate an attribute if ConcurrentReads;
+        attributes with cyclic dependencies share a single lock.
+        """
+        try:
+            return self._attr_locks[aname]
+        except KeyError:
+            with self._attr_locks_lock:
+                if aname in self.dyn_graph.cycles:
+                    lock = self._attr_locks.setdefault('<cycles>',
+                                                       threading.RLock())
+                else:
+                    lock = threading.RLock()
+                return self._attr_locks.setdefault(aname,lock)
+            
+    def read_dyn_cache(self,attr,aname):
+        """ Sets attr value from cache if available, returns True if so """
+        v = self.get_attr_cache(aname)
+        if v is None:
+            return False
+        self.debug('Returning cached (%s) value for %s: %s(%s)',
+            Lazy(time2str,v.updated),aname,type(v.value),
+            Lazy(shortstr,v.value))
+        attr.set_value_date_quality(v.value,v.date,v.quality)
+        return True
+
+    @dyn_attr_locked
     def read_dyn_attr(self,attr,fire_event=True):
         """
         Method to evaluate attributes from external clients.
@@ -1052,23 +1912,38 @@ class DynamicDSAttrs(DynamicDSImpl):
         aname = self.get_attr_name(attr.get_name())
         result = None
         tstart=time.time()
-        self.debug("DynamicDS(%s)::read_dyn_atr(%s), entering at %s\n%s"
-                   % (self.get_name(),aname,time2str(tstart),'<'*80))
+        self.debug("DynamicDS(%s)::read_dyn_atr(%s), entering at %s\n%s",
+                   self.get_name(),aname,Lazy(time2str,tstart),'<'*80)
 
-        v = self.get_attr_cache(aname)
-        if v is not None:
-            self.debug('Returning cached (%s) value for %s: %s(%s)'%(
-                time2str(v.updated),aname,type(v.value),shortstr(v.value)))
-            return attr.set_value_date_quality(v.value,v.date,v.quality)            
+        profiler = self.profiler
+        if self.read_dyn_cache(attr,aname):
+            if profiler is not None:
+                profiler.count(aname,'cache_hit')
+            return
+        elif profiler is not None:
+            profiler.count(aname,'cache_miss')
             
         try:
-            self.debug("DynamicDS(%s)::read_dyn_atr(%s) => evalAttr()"
-                   % (self.get_name(),aname))
-            result = self.evalAttr(aname)
+            batch = getattr(self._batch,'results',None)
+            if batch and aname in batch:
+                self.debug("DynamicDS(%s)::read_dyn_atr(%s) => batch",
+                    self.get_name(),aname)
+                result = batch.pop(aname)
+                if isinstance(result,Exception):
+                    raise result
+            else:
+                self.debug("DynamicDS(%s)::read_dyn_atr(%s) => evalAttr()",
+                    self.get_name(),aname)
+                if getattr(self._deps_pass,'nodes',None) is None:
+                    t0 = time.time()
+                    self.prefetch_xattrs([aname]+self.dyn_graph.plan(aname))
+                    if profiler is not None:
+                        profiler.add(aname,'prefetch',time.time()-t0)
+                result = self.evalAttr(aname)
             quality = getattr(result,'quality',
                               self.get_attr_quality(aname,result))
             date = self.get_attr_date(aname,result)
-            result = self.dyn_types[aname].pytype(result)
+            result = self.cast_dyn_value(aname,result)
 
             if 1: #hasattr(attr,'set_value_date_quality'):
                 attr.set_value_date_quality(result,date,quality)
@@ -1084,16 +1959,18 @@ class DynamicDSAttrs(DynamicDSImpl):
                 #try: PyTango.set_attribute_value_date_quality(attr,result,date,quality)
                 #except: attr.set_value(result)
                 
-            text_result = (type(result) is list and result and '%s[%s]'
-                           %(type(result[0]),len(result))) or str(result)
             now=time.time()
             self._last_period[aname]=now-self._last_read.get(aname,0)
             self._last_read[aname]=now
             self._read_times[aname]=now-self._hook_epoch
             self._total_usage += now-self._hook_epoch
-            self.debug('DynamicDS('+self.get_name()+
-                ").read_dyn_attr("+aname+")="+text_result+
-                ", ellapsed %1.2e"%(self._eval_times[aname])+" seconds.\n")
+            if profiler is not None:
+                profiler.add(aname,'read',now-tstart)
+            self.debug("DynamicDS(%s).read_dyn_attr(%s)=%s, ellapsed %1.2e"
+                " seconds.\n",self.get_name(),aname,
+                Lazy(lambda:(isSequence(result) and len(result) and '%s[%s]'
+                        %(type(result[0]),len(result))) or str(result)),
+                self._eval_times[aname])
 
             if 'debug' in str(self.getLogLevel()) and \
                 (time.time()>(self._cycle_start+self.PollingCycle*1e-3) \
@@ -1109,6 +1986,9 @@ class DynamicDSAttrs(DynamicDSImpl):
             self._read_times[aname]=now-self._hook_epoch #Internal debugging
             self._eval_times[aname]=now-tstart #Internal debugging
             if aname==self.dyn_values.keys()[-1]: self._cycle_start = now
+            if profiler is not None:
+                profiler.add(aname,'read',now-tstart)
+                profiler.count(aname,'errors')
             last_exc = str(e)
             self.error('DynamicDS_read_%s_Exception: %s\n\tresult=%s' 
                        % (aname,last_exc,result))
@@ -1120,7 +2000,7 @@ class DynamicDSAttrs(DynamicDSImpl):
     if USE_STATIC_METHODS: read_dyn_attr=staticmethod(read_dyn_attr)
 
     #@Catched
-    @self_locked
+    @dyn_attr_locked
     def write_dyn_attr(self,attr,fire_event=True):
         aname = attr.get_name()
         self.info("DynamicDS("+self.get_name()+")::write_dyn_atr("+aname+"), entering at "+time.ctime()+"...")
@@ -1167,20 +2047,22 @@ class DynamicDSAttrs(DynamicDSImpl):
             if not events or not changed:
                 return        
                 
-            self.info('push_dyn_attr(%s,%s)=%s(%s))\n%s'%(aname,
+            self.info('push_dyn_attr(%s,%s)=%s(%s))\n%s',aname,
                 queued and 'queued' or 'pushed',type(value),
-                shortstr(value),'<'*80))
+                Lazy(shortstr,value),'<'*80)
             
             if queued:
-                try:
-                    self._events_lock.acquire()
-                    self._events_queue.put((aname,value,date,quality,events))
-                finally:
-                    self._events_lock.release()
+                # only the last value of each attribute is kept
+                with self._events_queue_lock:
+                    self._events_queue.put(aname,
+                                           (value,date,quality,events))
             else:
+                t0 = time.time()
                 self.push_change_event(aname,value,date,quality)
                 if fun.clsearch('archive',events):
                     self.push_archive_event(aname,value,date,quality)
+                if self.profiler is not None:
+                    self.profiler.add(aname,'push',time.time()-t0)
         except Exception as e:
             self.error('push_dyn_attr(%s,%s(%s),%s,%s) failed!\n%s' % 
                 (aname,type(value),value,date,quality,traceback.format_exc()))
@@ -1198,16 +2080,16 @@ class DynamicDSAttrs(DynamicDSImpl):
         If push=True, any result is considered as change
         '''
         aname,formula = self.get_attr_name(aname),''
-        self.debug("DynamicDS(%s)::evalAttr(%s,%s): ... last value was %s"
-            % (self.get_name(), aname, push, shortstr(
+        self.debug("DynamicDS(%s)::evalAttr(%s,%s): ... last value was %s",
+            self.get_name(), aname, push, Lazy(lambda:shortstr(
                 getattr(self.dyn_values.get(aname,None),'value',None))))
-        tstart = time.time()
+        tstart,frame = time.time(),None
         
         try:
             aname,formula,compiled = self.get_attr_formula(aname,full=True)
         
             ##Checking attribute dependencies
-            # dependencies assigned at dyn_attr by self.check_dependencies()
+            # dependencies assigned at dyn_attr by self.build_dependencies()
             deps = False
             
             if (self.CheckDependencies and aname in self.dyn_values and
@@ -1215,50 +2097,50 @@ class DynamicDSAttrs(DynamicDSImpl):
                     deps = self.update_dependencies(aname)
             else:
                 self.debug("In evalAttr ... updating locals from dyn_values")
-                for k,v in self.dyn_values.items():
-                    if v.keep and k in formula:
-                        self._locals[k]=v.value            
+                keeps = self._formula_keeps.get(formula)
+                if keeps is None:
+                    keeps = self._formula_keeps[formula] = [k for k,v in 
+                        self.dyn_values.items() if v.keep and k in formula]
+                for k in keeps:
+                    self._locals[k]=self.dyn_values[k].value
             
             cache = self.get_attr_cache(aname) if (
                 not WRITE and not push and not deps) else None
             if cache is not None:
-                self.debug('Returning cached (%s) value for %s: %s(%s)'
-                    %(fun.time2str(cache.date),aname,type(cache.value),
-                      shortstr(cache.value)))                
+                self.debug('Returning cached (%s) value for %s: %s(%s)',
+                    Lazy(fun.time2str,cache.date),aname,type(cache.value),
+                    Lazy(shortstr,cache.value))
                 return cache.value
             
-            if formula in self.Lambdas:
+            memo = self.check_memo(aname) if (aname in self._pure 
+                    and not WRITE and _locals is None) else None
+            if memo is not None and memo[1]:
+                self.debug('evalAttr(%s): inputs not changed, memoized',aname)
+                result = memo[2]
+                
+            elif formula in self.Lambdas:
                 f = self.Lambdas[formula]
-                self.info("In evalAttr(push=%s) ... using Lambdas[%s] = %s" 
-                          % (push,formula,f))
+                self.info("In evalAttr(push=%s) ... using Lambdas[%s] = %s",
+                          push,formula,f)
                 if fun.isString(f):
                     f = self._locals.get(f,self.__getattr__(f,None))
                 result = (f() if fun.isCallable(f) else f)
                 
             else:
-                self.debug("In evalAttr ... updating locals defaults")
+                self.debug("In evalAttr ... pushing call locals")
                 try:
-                    self._locals.update({
+                    # Per call values are kept in a frame until evalAttr ends,
+                    # becoming available for quality/date/state management;
+                    # per device values (ATTRIBUTES, FORMULAS, qualities,
+                    # types, states) are already in self._locals
+                    frame = self._locals.push({
                         't':time.time()-self.time0,
                         'WRITE':WRITE,
                         'READ':bool(not WRITE),
                         'ATTRIBUTE':aname,
-                        'NAME':self.get_name(),
                         'VALUE':(VALUE if VALUE is None or aname not in self.dyn_types 
-                            else self.dyn_types[aname].pytype(VALUE)),
-                        'STATE':self.get_state(),
-                        'LOCALS':self._locals,
-                        'ATTRIBUTES':sorted(self.dyn_values.keys()),
-                        'FORMULAS':dict((k,v.formula) for k,v in self.dyn_values.items()),                  
-                        'XATTRS':self._external_attributes,
-                        }) #It is important to keep this values persistent; becoming available for quality/date/state/status management
-                    
-                    # Redundant but needed
-                    [self._locals.__setitem__(str(quality),quality) for quality in AttrQuality.values.values()]
-                    [self._locals.__setitem__(k,dst.pytype) for k,dst in DynamicDSTypes.items()]
-                    #Adding states for convenience evaluation
-                    #self.TangoStates = dict((str(v),v) for k,v in PyTango.DevState.values.items())
-                    #self._locals.update(self.TangoStates)                  
+                            else self.cast_dyn_value(aname,VALUE)),
+                        })
 
                     if _locals is not None: 
                         #High Priority: variables passed as argument
@@ -1275,17 +2157,26 @@ class DynamicDSAttrs(DynamicDSImpl):
                     raise e
             
                 if WRITE: 
-                    self.debug('%s::evalAttr(WRITE): Attribute=%s; formula=%s; VALUE=%s'%(self.get_name(),aname,formula,shortstr(VALUE)))
+                    self.debug('%s::evalAttr(WRITE): Attribute=%s; formula=%s; VALUE=%s',
+                        self.get_name(),aname,formula,Lazy(shortstr,VALUE))
                 elif aname in self.dyn_values: 
-                    self.debug('%s::evalAttr(READ): Attribute=%s; formula=%s;'%(self.get_name(),aname,formula,))
+                    self.debug('%s::evalAttr(READ): Attribute=%s; formula=%s;',
+                        self.get_name(),aname,formula)
                 else: 
-                    self.info('%s::evalAttr(COMMAND): formula=%s;'%(self.get_name(),formula,))
+                    self.info('%s::evalAttr(COMMAND): formula=%s;',
+                        self.get_name(),formula)
 
                 ###################################################################
-                result = eval(compiled or formula,self._globals,self._locals)
+                f = self.dyn_functions.get(aname)
+                if f is not None:
+                    result = f()
+                else:
+                    result = eval(compiled or formula,self._globals,self._locals)
             ###################################################################
             
-            self.debug('eval result: '+str(result))
+            if memo is not None and not memo[1]:
+                self._memo[aname] = (memo[0],result)
+            self.debug('eval result: %s',Lazy(shortstr,result))
             if aname not in self.dyn_values:
                 return result
             elif WRITE:
@@ -1300,18 +2191,22 @@ class DynamicDSAttrs(DynamicDSImpl):
             if hasattr(result,'quality'): 
                 result.quality = quality
             date = self.get_attr_date(aname,result)
-            value = self.dyn_types[aname].pytype(result)
+            value = self.cast_dyn_value(aname,result)
+            if np is not None and isinstance(value,np.ndarray):
+                result = value #Arrays are kept as numpy from here
 
             #UseEvents must be checked before updating the cache
             events = self.check_attribute_events(aname)
             check = events and (
-                        push or self.check_changed_event(aname,result,events))
+                        push or self.check_changed_event(aname,result,events)
+                        or (not self._events_paused and 
+                            quality != self.dyn_values[aname].quality))
             
             et = 1e3*(fn.now()-tstart)
             cached = events or self.dyn_values[aname].keep
             (self.debug if et < 1. else self.warning)(
                 'evalAttr(%s): events = %s, check = %s, cached = %s, '
-                'eval_ms = %d' % (aname,events,check,cached,et))
+                'eval_ms = %d', aname,events,check,cached,et)
             if events and check:
                 self.push_dyn_attr(aname,value=value,
                                    events=events,changed=1,queued=1)
@@ -1321,11 +2216,15 @@ class DynamicDSAttrs(DynamicDSImpl):
                 old = self.dyn_values[aname].value
                 self.dyn_values[aname].update(value,date,quality)
                 self._locals[aname] = value
-                self.debug('evalAttr(%s):Value kept for reuse' % (aname,))
+                self.dyn_graph.set_clean(aname)
+                self.debug('evalAttr(%s):Value kept for reuse',aname)
                 #Updating state if needed:
                 try:
-                    if old!=value and self.dyn_values.get(aname).states_queue:
-                        self.check_state()
+                    if self.check_value_changed(old,value):
+                        #Dependent attributes will be re-evaluated
+                        self.dyn_graph.mark_dirty(aname)
+                        if self.dyn_values.get(aname).states_queue:
+                            self.check_state()
                 except:
                     self.warning('Unable to check state!')
                     self.warning(traceback.format_exc())            
@@ -1354,7 +2253,10 @@ class DynamicDSAttrs(DynamicDSImpl):
         
         finally:
             self._eval_times[aname] = fun.now()-tstart
-            self._locals['ATTRIBUTE'] = ''
+            if self.profiler is not None and aname in self.dyn_values:
+                self.profiler.add(aname,'eval',self._eval_times[aname])
+            if frame is not None:
+                self._locals.pop()
             
     def evalCommand(self,cmd,argin=None):
         """This method will execute a command declared using DynamicCommands property"""
@@ -1379,19 +2281,18 @@ class DynamicDSAttrs(DynamicDSImpl):
             f = self.Lambdas[formula]
             return f() if fun.isCallable(f) else f
             
-        t = time.time()-self.time0            
         for k,v in self.dyn_values.items(): self._locals[k]=v#.value #Updating Last Attribute Values
-        __locals = {}#__locals=locals().copy() #Low priority: local variables
-        __locals.update(self._locals) #Second priority: object statements
-        __locals.update(_locals) #High Priority: variables passed as argument
-        __locals.update(
-            {'STATE':self.get_state(),'t':time.time()-self.time0,'NAME': self.get_name(),
-            'ATTRIBUTES':sorted(self.dyn_values.keys()),#'ATTRIBUTES':dict((a,getattr(self.dyn_values[a],'value',None)) for a in self.dyn_values if a in self._locals),
-            'FORMULAS':dict((k,v.formula) for k,v in self.dyn_values.items()),
+        # STATE, NAME, ATTRIBUTES, FORMULAS, XATTRS and READ/ATTRIBUTE 
+        # defaults are resolved by self._locals (lazy keys/defaults)
+        self._locals.push({
+            't':time.time()-self.time0,
             'WRITE':False,
             'VALUE':None,
-            })
-        return eval(formula,self._globals,__locals)
+            },_locals or {}) #variables passed as argument
+        try:
+            return eval(formula,self._globals,self._locals)
+        finally:
+            self._locals.pop()
     
     def rawState(self):
         self.debug('In DynamicDS.rawState(), overriding attribute-based State.')
@@ -1410,8 +2311,14 @@ class DynamicDSAttrs(DynamicDSImpl):
                 return new_state
             
             self.state_lock.acquire()
-            if self.dyn_states:
+            if self.dyn_states and current is None and (
+                    not self.check_state_inputs()):
+                self._state_counters['skipped'] += 1
+                self.debug('In DynamicDS.check_state(): inputs not changed')
+                
+            elif self.dyn_states:
                 self.info('In DynamicDS.check_state()')
+                self._state_counters['evaluated'] += 1
                 old_state = new_state if current is None else current
                 ## @remarks: the device state is not changed if none of the DynamicStates evaluates to True
                 #self.set_state(PyTango.DevState.UNKNOWN)
@@ -1434,6 +2341,9 @@ class DynamicDSAttrs(DynamicDSImpl):
                             if set_state:
                                 self.set_state(new_state,push=True)
                         break
+                        
+                if set_state:
+                    self._state_last = (time.time(),self.get_state_inputs())
         except Exception,e:
             print(traceback.format_exc())
             raise e
@@ -1458,10 +2368,38 @@ class DynamicDSAttrs(DynamicDSImpl):
                 self.warning('Unable to generate DynamicStatus:\n%s'%traceback.format_exc())
         return status.strip()    
 
+    def setup_events_queue(self):
+        """
+        Creates the events queue using EventPriorities, MaxEventQueue and 
+        EventQueuePolicy properties; pending events are kept.
+        """
+        q = self._events_queue
+        priorities = list(getattr(self,'EventPriorities',q.priorities))
+        maxsize = getattr(self,'MaxEventQueue',q.maxsize) or 0
+        policy = (getattr(self,'EventQueuePolicy','') or q.policy).lower()
+        if (priorities,maxsize,policy) == (q.priorities,q.maxsize,q.policy):
+            return q
+        try:
+            self._events_lock.acquire()
+            self._events_queue_lock.acquire()
+            new,stats = CoalescingQueue(maxsize,priorities,policy),q.stats
+            while not q.empty():
+                new.put(*q.get(False))
+            new.stats.update(stats)
+            self._events_queue = new
+            self.info('setup_events_queue(%s,%s,%s)' 
+                      % (priorities,maxsize,policy))
+        finally:
+            self._events_queue_lock.release()
+            self._events_lock.release()
+        return self._events_queue
+
     def processEvents(self):
         """
         Polled command to process the internal event queue
-        MaxEventStream must be configured
+        MaxEventStream must be configured, it bounds the number of 
+        attributes pushed on each call (events for the same attribute are
+        coalesced in the queue, EventPriorities are pushed first).
         """
         try:
             c = 0
@@ -1479,10 +2417,10 @@ class DynamicDSAttrs(DynamicDSImpl):
                 return 0
             for i in range(self.MaxEventStream):
                 try:
-                    a,v,d,q,e = self._events_queue.get(False)
+                    a,(v,d,q,e) = self._events_queue.get(False)
                     self.push_dyn_attr(a,v,d,q,e,True,False)
                     c+=1
-                except objects.Queue.Empty:
+                except CoalescingQueue.Empty:
                     break
                 except Exception as e:
                     self.warning('push(%s) failed!' % str((a,v,d,q,e)))
@@ -1519,6 +2457,20 @@ class DynamicDSHelpers(DynamicDSAttrs):
                     return k
         return aname
     
+    def get_attr_history(self,aname,window=None,method='items'):
+        """
+        Returns the (time,value,quality) samples kept for aname in the last
+        window seconds (all if None), or the result of a RingBuffer method 
+        (delta, mean, rate) over them. It requires HistorySize property.
+        
+        Available in formulas as HISTORY, DELTA, MEAN and RATE, e.g.:
+          P_RATE = RATE('P',60)
+        """
+        h = self.dyn_values[self.get_attr_name(aname)].history
+        if h is None:
+            return [] if method=='items' else None
+        return getattr(h,method)(window)
+    
     def get_attr_date(self,aname,value):
         if type(value) is DynamicAttribute:
             return value.date
@@ -1561,19 +2513,38 @@ class DynamicDSHelpers(DynamicDSAttrs):
         return ['/'.join(filter(bool,s)) for s in matches]   
     
     def get_attr_quality(self,aname,attr_value):
-        formula = self.dyn_qualities.get(aname.lower()) or 'Not specified'
-        self.debug('In get_attr_quality(%s,%s): %s' 
-            % (aname,shortstr(attr_value,15)[:10],formula))
+        a = aname.lower()
+        formula = self.dyn_qualities.get(a) or 'Not specified'
+        self.debug('In get_attr_quality(%s,%s): %s',aname,
+            Lazy(lambda:shortstr(attr_value,15)[:10]),formula)
         try:
-            if aname.lower() in self.dyn_qualities:
-                self._locals['ATTRIBUTE'] = aname.lower()
-                self._locals['FORMULAS'] = dict((k,v.formula) for k,v in self.dyn_values.items())
-                self._locals['VALUE'] = getattr(attr_value,'value',attr_value)
-                self._locals['DEFAULT'] = getattr(attr_value,'quality',AttrQuality.ATTR_VALID)
-                quality = eval(formula,{},self._locals) or AttrQuality.ATTR_VALID
+            if a in self.dyn_qualities:
+                value = getattr(attr_value,'value',attr_value)
+                default = getattr(attr_value,'quality',AttrQuality.ATTR_VALID)
+                deps = self._quality_deps.get(a)
+                inputs = None if deps is None else (
+                    [value,default]+[self.dyn_values[d].value for d in deps])
+                cache = self._quality_cache.get(a)
+                
+                if (inputs is not None and cache is not None 
+                        and not any(self.check_value_changed(i,c) 
+                                    for i,c in zip(inputs,cache[0]))):
+                    quality = cache[1]
+                else:
+                    code = self.dyn_quality_codes.get(a) or formula
+                    self._locals.push({
+                        'ATTRIBUTE':a,'VALUE':value,'DEFAULT':default})
+                    try:
+                        quality = (code() if isCallable(code) 
+                                   else eval(code,{},self._locals)
+                                   ) or AttrQuality.ATTR_VALID
+                    finally:
+                        self._locals.pop()
+                    if inputs is not None:
+                        self._quality_cache[a] = (inputs,quality)
             else:
                 quality =  getattr(attr_value,'quality',AttrQuality.ATTR_VALID)
-            self.debug('\t%s.quality = %s'%(aname,quality))
+            self.debug('\t%s.quality = %s',aname,quality)
             return quality
         except Exception,e:
             self.error('Unable to generate quality for attribute %s: %s\n%s'%(aname,formula,traceback.format_exc()))
@@ -1588,6 +2559,7 @@ class DynamicDSHelpers(DynamicDSAttrs):
             #self.info('%s,keep=%s,keeptime=%s,updated=%s' 
                     #% (aname,keep,self.KeepTime,updated))            
             if (keep and self.KeepTime and updated
+                    and not self.dyn_graph.is_dirty(aname)
                     and time.time()<(updated+(self.KeepTime/1e3))):
                 v = self.dyn_values[aname]
                 return v
@@ -1611,7 +2583,13 @@ class DynamicDSHelpers(DynamicDSAttrs):
           elif al=='status': 
               value = self.get_status()
           elif al in map(str.lower,self.dyn_values.keys()):
-              value = self.evalAttr(aname,WRITE=write,VALUE=fun.notNone(wvalue,default))
+              if getattr(self,'ConcurrentReads',False):
+                  # same lock used by read_dyn_attr/write_dyn_attr
+                  with self.get_attr_lock(self.get_attr_name(aname)):
+                      value = self.evalAttr(aname,WRITE=write,
+                                            VALUE=fun.notNone(wvalue,default))
+              else:
+                  value = self.evalAttr(aname,WRITE=write,VALUE=fun.notNone(wvalue,default))
           else:
               #Getting an Static attribute that match:
               method = getattr(self,'read_%s'%aname,getattr(self,'read_%s'%al,None))
@@ -1704,6 +2682,167 @@ class DynamicDSHelpers(DynamicDSAttrs):
         else:
             return PyTango.DeviceProxy(dname)
 
+    def parse_xattr_model(self,model):
+        """ Returns the (device,attribute) tuple of a model, parsed once """
+        try:
+            return self._xattr_models[model]
+        except KeyError:
+            params = tango.parse_tango_model(model,use_host=False) #Device will contain TANGO_HOST only if differs from current
+            if params: 
+                r = (params.get('devicemodel',None),
+                     params.get('attribute',model))
+            else: 
+                r = tuple(model.rsplit('/',1)) if '/' in model else ('',model)
+            self._xattr_models[model] = r
+            return r
+        
+    def get_xattr_handle(self,model):
+        """ A method reading model, used by FormulaCompiler """
+        self.parse_xattr_model(model)
+        return functools.partial(self.getXAttr,model)
+
+    def get_xattr_models(self,aname):
+        """ 
+        Returns the (device,attribute) external models used by a formula,
+        excluding the attributes of devices in this server
+        """
+        try:
+            return self._attr_xmodels[aname]
+        except KeyError:
+            devs_in_server = (self.myClass and self.myClass.get_devs_in_server()
+                              or [])
+            models = []
+            for m in self.get_attr_models(aname):
+                device,attr = self.parse_xattr_model(m)
+                if device and device not in devs_in_server:
+                    models.append((device,attr))
+            self._attr_xmodels[aname] = models
+            return models
+        
+    IO_CALLS = ('XAttr','XATTR','WATTR','COMM','XDEV','DELAY')
+        
+    def is_io_bound(self,aname):
+        """
+        Returns True if the formula reads external attributes or calls
+        external commands/devices; these are the attributes evaluated by
+        the EvalThreads pool in read_batch.
+        """
+        try:
+            return self._io_bound[aname]
+        except KeyError:
+            formula = self.dyn_values[aname].formula or ''
+            r = bool(self.get_xattr_models(aname) or any(c in self.IO_CALLS 
+                for c in re.findall('([_a-zA-Z][_0-9a-zA-Z]*)[ ]*\(',formula)))
+            self._io_bound[aname] = r
+            return r
+        
+    def get_eval_pool(self):
+        """
+        Returns the ThreadPool used to evaluate independent attributes in
+        parallel, None if EvalThreads is 0 (the default).
+        """
+        n = int(getattr(self,'EvalThreads',0) or 0)
+        pool = self._eval_pool
+        if pool is not None and len(pool)!=n:
+            pool.stop(0)
+            pool = self._eval_pool = None
+        if n>0 and pool is None:
+            pool = self._eval_pool = ThreadPool(n,name=self.get_name())
+        return pool
+    
+    def eval_pooled(self,aname,target,done):
+        """
+        Evaluates an attribute in an EvalThreads worker, sharing the 
+        dependencies pass of read_batch; inputs are evaluated only if expired.
+        The attribute lock is held until the result is written in dyn_values,
+        errors are kept there and returned as result.
+        """
+        self._deps_pass.nodes = done
+        try:
+            with self.get_attr_lock(aname):
+                if not target and not self.check_dependency_expired(aname):
+                    return None
+                try:
+                    return self.evalAttr(aname)
+                except Exception,e:
+                    self.dyn_values[aname].update(e,time.time(),
+                                                  AttrQuality.ATTR_INVALID)
+                    return e
+        finally:
+            self._deps_pass.nodes = None
+        
+    def get_xattr_snapshot(self,full_name):
+        """ Returns the value of full_name if prefetched within KeepTime """
+        t,value = self._xattr_snapshot.get(full_name,(0,None))
+        if t and time.time() < t+max((100,self.KeepTime))/1e3:
+            return value
+        return None
+    
+    def prefetch_xattrs(self,anames):
+        """
+        If PrefetchXAttrs is True, all the external attributes used by anames
+        formulas are read in advance, grouped by device: a single 
+        read_attributes_asynch is sent to each device and then all replies 
+        are collected; getXAttr will return these values within KeepTime.
+        
+        Latency and errors for each device are kept in self._xdevice_stats 
+        (see getXDeviceStats command).
+        """
+        if not getattr(self,'PrefetchXAttrs',False) or self.UseTaurus:
+            return 0
+        groups = defaultdict(set)
+        for a in anames:
+            for device,attr in self.get_xattr_models(a):
+                if self.get_xattr_snapshot(device+'/'+attr) is None:
+                    groups[device].add(attr)
+                
+        requests = []
+        for device,attrs in groups.items():
+            t0,attrs = time.time(),sorted(attrs)
+            try:
+                if device not in self._xdevice_proxies:
+                    self._xdevice_proxies[device] = PyTango.DeviceProxy(device)
+                dp = self._xdevice_proxies[device]
+                requests.append((device,dp,attrs,t0,
+                                 dp.read_attributes_asynch(attrs)))
+            except Exception,e:
+                self.update_xdevice_stats(device,t0,len(attrs),error=e)
+                
+        count = 0
+        for device,dp,attrs,t0,rid in requests:
+            try:
+                values = dp.read_attributes_reply(rid,
+                                        int(self.DEFAULT_POLLING_PERIOD))
+                now = time.time()
+                for attr,v in zip(attrs,values):
+                    if not getattr(v,'has_failed',False):
+                        self._xattr_snapshot[device+'/'+attr] = (now,v.value)
+                        count += 1
+                self.update_xdevice_stats(device,t0,len(attrs))
+            except Exception,e:
+                self.update_xdevice_stats(device,t0,len(attrs),error=e)
+                
+        self.debug('prefetch_xattrs(%s): %d values from %d devices' 
+                   % (len(anames),count,len(requests)))
+        return count
+    
+    def update_xdevice_stats(self,device,t0,nattrs=0,error=None):
+        now = time.time()
+        ms = 1e3*(now-t0)
+        stats = self._xdevice_stats.setdefault(device,
+            {'reads':0,'errors':0,'attributes':0,'avg_ms':0.,'max_ms':0.,
+             'last_ms':0.,'last_read':0,'last_error':''})
+        stats['reads'] += 1
+        stats['attributes'] = nattrs
+        stats['last_ms'],stats['last_read'] = ms,now
+        stats['max_ms'] = max((stats['max_ms'],ms))
+        stats['avg_ms'] += (ms-stats['avg_ms'])/stats['reads']
+        if error is not None:
+            stats['errors'] += 1
+            stats['last_error'] = shortstr(error,80)
+            self.warning('prefetch_xattrs(%s) failed: %s'%(device,error))
+        return stats
+    
     def getXAttr(self,aname,default=None,write=False,wvalue=None):
         """
         Performs an external Attribute reading, using a DeviceProxy to read own attributes.
@@ -1711,11 +2850,7 @@ class DynamicDSHelpers(DynamicDSAttrs):
         
         :returns: Attribute value or None
         """
-        params = tango.parse_tango_model(aname,use_host=False) #Device will contain TANGO_HOST only if differs from current
-        if params: 
-            device,aname = params.get('devicemodel',None),params.get('attribute',aname)
-        else: 
-            device,aname = aname.rsplit('/',1) if '/' in aname else '',aname
+        device,aname = self.parse_xattr_model(aname)
         
         (self.info if write else self.debug)("DynamicDS.getXAttr(%s,%s,write=%s): ..."
             %(device or self.get_name(),aname,write and '%s(%s)'%(type(wvalue),wvalue)))
@@ -1744,7 +2879,12 @@ class DynamicDSHelpers(DynamicDSAttrs):
                 else:
                     #READING FROM AN EXTERNAL DEVICE
                     full_name = (device or self.get_name())+'/'+aname
-                    if full_name not in self._external_attributes:
+                    snapshot = None if write else (
+                        self.get_xattr_snapshot(full_name))
+                    if snapshot is not None:
+                        self.debug('%s.getXAttr: using prefetched %s' % (
+                            self._locals.get('ATTRIBUTE'),full_name))
+                    elif full_name not in self._external_attributes:
                         self.debug('%s.getXAttr: creating %s proxy to %s' % (self._locals.get('ATTRIBUTE'),'taurus' if self.UseTaurus else 'PyTango',full_name))
                         if self.UseTaurus: 
                             #USING TAURUS+EVENTS = CACHED VALUES
@@ -1772,13 +2912,19 @@ class DynamicDSHelpers(DynamicDSAttrs):
                             self._external_attributes[full_name] = tango.CachedAttributeProxy(full_name,max((100,self.KeepTime)))#keeptime=self.KeepTime)
                     else:
                         self.debug('%s.getXAttr: using %s proxy to %s' % (self._locals.get('ATTRIBUTE'),'taurus' if self.UseTaurus else 'PyTango',full_name))
-                    if write: 
+                    if snapshot is not None:
+                        result = snapshot
+                    elif write: 
                         self.info('getXAttr(Write): %s(%s)'%(type(wvalue),wvalue))
                         self._external_attributes[full_name].write(wvalue)
                         result = wvalue
                     else:
+                        t0 = time.time()
                         attrval = self._external_attributes[full_name].read()
                         result = attrval.value
+                        if self.profiler is not None:
+                            self.profiler.add(self._locals.get('ATTRIBUTE'),
+                                              'xread',time.time()-t0)
                         
                     self.debug('%s.read() = %s ...'%(full_name,str(result)[:40])) 
         except Exception,e:
@@ -1830,7 +2976,7 @@ class DynamicDSHelpers(DynamicDSAttrs):
                 elif self._external_listeners[full_name]:
                     _log('info','\t%s.listeners: %s'%(full_name,self._external_listeners[full_name]))
                     for aname in self._external_listeners[full_name]:
-                        if self._locals['ATTRIBUTE'] == aname:
+                        if aname in self._locals.in_frames('ATTRIBUTE'):
                             #Variable already being evaluated
                             continue 
                         else:
@@ -1957,6 +3103,9 @@ class DynamicDS(DynamicDSHelpers):
 
     def delete_device(self):
         self.warning( 'DynamicDS.delete_device(): ... ')
+        if self._eval_pool is not None:
+            self._eval_pool.stop(0)
+            self._eval_pool = None
         ('Device_4Impl' in dir(PyTango) and PyTango.Device_4Impl or PyTango.Device_3Impl).delete_device(self)
         
     @self_locked
@@ -2012,6 +3161,13 @@ class DynamicDS(DynamicDSHelpers):
         attrs = self.get_device_attr()
         read_attrs = [attrs.get_attr_by_ind(d).get_name() for d in data]
         for a in read_attrs: self._read_count[a]+=1
+        self._batch.results = None
+        if getattr(self,'BatchReads',False) and len(read_attrs)>1:
+            try:
+                self.read_batch(read_attrs)
+            except Exception,e:
+                self.warning('read_attr_hardware(): batch failed: %s' % e)
+                self._batch.results = None
         return read_attrs
         #self.info("read_attr_hardware([%d]=%s)"%(len(data),str(read_attrs)[:80]))        
         ## Edit this code in child classes if needed
@@ -2024,6 +3180,100 @@ class DynamicDS(DynamicDSHelpers):
         #except Exception,e:
             #self.last_state_exception = 'Exception in read_attr_hardware: %s'%str(e)
             #self.error('Exception in read_attr_hardware: %s'%str(e))   
+        
+    def read_batch(self,anames):
+        """
+        Evaluates the requested attributes and their dependencies in a 
+        single pass, in dependency order and each formula just once.
+        Results are kept for the read_dyn_attr calls of the same request.
+        """
+        t0 = time.time()
+        anames = [self.get_attr_name(a) for a in anames]
+        targets = set(a for a in anames if a in self.dyn_values 
+                      and self.get_attr_cache(a) is None)
+        results = self._batch.results = {}
+        if len(targets)<2:
+            return results
+        
+        plan = self.dyn_graph.plan(*targets)
+        order = plan + self.dyn_graph.sort(targets)
+        self.prefetch_xattrs(order)
+        concurrent = getattr(self,'ConcurrentReads',False)
+        if not hasattr(self,'lock'):
+            self.lock = threading.RLock()
+        done = self._deps_pass.nodes = set() #Shared by update_dependencies
+        
+        # With EvalThreads, attributes not depending on each other are
+        # grouped in levels and the I/O bound ones evaluated in parallel
+        pool = self.get_eval_pool()
+        if pool is not None and not self.dyn_graph.cycles:
+            levels = self.dyn_graph.levels(order)
+        else:
+            pool,levels = None,[order]
+        
+        try:
+            if not concurrent: 
+                self.lock.acquire()
+            for level in levels:
+                pooled = {}
+                if pool is not None and len(level)>1:
+                    t1 = time.time()
+                    pooled = dict((a,pool.submit(self.eval_pooled,a,
+                                                 a in targets,done))
+                                  for a in level if self.is_io_bound(a))
+                for a in level:
+                    if a in done or a in pooled:
+                        continue
+                    lock = self.get_attr_lock(a) if concurrent else None
+                    if lock: lock.acquire()
+                    try:
+                        if a not in targets:
+                            # dependencies, updated only if expired; 
+                            # errors are kept in dyn_values by read_dyn_attr
+                            if self.check_dependency_expired(a):
+                                try:
+                                    if USE_STATIC_METHODS: 
+                                        self.read_dyn_attr(self,
+                                            tango.fakeAttributeValue(a))
+                                    else: 
+                                        self.read_dyn_attr(
+                                            tango.fakeAttributeValue(a))
+                                except:
+                                    pass
+                        else:
+                            try:
+                                results[a] = self.evalAttr(a)
+                            except Exception,e:
+                                self.dyn_values[a].update(e,time.time(),
+                                                    AttrQuality.ATTR_INVALID)
+                                results[a] = e
+                    finally:
+                        done.add(a)
+                        if lock: lock.release()
+                        
+                # EvalTimeout is counted for each attribute from submission;
+                # a late result is still written to dyn_values by the worker
+                timeout = getattr(self,'EvalTimeout',0)/1e3
+                for a,pending in sorted(pooled.items()):
+                    try:
+                        r = pending.get(max((0,t1+timeout-time.time()))
+                                        if timeout else None)
+                    except Exception,e:
+                        self.warning('read_batch(%s): %s'%(a,e))
+                        if self.profiler is not None:
+                            self.profiler.count(a,'timeout')
+                        r = e
+                    if a in targets:
+                        results[a] = r
+                    done.add(a)
+        finally:
+            self._deps_pass.nodes = None
+            if not concurrent: 
+                self.lock.release()
+                
+        self.debug('read_batch(%d): %d evaluated in %f seconds'
+            % (len(anames),len(done),time.time()-t0))
+        return results
             
     ###########################################################################
     # EXTERNAL COMMANDS
@@ -2082,6 +3332,82 @@ class DynamicDS(DynamicDSHelpers):
     def getMemUsage(self):
         return fn.linos.get_memory()/1e3
     
+    #------------------------------------------------------------------
+    #    getXDeviceStats command:
+    #
+    #    Description: Latency of external devices read by prefetch_xattrs
+    #
+    #    argin:  DevVoid
+    #    argout: DevString
+    #------------------------------------------------------------------
+    def getXDeviceStats(self):
+        return '\n'.join('%s: %s' % (d,', '.join('%s=%s'%(k,v) 
+                for k,v in sorted(s.items())))
+            for d,s in sorted(self._xdevice_stats.items()))
+    
+    #------------------------------------------------------------------
+    #    getProfile command:
+    #
+    #    Description: Per attribute eval/read/push/xread latencies (ms),
+    #       percentiles and cache hit rates (requires EnableProfiler)
+    #
+    #    argin:  DevString, attribute regexp (all if empty)
+    #    argout: DevString, JSON report
+    #------------------------------------------------------------------
+    def getProfile(self,argin=''):
+        if self.profiler is None:
+            return '{}'
+        keys = [k for k in self.profiler.keys() 
+                if k and (not argin or clmatch(argin,k))]
+        return self.profiler.to_json(keys)
+    
+    #------------------------------------------------------------------
+    #    resetProfile command:
+    #
+    #    Description: Clears all profiler histograms and counters
+    #
+    #    argin:  DevVoid
+    #    argout: DevVoid
+    #------------------------------------------------------------------
+    def resetProfile(self):
+        if self.profiler is not None:
+            self.profiler.reset()
+            
+    def get_profile_stats(self,metric='eval',stat='p50'):
+        """ Returns stat for each attribute in ProfileAttributes order """
+        if self.profiler is None:
+            return []
+        return [float(self.profiler.get(a,metric,stat))
+                for a in self.get_profile_attributes()]
+    
+    def get_profile_attributes(self):
+        return [a for a in self.dyn_values if a in self.profiler.histograms
+                ] if self.profiler is not None else []
+    
+    #------------------------------------------------------------------
+    #    Read Profile attributes
+    #------------------------------------------------------------------
+    def read_ProfileAttributes(self, attr):
+        attr.set_value(self.get_profile_attributes())
+        
+    def read_ProfileEvalP50(self, attr):
+        attr.set_value(self.get_profile_stats('eval','p50'))
+        
+    def read_ProfileEvalP95(self, attr):
+        attr.set_value(self.get_profile_stats('eval','p95'))
+        
+    def read_ProfileEvalP99(self, attr):
+        attr.set_value(self.get_profile_stats('eval','p99'))
+        
+    def read_ProfileEvalMax(self, attr):
+        attr.set_value(self.get_profile_stats('eval','max'))
+        
+    def read_ProfileCacheHitRate(self, attr):
+        report = self.profiler.report(self.get_profile_attributes()) \
+                    if self.profiler is not None else {}
+        attr.set_value([float(report[a].get('cache_hit_rate',0.))
+                        for a in self.get_profile_attributes()])
+    
     #------------------------------------------------------------------
     #    Read MemUsage attribute
     #------------------------------------------------------------------
@@ -2091,6 +3417,22 @@ class DynamicDS(DynamicDSHelpers):
         #    Add your own code here
         attr.set_value(self.getMemUsage())
         
+    #------------------------------------------------------------------
+    #    Read MemoStats attribute
+    #------------------------------------------------------------------
+    def read_MemoStats(self, attr):
+        self.debug("In read_MemoStats()")
+        attr.set_value([self._memo_counters['hits'],
+                        self._memo_counters['misses']])
+        
+    #------------------------------------------------------------------
+    #    Read StateEvaluations attribute
+    #------------------------------------------------------------------
+    def read_StateEvaluations(self, attr):
+        self.debug("In read_StateEvaluations()")
+        attr.set_value([self._state_counters['evaluated'],
+                        self._state_counters['skipped']])
+        
     #------------------------------------------------------------------
     #    Read EventQueueSize attribute
     #------------------------------------------------------------------
@@ -2100,6 +3442,14 @@ class DynamicDS(DynamicDSHelpers):
         #    Add your own code here
         attr.set_value(self._events_queue.qsize())        
         
+    #------------------------------------------------------------------
+    #    Read EventQueueStats attribute
+    #------------------------------------------------------------------
+    def read_EventQueueStats(self, attr):
+        self.debug("In read_EventQueueStats()")
+        stats = self._events_queue.stats
+        attr.set_value([stats[k] for k in ('put','coalesced','dropped','get')])
+        
     #------------------------------------------------------------------
     #    EvaluateFormula command:
     #
@@ -2268,6 +3618,12 @@ class DynamicDSClass(PyTango.DeviceClass):
             [PyTango.DevVarStringArray,
             "This property can be used to store the values of only needed attributes; values are 'yes', 'no' or a list of attribute names",
             ['yes'] ],
+        'HistorySize':
+            [PyTango.DevLong,
+            "Number of (time,value,quality) samples kept for each numeric "
+            "scalar attribute; formulas can use them with HISTORY(attr,secs),"
+            " DELTA(attr,secs), MEAN(attr,secs) or RATE(attr,secs)",
+            [ 0 ] ],
         'KeepTime':
             [PyTango.DevDouble,
             "The kept value will be returned if a kept value is re-asked within this milliseconds time (Cache).",
@@ -2291,12 +3647,81 @@ class DynamicDSClass(PyTango.DeviceClass):
             ['false'] ],
         'MaxEventStream':
             [PyTango.DevLong,
-            "Max number of events to be pushed by processEvents()",
-            [ 0 ] ],             
+            "Max number of attributes to be pushed by processEvents() "
+            "(events of the same attribute are coalesced)",
+            [ 0 ] ],
+        'MaxEventQueue':
+            [PyTango.DevLong,
+            "Max number of attributes with events waiting in the queue "
+            "(0 = unlimited); see EventQueuePolicy",
+            [ 0 ] ],
+        'EventQueuePolicy':
+            [PyTango.DevString,
+            "If MaxEventQueue is reached, discard the event of the oldest "
+            "attribute with lower priority (oldest) or the new one (newest)",
+            [ 'oldest' ] ],
+        'EventPriorities':
+            [PyTango.DevVarStringArray,
+            "Regular expressions of attributes to be pushed first by "
+            "processEvents(), in order",
+            [ 'state', 'status' ] ],             
         'UseTaurus':
             [PyTango.DevBoolean,
             "This property manages if Taurus or PyTango will be used to read external attributes.",
             [False] ],
+        'UseNumpy':
+            [PyTango.DevBoolean,
+            "If True, numeric SPECTRUM/IMAGE attributes are kept as "
+            "numpy arrays (requires numpy)",
+            [False] ],
+        'PrefetchXAttrs':
+            [PyTango.DevBoolean,
+            "If True, external attributes used by formulas are read in "
+            "advance with a single read_attributes_asynch call per device",
+            [False] ],
+        'StateMinInterval':
+            [PyTango.DevDouble,
+            "Minimum time (ms) between two evaluations of DynamicStates;"
+            " states are evaluated only if any of its inputs changed",
+            [ 0 ] ],
+        'BatchReads':
+            [PyTango.DevBoolean,
+            "If True, all attributes requested by a read_attributes call "
+            "(and their dependencies) are evaluated once, in dependency order,"
+            " at read_attr_hardware",
+            [False] ],
+        'ConcurrentReads':
+            [PyTango.DevBoolean,
+            "If True, each attribute is evaluated using its own lock instead "
+            "of a device-wide one, and cached values are returned without "
+            "locking (the server must use SerialModel NO_SYNC to take profit)",
+            [False] ],
+        'EvalThreads':
+            [PyTango.DevLong,
+            "Number of threads used to evaluate in parallel the attributes "
+            "reading external devices (XATTR, COMM, ...) that do not depend "
+            "on each other; 0 to evaluate all of them in the calling thread",
+            [ 0 ] ],
+        'EvalTimeout':
+            [PyTango.DevLong,
+            "Maximum time (ms) to wait for each attribute evaluated by the "
+            "EvalThreads; 0 to wait until finished",
+            [ 3000 ] ],
+        'MemoizeFormulas':
+            [PyTango.DevBoolean,
+            "If True, formulas using only other attributes, operators and "
+            "basic builtins are memoized like the ones tagged with #@pure",
+            [False] ],
+        'CompileFormulas':
+            [PyTango.DevBoolean,
+            "If True, attribute formulas are converted to python functions "
+            "at startup instead of being evaluated using eval()",
+            [False] ],
+        'EnableProfiler':
+            [PyTango.DevBoolean,
+            "If True, eval/read/push/external read times of each attribute"
+            " are kept in histograms (see getProfile command)",
+            [False] ],
         'LogLevel':
             [PyTango.DevString,
             "This property selects the log level (DEBUG/INFO/WARNING/ERROR)",
@@ -2307,7 +3732,7 @@ class DynamicDSClass(PyTango.DeviceClass):
     cmd_list = {
         'updateDynamicAttributes':
             [[PyTango.DevVoid, "Reloads properties and updates attributes"],
-            [PyTango.DevVoid, "Reloads properties and updates attributes"],
+            [PyTango.DevString, "Added/removed/changed attributes and time"],
             {
                 'Display level':PyTango.DispLevel.EXPERT,
              } ],
@@ -2344,6 +3769,24 @@ class DynamicDSClass(PyTango.DeviceClass):
             {
                 'Display level':PyTango.DispLevel.EXPERT,
              } ],                   
+        'getXDeviceStats':
+            [[PyTango.DevVoid, "Latency/errors of external devices (PrefetchXAttrs)"],
+            [PyTango.DevString, "Latency/errors of external devices (PrefetchXAttrs)"],
+            {
+                'Display level':PyTango.DispLevel.EXPERT,
+             } ],
+        'getProfile':
+            [[PyTango.DevString, "Attribute regexp (EnableProfiler)"],
+            [PyTango.DevString, "JSON latencies/hit rates per attribute"],
+            {
+                'Display level':PyTango.DispLevel.EXPERT,
+             } ],
+        'resetProfile':
+            [[PyTango.DevVoid, "Clears profiler histograms"],
+            [PyTango.DevVoid, "Clears profiler histograms"],
+            {
+                'Display level':PyTango.DispLevel.EXPERT,
+             } ],
         'getMemUsage':
             [[PyTango.DevVoid, "Returns own process RSS memory usage (Kb)"],
             [PyTango.DevDouble, "Returns own process RSS memory usage (Kb)"],
@@ -2374,6 +3817,78 @@ class DynamicDSClass(PyTango.DeviceClass):
            [[PyTango.DevLong,
            PyTango.SCALAR,
            PyTango.READ]],
+        'EventQueueStats':
+           [[PyTango.DevLong,
+           PyTango.SPECTRUM,
+           PyTango.READ, 4],
+            {
+                'Display level':PyTango.DispLevel.EXPERT,
+                'description':'Events queue put/coalesced/dropped/pushed counters',
+            } ],
+        'MemoStats':
+           [[PyTango.DevLong,
+           PyTango.SPECTRUM,
+           PyTango.READ, 2],
+            {
+                'Display level':PyTango.DispLevel.EXPERT,
+                'description':'Memoized (@pure) formulas hits/misses counters',
+            } ],
+        'StateEvaluations':
+           [[PyTango.DevLong,
+           PyTango.SPECTRUM,
+           PyTango.READ, 2],
+            {
+                'Display level':PyTango.DispLevel.EXPERT,
+                'description':'DynamicStates evaluated/skipped counters',
+            } ],
+        'ProfileAttributes':
+           [[PyTango.DevString,
+           PyTango.SPECTRUM,
+           PyTango.READ, 4096],
+            {
+                'Display level':PyTango.DispLevel.EXPERT,
+                'description':'Attributes in Profile* arrays (EnableProfiler)',
+            } ],
+        'ProfileEvalP50':
+           [[PyTango.DevDouble,
+           PyTango.SPECTRUM,
+           PyTango.READ, 4096],
+            {
+                'Display level':PyTango.DispLevel.EXPERT,
+                'description':'evalAttr p50 time (ms) per attribute',
+            } ],
+        'ProfileEvalP95':
+           [[PyTango.DevDouble,
+           PyTango.SPECTRUM,
+           PyTango.READ, 4096],
+            {
+                'Display level':PyTango.DispLevel.EXPERT,
+                'description':'evalAttr p95 time (ms) per attribute',
+            } ],
+        'ProfileEvalP99':
+           [[PyTango.DevDouble,
+           PyTango.SPECTRUM,
+           PyTango.READ, 4096],
+            {
+                'Display level':PyTango.DispLevel.EXPERT,
+                'description':'evalAttr p99 time (ms) per attribute',
+            } ],
+        'ProfileEvalMax':
+           [[PyTango.DevDouble,
+           PyTango.SPECTRUM,
+           PyTango.READ, 4096],
+            {
+                'Display level':PyTango.DispLevel.EXPERT,
+                'description':'evalAttr max time (ms) per attribute',
+            } ],
+        'ProfileCacheHitRate':
+           [[PyTango.DevDouble,
+           PyTango.SPECTRUM,
+           PyTango.READ, 4096],
+            {
+                'Display level':PyTango.DispLevel.EXPERT,
+                'description':'read cache hits/reads per attribute',
+            } ],
         }
         
     @staticmethod
@@ -2397,6 +3912,28 @@ class DynamicDSClass(PyTango.DeviceClass):
         for dev in dev_list:
             DynamicDS.dyn_attr(dev)
             
+    @staticmethod
+    def get_properties_snapshot(update=False):
+        """
+        Returns a PropertySnapshot with the properties of all devices and 
+        classes in this server, loaded in bulk on the first call; it is 
+        shared by all DynamicDS devices to avoid a database call for each 
+        device/property/extension at startup.
+        """
+        snap = getattr(DynamicDSClass,'_properties_snapshot',None)
+        if snap is None or update:
+            t0 = time.time()
+            db = DynamicDS.get_db()
+            server = PyTango.Util.instance().get_ds_name()
+            pairs = list(db.get_device_class_list(server))
+            devs,classes = pairs[::2],sorted(set(pairs[1::2]))
+            snap = PropertySnapshot(db).load(devs,classes)
+            DynamicDSClass._properties_snapshot = snap
+            print('DynamicDSClass.get_properties_snapshot(%s): %d devices, '
+                  '%d classes loaded in %d queries, %f seconds' % (server,
+                  len(devs),len(classes),snap.queries,time.time()-t0))
+        return snap
+            
     def get_devs_in_server(self,MyClass=None):
         """
         Method for getting a dictionary with all the devices running in this server
@@ -2433,18 +3970,22 @@ def CreateDynamicCommands(ds,ds_class):
     server = U.get_ds_name()
     print('#'*80)
     print('In DynamicDS.CreateDynamicCommands(%s)'%(server,))
-    db = U.get_database()
+    db = DynamicDSClass.get_properties_snapshot()
     #devices = DynamicDSClass('DynamicDS').get_devs_in_server()    
     classes = list(db.get_device_class_list(server))
     print('class = %s; classes = %s' % (ds.__name__,classes))
     devs = [classes[i] for i in range(len(classes)-1) if classes[i+1]==ds.__name__]    
     print('devs = %s'%(devs,))
+    if not U.is_svr_starting():
+        # Reloading (updateDynamicAttributes), snapshot may be outdated
+        db.load(devs,update=True)
     if not hasattr(ds,'dyn_comms'): ds.dyn_comms = CaselessDict()
     
     for dev in devs:
         prop = db.get_device_property(dev,['DynamicCommands'])['DynamicCommands']
         print('In DynamicDS.CreateDynamicCommands(%s.%s): %s'%(server,dev,prop))
-        prop = DynamicDS.check_property_extensions('DynamicCommands',prop)
+        prop = DynamicDS.check_property_extensions('DynamicCommands',prop,
+                                                   db=db)
         #lines = [(dev+'/'+l.split('=',1)[0].strip(),l.split('=',1)[1].strip()) 
                  #for l in [d.split('#')[0].strip() for d in prop if d] if l]
         lines = []
@@ -123,6 +123,26 @@ ERROR,WARNING,INFO,DEBUG = \
   logging.ERROR,logging.WARNING,logging.INFO,logging.DEBUG
 LogLevels = {'ERROR':ERROR,'WARNING':WARNING,'INFO':INFO,'DEBUG':DEBUG,}
   
+class Lazy(object):
+    """
+    Deferred log argument, target(*args,**kwargs) is called only when 
+    the message is formatted (i.e. if the log level is enabled):
+    
+      self.debug('value is %s',Lazy(shortstr,value))
+      
+    Any other callable passed as argument is logged as it is.
+    """
+    __slots__ = ('target','args','kwargs')
+    
+    def __init__(self,target,*args,**kwargs):
+        self.target,self.args,self.kwargs = target,args,kwargs
+        
+    def __call__(self):
+        return self.target(*self.args,**self.kwargs)
+    
+    def __str__(self):
+        return str(self())
+    
 class FakeLogger():
     """
     This class just simulates a Logger using prints with date and header, 
@@ -292,6 +312,30 @@ class Logger(Object):
         l = LogLevels(self.getLogLevel(level))
         return LogLevels[self.getLogLevel()] <= l
 
+    def isEnabledFor(self,level):
+        """
+        Cheap check to be done before building expensive log messages:
+        
+          if self.isEnabledFor(self.Debug): 
+              self.debug('value is %s' % shortstr(value))
+              
+        level can be a logging number (self.Debug) or a name ('debug');
+        if the Tango logger is in use its own level is checked instead.
+        """
+        if not isinstance(level,int):
+            level = LogLevels.get(str(level).upper(),DEBUG)
+        obj = self.use_tango and self.getTangoLog()
+        if obj:
+            try:
+                tl = obj.get_logger()
+                if level<INFO: return tl.is_debug_enabled()
+                elif level<WARNING: return tl.is_info_enabled()
+                elif level<ERROR: return tl.is_warn_enabled()
+                else: return tl.is_error_enabled()
+            except:
+                return True
+        return level>=self.log_obj.getEffectiveLevel()
+
     def getRootLog(self):
         return logging.getLogger()
     
@@ -363,22 +407,33 @@ class Logger(Object):
         self.sendToStream(msg,'error',0,*args,**kw)
             
     def sendToStream(self,msg,level,prio,*args,**kw):
-        #stream should be a number in trace=4,debug=3,info=2,warning=1,error=0
+        """
+        stream should be a number in trace=4,debug=3,info=2,warning=1,error=0
+        
+        If args are passed, msg%args is done only if the level is enabled;
+        Lazy args (e.g. Lazy(shortstr,value)) are called at that point.
+        """
         try:
             prio = min(prio,3)
+            if not self.isEnabledFor((ERROR,WARNING,INFO,DEBUG)[prio]):
+                return
+            if args:
+                msg = msg % tuple(a() if isinstance(a,Lazy) else a 
+                                  for a in args)
+                args = ()
             if self.max_len>0: msg = shortstr(msg,self.max_len)
             msg = str(msg).replace('\r','').replace('%','%%')
             obj = self.getTangoLog()
             if obj: 
                 stream = (obj.error_stream,obj.warn_stream,
                           obj.info_stream,obj.debug_stream)[prio]
-                stream(msg, *args, **kw)
+                stream(msg)
             elif self._ForcePrint: 
                 self.logPrint(level.upper(),msg)
             else: 
                 stream = (self.log_obj.error,self.log_obj.warning,
                           self.log_obj.info,self.log_obj.debug)[prio]
-                stream(msg, *args, **kw)
+                stream(msg, **kw)
         except Exception,e:
             print('Exception in Logger.%s! \nmsg:%s\ne:%s\nargs:%s\nkw:%s'
               %(level,msg,e,str(args),str(kw)))
@@ -49,17 +49,41 @@ import PyTango
 from PyTango import AttrQuality
 import fandango
 import fandango.functional as fun
-import re, time, inspect, traceback
+from fandango.arrays import RingBuffer
+import re, time, inspect, traceback, operator
+
+try:
+    import numpy as np
+except:
+    np = None
 
 class DynamicDSType(object):
     """ Allows to parse all the Tango types for Attributes """
-    def __init__(self,tangotype,labels,pytype,dimx=1,dimy=1):
+    def __init__(self,tangotype,labels,pytype,dimx=1,dimy=1,dtype=None):
         self.tangotype=tangotype
         self.name=labels[0] if labels else ''
         self.labels=labels
         self.pytype=pytype
         self.dimx=dimx
         self.dimy=dimy
+        self.dtype=dtype #numpy dtype, only for numeric arrays
+        
+    def cast(self,value,use_numpy=False):
+        """
+        Converts value to the attribute type, if use_numpy is True 
+        numeric arrays will be kept as numpy.ndarray instead of lists
+        """
+        if not (use_numpy and self.dtype and np is not None):
+            return self.pytype(value)
+        if not hasattr(value,'__iter__'):
+            return np.zeros((0,)*(1 if self.dimy==1 else 2),dtype=self.dtype)
+        value = np.asarray(value,dtype=self.dtype)
+        if self.dimy==1 and value.ndim!=1:
+            value = value.ravel()
+        elif self.dimy>1 and value.ndim!=2:
+            value = np.atleast_2d(value)
+        return value
+        
     def match(self,expr):
         expr = expr.strip()
         for l in self.labels:
@@ -104,19 +128,22 @@ DynamicDSTypes={
             ['DevVarLongArray','DevVarULongArray',
             'SPECTRUM(int','list(int','[int'],
             lambda l:[int(i) for i in 
-                ([],l)[hasattr(l,'__iter__')]],4096,1),
+                ([],l)[hasattr(l,'__iter__')]],4096,1,
+            dtype='int32'),
     'DevVarLong64Array':
         DynamicDSType(PyTango.ArgType.DevLong,
             ['DevVarLong64Array','DevVarULong64Array',
             'SPECTRUM(long','list(long','[long'],
             lambda l:[long(i) for i in 
-                ([],l)[hasattr(l,'__iter__')]],4096,1),            
+                ([],l)[hasattr(l,'__iter__')]],4096,1,
+            dtype='int64'),            
     'DevVarShortArray':
         DynamicDSType(PyTango.ArgType.DevShort,
             ['DevVarShortArray','DevVarUShortArray',
             'list(short','[short'],
             lambda l:[int(i) for i in 
-                ([],l)[hasattr(l,'__iter__')]],4096,1),
+                ([],l)[hasattr(l,'__iter__')]],4096,1,
+            dtype='int16'),
     'DevVarStringArray':
         DynamicDSType(PyTango.ArgType.DevString,
             ['DevVarStringArray','SPECTRUM(str','list(str','[str'],
@@ -126,29 +153,34 @@ DynamicDSTypes={
         DynamicDSType(PyTango.ArgType.DevShort,
             ['DevVarBooleanArray','SPECTRUM(bool','list(bool','[bool'],
             lambda l:[bool(i) for i in 
-                ([],l)[hasattr(l,'__iter__')]],4096,1),
+                ([],l)[hasattr(l,'__iter__')]],4096,1,
+            dtype='bool'),
     'DevVarDoubleArray':
         DynamicDSType(PyTango.ArgType.DevDouble,
             ['DevVarDoubleArray','SPECTRUM(float',
             'list(double','[double','list(float','[float'],
             lambda l:[float(i) for i in 
-                ([],l)[hasattr(l,'__iter__')]],4096,1),
+                ([],l)[hasattr(l,'__iter__')]],4096,1,
+            dtype='float64'),
             
     'DevVarLongImage':
         DynamicDSType(PyTango.ArgType.DevLong,
             ['DevVarLongImage','IMAGE(int,'],
             lambda l:[map(int,i) for i in 
-                ([],l)[hasattr(l,'__iter__')]],4096,4096),
+                ([],l)[hasattr(l,'__iter__')]],4096,4096,
+            dtype='int32'),
     'DevVarLong64Image':
         DynamicDSType(PyTango.ArgType.DevLong,
             ['DevVarLong64Image','IMAGE(long,'],
             lambda l:[map(long,i) for i in 
-                ([],l)[hasattr(l,'__iter__')]],4096,4096),            
+                ([],l)[hasattr(l,'__iter__')]],4096,4096,
+            dtype='int64'),            
     'DevVarShortImage':
         DynamicDSType(PyTango.ArgType.DevShort,
             ['DevVarShortImage',],
             lambda l:[map(int,i) for i in 
-                ([],l)[hasattr(l,'__iter__')]],4096,4096),
+                ([],l)[hasattr(l,'__iter__')]],4096,4096,
+            dtype='int16'),
     'DevVarStringImage':DynamicDSType(PyTango.ArgType.DevString,
             ['DevVarStringImage','IMAGE(str,'],
             lambda l:[map(str,i) for i in 
@@ -157,12 +189,14 @@ DynamicDSTypes={
         DynamicDSType(PyTango.ArgType.DevShort,
             ['DevVarBooleanImage','IMAGE(bool,'],
             lambda l:[map(bool,i) for i in 
-                ([],l)[hasattr(l,'__iter__')]],4096,4096),
+                ([],l)[hasattr(l,'__iter__')]],4096,4096,
+            dtype='bool'),
     'DevVarDoubleImage':
         DynamicDSType(PyTango.ArgType.DevDouble,
             ['DevVarDoubleImage','IMAGE(float,',],
             lambda l:[map(float,i) for i in 
-                ([],l)[hasattr(l,'__iter__')]],4096,4096),     
+                ([],l)[hasattr(l,'__iter__')]],4096,4096,
+            dtype='float64'),     
 }
 
 for a,b in [('Float','Double'),('ULong','Long'),('ULong64','Long64'),
@@ -173,11 +207,13 @@ for a,b in [('Float','Double'),('ULong','Long'),('ULong64','Long64'),
     DynamicDSTypes[ta] = DynamicDSType(
         pt,[ta],tb.pytype,tb.dimx,tb.dimy)
     ta, tb = 'DevVar%sArray'%a, DynamicDSTypes['DevVar%sArray'%b]
+    dt = ('u'+tb.dtype if a.startswith('U') and tb.dtype 
+          and tb.dtype.startswith('int') else tb.dtype)
     DynamicDSTypes[ta] = DynamicDSType(
-        pt,[ta],tb.pytype,tb.dimx,tb.dimy)
+        pt,[ta],tb.pytype,tb.dimx,tb.dimy,dt)
     ta, tb = 'DevVar%sImage'%a, DynamicDSTypes['DevVar%sImage'%b]
     DynamicDSTypes[ta] = DynamicDSType(
-        pt,[ta],tb.pytype,tb.dimx,tb.dimy)
+        pt,[ta],tb.pytype,tb.dimx,tb.dimy,dt)
     
             
 def isTypeSupported(ttype,n_dim=None):
@@ -201,10 +237,21 @@ class DynamicAttribute(object):
     interoperativity
     Future subclasses could override the operands of the class to manage 
     quality and date modifications
+    
+    Instances use __slots__ (no per-instance __dict__); subclasses needing 
+    extra members must declare their own __slots__ or get a __dict__.
+    
+    If set_history(size) is called, the last (time,value,quality) samples
+    are kept in a RingBuffer (see delta, mean and rate methods).
     '''
+    __slots__ = ('name','value','max_peak','min_peak','forced','date',
+        'quality','updated','formula','compiled','states_queue','type',
+        'keep','dependencies','primeOlder','history')
+    
     qualityOrder = [AttrQuality.ATTR_VALID, AttrQuality.ATTR_CHANGING, 
         AttrQuality.ATTR_WARNING, AttrQuality.ATTR_ALARM, 
         AttrQuality.ATTR_INVALID]
+    qualityRank = dict((q,i) for i,q in enumerate(qualityOrder))
 
     def __init__(self,value=None,date=0.,quality=AttrQuality.ATTR_VALID,name=''):
         self.name = name
@@ -222,7 +269,26 @@ class DynamicAttribute(object):
         self.keep = True
         self.dependencies = None #it will be initialized to set() in evalAttr
         self.primeOlder=False #
+        self.history = None #RingBuffer, see set_history()
         #self.__add__ = lambda self,other: self.value.__add__(other)
+        
+    def set_history(self,size,numeric=True):
+        """ 
+        Keeps the last size samples of the attribute; numeric=False is
+        needed to keep non-numeric values. size=0 disables the history.
+        """
+        self.history = RingBuffer(size,numeric) if size else None
+        
+    def delta(self,window=None):
+        """ Value increment in the last window seconds of history """
+        return self.history.delta(window) if self.history else None
+    
+    def mean(self,window=None):
+        return self.history.mean(window) if self.history else None
+    
+    def rate(self,window=None):
+        """ Value increment per second in the last window seconds """
+        return self.history.rate(window) if self.history else None
 
     def getItem(self,index=None):
         if type(self.value) is list or list in self.value.__class__.__bases__:
@@ -237,20 +303,27 @@ class DynamicAttribute(object):
         self.date=date
         self.quality=quality
         self.updated = t or fun.now()
+        if self.history is not None and not isinstance(value,Exception):
+            try:
+                self.history.append(date,value,quality)
+            except (TypeError,ValueError): 
+                pass #Not numeric, or None
         try: 
-            if value is not None and not hasattr(value,'__len__') and not isinstance(value,Exception):
+            if np is not None and isinstance(value,np.ndarray):
+                # Peaks of numeric arrays are calculated using reductions
+                if value.size and value.dtype.kind in 'iufb':
+                    vmax,vmin = value.max(),value.min()
+                    if self.max_peak[0] is None or vmax>self.max_peak[0]:
+                        self.max_peak = (vmax,date)
+                    if self.min_peak[0] is None or vmin<self.min_peak[0]:
+                        self.min_peak = (vmin,date)
+            elif value is not None and not hasattr(value,'__len__') and not isinstance(value,Exception):
                 if self.max_peak[0] is None or self.value>self.max_peak[0]:
                     self.max_peak = (value,date)
                 if self.min_peak[0] is None or self.value<self.min_peak[0]:
                     self.min_peak = (value,date)
         except: pass
 
-    def __add__(self,other):
-        result = DynamicAttribute()
-        #This method is wrong, qualities are not ordered by criticity!
-        result.update(self.value.__add__(other),min([self.date,other.date]),max([self.quality,other.quality]))
-        return result.value
-
     def __repr__(self,klass='DynamicAttribute'):
         r='%s({'%klass
         r+='"%s": %s; '%('value',repr(self.value))
@@ -262,121 +335,114 @@ class DynamicAttribute(object):
         else: r = r.replace(';',',')
         return r
 
+    def result(self,value,other=None):
+        """
+        Returns a new DynamicAttribute for the result of an operation;
+        quality is the worst of self and other (if it is a DynamicAttribute)
+        and date the newest (or the oldest, if primeOlder).
+        """
+        # __init__ is skipped, all slots are assigned in a single statement
+        result = object.__new__(DynamicAttribute)
+        (result.value,result.quality,result.date,result.primeOlder,
+            result.name,result.max_peak,result.min_peak,result.forced,
+            result.updated,result.formula,result.compiled,result.states_queue,
+            result.type,result.keep,result.dependencies,result.history) = (
+            value,self.quality,self.date,self.primeOlder,
+            '',(None,0),(None,0),None,0,None,None,[],None,True,None,None)
+        if other is not None:
+            rank = self.qualityRank
+            if rank.get(other.quality,0) >= rank.get(self.quality,0):
+                result.quality = other.quality
+            if (other.date<self.date) == bool(self.primeOlder):
+                result.date = other.date
+        return result
+
     def operator(self,op_name,other=None,unary=False,multipleargs=False):
-        #print('operator() called for %s(%s).%s(%s)'%(self.__class__,str(type(self.value)),op_name,other and other.__class__ or ''))
-        value = self.value
+        """ 
+        Calls the op_name operator method (e.g. '__add__'); kept for 
+        backwards compatibility, operators are generated at class creation
+        (see DynamicAttribute.OPERATORS)
+        """
+        method = getattr(self,op_name)
+        if unary:
+            return method()
+        elif multipleargs:
+            return method(*other)
+        else:
+            return method(other)
 
-        if value is None:
-            if op_name in ['__nonzero__','__int__','__float__','__long__','__complex__']: 
-                value = 0
-            elif op_name in ['__str__','__repr__']:
-                return ''
-            else:
-                return None
+    def __getslice__(self,i,j): 
+        return self.__getitem__(slice(i,j))
 
-        result = DynamicAttribute()
-        result.quality,result.date,result.primeOlder=self.quality,self.date,self.primeOlder
-        op_name = '__len__' if op_name == '__nonzero__' and type(value) is list else op_name
+    @staticmethod
+    def make_operator(name,function,unary=False,raw=False,none=False):
+        """
+        Returns a method applying function to the attribute value (and to 
+        the other operand, or its value if it is a DynamicAttribute).
         
-        if op_name in ['__eq__','__lt__','__gt__','__ne__','__le__','__ge__'] and '__cmp__' in dir(value):
-            if op_name is '__eq__': method = lambda s,x: not bool(s.__cmp__(x))
-            if op_name is '__ne__': method = lambda s,x: bool(s.__cmp__(x))
-            if op_name is '__lt__': method = lambda s,x: (s.__cmp__(x)<0)
-            if op_name is '__le__': method = lambda s,x: (s.__cmp__(x)<=0)
-            if op_name is '__gt__': method = lambda s,x: (s.__cmp__(x)>0)
-            if op_name is '__ge__': method = lambda s,x: (s.__cmp__(x)>=0)
-
-        elif hasattr(type(value),op_name) and hasattr(value,op_name): 
-            #Be Careful, method from the class and from the instance don't get the same args
-            method = getattr(type(value),op_name)
-            #print('Got %s from %s: %s'%(op_name,type(value),method))
-        #elif op_name in value.__class__.__base__.__dict__:
-        #    method = value.__class__.__base__.__dict__[op_name]
-
-        else:
-            raise Exception,'DynamicAttribute_WrongMethod%sFor%sType==(%s)'% (
-                    op_name,str(type(value)),value)
-
+        The result is returned as a DynamicAttribute (see result()) unless 
+        raw is True. If value is None the method returns None, unless 
+        none=True (function must manage it).
+        """
         if unary:
-            if value is None and op_name in ['__nonzero__','__int__','__float__','__long__','__complex__']: 
-                result.value = method(0)
-            else:
-                result.value = method(value)
-        elif multipleargs:
-            args=[value]+list(other)
-            result.value = method(*args)
-        elif isinstance(other,DynamicAttribute):
-            #print(str(self),'.',op_name,'(',str(other),')')
-            result.quality = self.quality if self.qualityOrder.index(self.quality)>self.qualityOrder.index(other.quality) else other.quality
-            result.date = min([self.date,other.date]) if self.primeOlder else max([self.date,other.date])
-            result.value = method(value,other.value)
-        else:
-            #print('%s,%s(%s),%s(%s)' % (method,type(value),value,type(other),other))
-            result.value = method(value,other)
-        if op_name in ['__nonzero__','__int__','__float__','__long__','__complex__','__index__','__len__','__str__',
-                    '__eq__','__lt__','__gt__','__ne__','__le__','__ge__']:
-            return result.value
+            def method(self):
+                value = self.value
+                if value is None and not none:
+                    return None
+                return function(value) if raw else self.result(function(value))
         else:
-            return result
-
-    def __add__(self,other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def __mul__(self,other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def __pow__(self,other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def __sub__(  self, other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def __mod__(  self, other):    return self.operator(inspect.currentframe().f_code.co_name,other)
-    def __div__(self,other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def __rshift__(self,other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def __lshift__(self,other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    #def __truediv__(self,other): return self.value.__class__.__dict__[inspect.currentframe().f_code.co_name](self.value,other)
-    def __radd__(self,other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def __rmul__(self,other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def __rpow__(self,other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def __rsub__(  self, other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def __rmod__(  self, other):    return self.operator(inspect.currentframe().f_code.co_name,other)
-    def __rdiv__(self,other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def __rrshift__(self,other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def __rlshift__(self,other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    #def __rtruediv__(self,other): return self.value.__class__.__dict__[inspect.currentframe().f_code.co_name](self.value,other)
+            def method(self,other):
+                value = self.value
+                if value is None:
+                    return None
+                if isinstance(other,DynamicAttribute):
+                    r = function(value,other.value)
+                    return r if raw else self.result(r,other)
+                r = function(value,other)
+                return r if raw else self.result(r)
+        method.__name__ = name
+        return method
 
-    def __complex__(self): return self.operator(inspect.currentframe().f_code.co_name,unary=True)
-    def __float__(self): return self.operator(inspect.currentframe().f_code.co_name,unary=True)
-    def __int__(self): return self.operator(inspect.currentframe().f_code.co_name,unary=True)
-    def __long__(self): return self.operator(inspect.currentframe().f_code.co_name,unary=True)
-    def __nonzero__(self): return self.operator(inspect.currentframe().f_code.co_name,unary=True)
-    def __len__(self): return self.operator(inspect.currentframe().f_code.co_name,unary=True)
-    def __str__(self): return self.operator(inspect.currentframe().f_code.co_name,unary=True)
+def _reflected(function):
+    return lambda value,other: function(other,value)
 
-    def __lt__(  self, other): return self.operator(inspect.currentframe().f_code.co_name,other)#lower than
-    def __le__(  self, other): return self.operator(inspect.currentframe().f_code.co_name,other)#lower/equal
-    def __eq__(  self, other): return self.operator(inspect.currentframe().f_code.co_name,other)#equal
-    def __ne__(  self, other): return self.operator(inspect.currentframe().f_code.co_name,other)#not equal
-    def __gt__(  self, other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def __ge__(  self, other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def __cmp__(  self, other): return self.operator(inspect.currentframe().f_code.co_name,other)#returns like strcmp (neg=lower,0=equal,pos=greater)
+def _method(name):
+    return lambda value,*args: getattr(value,name)(*args)
 
-    #List operations
-    def __contains__(self,other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def __getitem__(self,other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def __getslice__(self,*args): return self.operator(inspect.currentframe().f_code.co_name,args,multipleargs=True)
-    def __iter__(self,*args): return self.operator(inspect.currentframe().f_code.co_name,unary=True)
-    def next(self,*args): return self.operator(inspect.currentframe().f_code.co_name,unary=True)
-    def index(self,other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def append(self,other): return self.operator(inspect.currentframe().f_code.co_name,other)
+def _none_as(default,function):
+    return lambda value: function(default if value is None else value)
 
-    def count(self,other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def extend(self,other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def sort(self,other): return self.operator(inspect.currentframe().f_code.co_name,other)
+#: Operator methods of DynamicAttribute: (name,function,options);
+#: options are passed to DynamicAttribute.make_operator
+DynamicAttribute.OPERATORS = [(n,getattr(operator,n),{}) for n in (
+        '__add__','__mul__','__pow__','__sub__','__mod__','__div__',
+        '__rshift__','__lshift__','__and__','__xor__','__or__')
+    ] + [('__r'+n[2:],_reflected(getattr(operator,n)),{}) for n in (
+        '__add__','__mul__','__pow__','__sub__','__mod__','__div__',
+        '__rshift__','__lshift__')
+    ] + [(n,getattr(operator,n),{'raw':True}) for n in (
+        '__lt__','__le__','__eq__','__ne__','__gt__','__ge__','__contains__')
+    ] + [('__cmp__',cmp,{'raw':True}),
+    ] + [(n,_none_as(0,f),{'unary':True,'raw':True,'none':True}) for n,f in (
+        ('__complex__',complex),('__float__',float),('__int__',int),
+        ('__long__',long),('__nonzero__',bool))
+    ] + [('__str__',lambda v: '' if v is None else str(v),
+          {'unary':True,'raw':True,'none':True}),
+         ('__len__',len,{'unary':True,'raw':True}),
+    ] + [(n,getattr(operator,n),{'unary':True}) for n in (
+        '__neg__','__pos__','__abs__','__invert__')
+    ] + [('__getitem__',operator.getitem,{}),
+         ('__iter__',iter,{'unary':True}),
+         ('next',next,{'unary':True}),
+    ] + [(n,_method(n),{}) for n in (
+        'index','append','count','extend','sort')
+    ]
 
-    #Boolean operations
-    def __and__(  self, other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def __xor__(  self, other): return self.operator(inspect.currentframe().f_code.co_name,other)
-    def __or__(  self, other): return self.operator(inspect.currentframe().f_code.co_name,other)
+for _name,_function,_options in DynamicAttribute.OPERATORS:
+    setattr(DynamicAttribute,_name,
+            DynamicAttribute.make_operator(_name,_function,**_options))
+del _name,_function,_options
 
-    #Called to implement the unary arithmetic operations (-, +, abs() and ~).
-    def __neg__(  self): return self.operator(inspect.currentframe().f_code.co_name,unary=True)
-    def __pos__(  self): return self.operator(inspect.currentframe().f_code.co_name,unary=True)
-    def __abs__(  self): return self.operator(inspect.currentframe().f_code.co_name,unary=True)
-    def __invert__(  self): return self.operator(inspect.currentframe().f_code.co_name,unary=True)
 #
 #if op = add or sub or mul or div:
 #    __rop__ (self,other): These methods are called to implement the binary arithmetic operations (+, -, *, /, %, divmod(), pow(), **, <<, >>, &, ^, |) with reflected (swapped) operands. These functions are only called if the left operand does not support the corresponding operation and the operands are of different types
@@ -1115,7 +1115,7 @@ def check_property_extensions(prop,value,db=None,
     apply @COPY, @FILE, @ATTR macros in properties declaration, 
     to obtain property values from the database or stored files.
     
-    DynamicDS adds its own extensions
+    DynamicDS adds its own extensions; they are called as f(prop,row,db=db)
     """
     db = db or get_database()
     if multiline and isSequence(value) and len(value) and isString(value[0]): 
@@ -1133,7 +1133,7 @@ def check_property_extensions(prop,value,db=None,
                     #parsed.extend(DynamicDS._file_extension(prop,v))
                 ext,f = first([(e,f) for e,f in extensions.items() 
                                if v.startswith(e)] or [(None,None)])
-                if ext: parsed.extend(f(prop,v))
+                if ext: parsed.extend(f(prop,v,db=db))
                 else: parsed.append(v)
             except: 
                 print('check_property_extensions(%s,%s): %s'
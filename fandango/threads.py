@@ -105,6 +105,105 @@ class FakeLock(object):
 
 ###############################################################################
 
+class CoalescingQueue(object):
+    """
+    A Queue keyed by name (e.g. attribute) that keeps only the latest item 
+    put for each key, preserving the order of first arrival.
+    
+    Keys matching the priorities list (regular expressions, in order) are
+    returned first (e.g. priorities=['state','status']). 
+    
+    If maxsize>0 (distinct keys), a new key arriving to a full queue will 
+    be discarded (policy='newest') or will replace the oldest key of the 
+    lowest priority class (policy='oldest'), unless that class has higher 
+    priority than the new key (then the new key is discarded).
+    
+    Counters for put/coalesced/dropped/get items are kept in self.stats
+    
+    q = CoalescingQueue(priorities=['state'])
+    q.put('A',1); q.put('A',2); q.put('State',3)
+    q.get() => ('State',3) ; q.get() => ('A',2)
+    """
+    
+    POLICIES = ('oldest','newest')
+    Empty = Queue.Empty
+    
+    def __init__(self,maxsize=0,priorities=None,policy='oldest'):
+        from collections import OrderedDict
+        assert policy in self.POLICIES,'policy must be in %s'%(self.POLICIES,)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.priorities = list(priorities or [])
+        self._levels = [OrderedDict() for p in range(len(self.priorities)+1)]
+        self._classes = {}
+        self._lock = threading.Lock()
+        self.stats = dict.fromkeys(('put','coalesced','dropped','get'),0)
+        
+    def get_priority(self,key):
+        """ returns the index of the first priority matched by key """
+        try:
+            return self._classes[key]
+        except KeyError:
+            p = first((i for i,r in enumerate(self.priorities) 
+                       if clmatch(r,str(key))),len(self.priorities))
+            return self._classes.setdefault(key,p)
+    
+    def put(self,key,item,block=False,timeout=None):
+        """ 
+        returns False if the item was dropped 
+        (block/timeout are kept for compatibility with Queue.put)
+        """
+        priority = self.get_priority(key)
+        level = self._levels[priority]
+        with self._lock:
+            self.stats['put'] += 1
+            if key in level:
+                self.stats['coalesced'] += 1
+                level[key] = item
+                return True
+            if self.maxsize>0 and self._qsize()>=self.maxsize:
+                self.stats['dropped'] += 1
+                if self.policy == 'newest':
+                    return False
+                # a key never evicts another of higher priority
+                lowest = first(i for i in range(len(self._levels)-1,-1,-1)
+                               if self._levels[i])
+                if lowest < priority:
+                    return False
+                self._levels[lowest].popitem(last=False)
+            level[key] = item
+            return True
+        
+    def get(self,block=False,timeout=None):
+        """ 
+        returns the (key,item) tuple of higher priority or raises 
+        Queue.Empty (blocking is not supported)
+        """
+        with self._lock:
+            for level in self._levels:
+                if level:
+                    self.stats['get'] += 1
+                    return level.popitem(last=False)
+        raise Queue.Empty()
+    
+    def get_nowait(self):
+        return self.get(False)
+    
+    def _qsize(self):
+        return sum(len(l) for l in self._levels)
+    
+    def qsize(self):
+        return self._qsize()
+    
+    def empty(self):
+        return not any(self._levels)
+    
+    def clear(self):
+        with self._lock:
+            [l.clear() for l in self._levels]
+
+###############################################################################
+
 class ThreadedObject(Object):
   """
   An Object with a thread pool that provides safe stop on exit.
@@ -1146,6 +1245,84 @@ class Pool(object):
             
     pass
     
+class PendingResult(object):
+    """ Result of a task submitted to a ThreadPool """
+    
+    def __init__(self,name=''):
+        self.name = name
+        self.value = None
+        self.error = None
+        self._event = threading.Event()
+        
+    def set(self,value=None,error=None):
+        self.value,self.error = value,error
+        self._event.set()
+        
+    def done(self):
+        return self._event.is_set()
+        
+    def get(self,timeout=None):
+        """ 
+        Waits for the task to finish and returns its result, 
+        raises the task exception or a TimeOut exception.
+        """
+        if not self._event.wait(timeout) and not self._event.is_set():
+            raise Exception('TimeOut(%s,%s)!'%(self.name,timeout))
+        if self.error is not None:
+            raise self.error
+        return self.value
+    
+class ThreadPool(object):
+    """
+    A fixed number of daemon threads executing the tasks put in a queue;
+    submit() returns a PendingResult to wait for each task.
+    
+    Unlike Pool, threads are kept running until stop() is called.
+    
+    Usage:
+        tp = ThreadPool(4)
+        results = [tp.submit(read,a) for a in attributes]
+        values = [r.get(timeout=3.) for r in results]
+    """
+    
+    def __init__(self,threads=4,name='ThreadPool'):
+        self.name = name
+        self._queue = Queue.Queue()
+        self._stop = threading.Event()
+        self._threads = []
+        for i in range(threads):
+            t = threading.Thread(target=self._worker,name='%s-%d'%(name,i))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+            
+    def __len__(self):
+        return len(self._threads)
+            
+    def submit(self,target,*args,**kwargs):
+        result = PendingResult(getattr(target,'__name__',str(target)))
+        self._queue.put((result,target,args,kwargs))
+        return result
+    
+    def pending(self):
+        return self._queue.qsize()
+    
+    def stop(self,timeout=3.):
+        self._stop.set()
+        [self._queue.put(None) for t in self._threads]
+        [t.join(timeout) for t in self._threads]
+        
+    def _worker(self):
+        while not self._stop.is_set():
+            item = self._queue.get()
+            if item is None:
+                break
+            result,target,args,kwargs = item
+            try:
+                result.set(target(*args,**kwargs))
+            except Exception,e:
+                result.set(error=e)
+    
 ###############################################################################
 
 def SubprocessMethod(obj,method,*args,**kwargs):